@@ -1,34 +1,231 @@
+import boto3
+import hashlib
 import json
 import logging
 import os
+import posixpath
+import requests
 import sys
 
+from botocore.client import Config
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlparse
+
 from cirruslib  import stac
-from pystac import Catalog, Collection
+from pystac import Catalog, Collection, Link
 
 
 # configure logger - CRITICAL, ERROR, WARNING, INFO, DEBUG
 logger = logging.getLogger(__name__)
 
+# envvars
+# max number of concurrent reads and writes of collections
+MAX_WORKERS = int(os.getenv('CIRRUS_ADD_COLLECTIONS_MAX_WORKERS', 20))
+
+# links set by Cirrus when adding a collection to the root catalog
+CIRRUS_LINKS = ['self', 'root', 'parent', 'child', 'copied_from']
+
+# clients, with a connection pool large enough for all workers
+s3client = boto3.client('s3', config=Config(max_pool_connections=MAX_WORKERS))
+session = requests.Session()
+session.mount('https://', HTTPAdapter(pool_connections=MAX_WORKERS, pool_maxsize=MAX_WORKERS))
+session.mount('http://', HTTPAdapter(pool_connections=MAX_WORKERS, pool_maxsize=MAX_WORKERS))
+
+
+def collection_url(id):
+    """Get the URL of a collection in the Cirrus root catalog"""
+    return f"{stac.ROOT_URL}/{id}/collection.json"
+
+
+def s3_key(url):
+    """Get the key in the data bucket of a URL under the Cirrus root catalog"""
+    return urlparse(url).path.lstrip('/')
+
+
+def absolute_href(href, base):
+    """Get the absolute URL of a link href, relative to the (s3 or http) URL of the document it is in"""
+    if urlparse(href).scheme:
+        return href
+    parsed = urlparse(base)
+    return parsed._replace(path=posixpath.normpath(posixpath.join(posixpath.dirname(parsed.path), href))).geturl()
+
+
+def fetch(url):
+    """Fetch a JSON document from s3 or http(s)
+
+    Args:
+        url (str): s3 or http(s) URL
+
+    Returns:
+        Dict: The JSON document, None if it does not exist
+    """
+    parsed = urlparse(url)
+    if parsed.scheme == 's3':
+        try:
+            resp = s3client.get_object(Bucket=parsed.netloc, Key=parsed.path.lstrip('/'))
+        except ClientError as err:
+            if err.response['Error']['Code'] in ['404', 'NoSuchKey']:
+                return None
+            raise
+        return json.loads(resp['Body'].read())
+    resp = session.get(url)
+    if resp.status_code == 404:
+        return None
+    resp.raise_for_status()
+    return resp.json()
+
+
+def fetch_children(catalog, url):
+    """Fetch all children of a catalog concurrently
+
+    Args:
+        catalog (Dict): STAC Catalog
+        url (str): URL of the catalog, child links are relative to
+
+    Returns:
+        List[Tuple[str, Dict]]: URL and content of each child that exists
+    """
+    urls = [absolute_href(link['href'], url) for link in catalog.get('links', []) if link['rel'] == 'child']
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        children = executor.map(fetch, urls)
+    return [(u, child) for u, child in zip(urls, children) if child is not None]
+
+
+def fetch_collections(ids):
+    """Fetch the Cirrus copies of collections concurrently
+
+    Args:
+        ids (List[str]): IDs of the collections
+
+    Returns:
+        Dict: Content of each collection in Cirrus by ID, collections not in Cirrus are not included
+    """
+    urls = [f"s3://{stac.DATA_BUCKET}/{s3_key(collection_url(id))}" for id in ids]
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        collections = executor.map(fetch, urls)
+    return {id: collection for id, collection in zip(ids, collections) if collection is not None}
+
+
+def content_hash(collection, source_url=None):
+    """Hash of the content of a collection, without the links pystac rewrites when adding it to the root catalog
+
+    Other links relative to the source URL of the collection are made absolute, so that a copy written by
+    `cirruslib.stac.add_collections`, which keeps them relative, has the same hash as a copy written here.
+
+    Args:
+        collection (Dict): STAC Collection
+        source_url (str, optional): URL the collection was copied from. Defaults to None.
+
+    Returns:
+        str: MD5 hash
+    """
+    links = [link for link in collection.get('links', []) if link['rel'] not in CIRRUS_LINKS]
+    if source_url:
+        links = [dict(link, href=absolute_href(link['href'], source_url)) for link in links]
+    return hashlib.md5(json.dumps(dict(collection, links=links), sort_keys=True).encode()).hexdigest()
+
+
+def to_cirrus(collection, source_url=None):
+    """Get the Cirrus copy of a collection, as `cirruslib.stac.add_collections` adds it to the root catalog
+
+    Links relative to the source URL of the collection are made absolute, and its `copied_from` link is
+    the source URL rather than the copy. The collection is not linked from the root catalog.
+
+    Args:
+        collection (Dict): STAC Collection
+        source_url (str, optional): URL the collection was copied from. Defaults to None.
+
+    Returns:
+        pystac.Collection: STAC Collection
+    """
+    collection = Collection.from_dict(collection)
+    for rel in CIRRUS_LINKS:
+        collection.remove_links(rel)
+    # links relative to the source would be relative to the copy in Cirrus
+    if source_url:
+        for link in collection.links:
+            link.target = absolute_href(link.target, source_url)
+        collection.add_link(Link('copied_from', source_url, media_type='application/json'))
+    root_url = f"{stac.ROOT_URL}/catalog.json"
+    collection.add_link(Link('root', root_url, media_type='application/json'))
+    collection.add_link(Link('parent', root_url, media_type='application/json'))
+    collection.set_self_href(collection_url(collection.id))
+    return collection
+
+
+def write(document, url):
+    """Write a JSON document under the Cirrus root catalog"""
+    extra = {'ACL': 'public-read'} if stac.PUBLIC_CATALOG else {}
+    s3client.put_object(Bucket=stac.DATA_BUCKET, Key=s3_key(url), Body=json.dumps(document),
+                        ContentType='application/json', **extra)
+
+
+def add_collections(collections, publish=True):
+    """Add collections to the Cirrus root catalog, only writing those that are new or changed
+
+    Extends `cirruslib.stac.add_collections`, which writes all collections of the root catalog, by comparing
+    each collection with its Cirrus copy and writing and publishing only new or changed collections.
+
+    Args:
+        collections (List[Tuple[str, Dict]]): Source URL (or None) and content of each collection
+        publish (bool, optional): Publish added collections to the Cirrus publish topic. Defaults to True.
+
+    Returns:
+        List[str]: IDs of the collections written
+    """
+    sources = {collection['id']: url for url, collection in collections}
+    collections = [to_cirrus(collection, source_url=url) for url, collection in collections]
+    existing = fetch_collections([collection.id for collection in collections])
+
+    documents = [c.to_dict() for c in collections]
+    changed = [d for d in documents if d['id'] not in existing or
+               content_hash(existing[d['id']], sources[d['id']]) != content_hash(d, sources[d['id']])]
+    logger.info(f"{len(changed)} of {len(collections)} collections are new or changed")
+
+    def add(document):
+        write(document, collection_url(document['id']))
+        if publish:
+            logger.debug(f"Publishing {document['id']}")
+            stac.snsclient.publish(TopicArn=stac.PUBLISH_TOPIC, Message=json.dumps(document))
+        return document['id']
+
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        ids = list(executor.map(add, changed))
+
+    # link new collections from the root catalog, unless already linked
+    written = set(ids)
+    new = [c for c in collections if c.id in written and c.id not in existing]
+    if new:
+        # not stac.get_root_catalog, which reads all children of the root catalog to describe it
+        root = Catalog.from_file(f"{stac.ROOT_URL}/catalog.json")
+        linked = set(link.get_absolute_href() for link in root.get_child_links())
+        new = [c for c in new if collection_url(c.id) not in linked]
+        for collection in new:
+            root.add_child(collection)
+        if new:
+            write(root.to_dict(), f"{stac.ROOT_URL}/catalog.json")
+    return ids
+
 
 def lambda_handler(event, context={}):
     logger.debug('Event: %s' % json.dumps(event))
 
     # check if collection and if so, add to Cirrus
     if 'extent' in event:
-        stac.add_collections([Collection.from_dict(event)])
+        links = [link['href'] for link in event.get('links', []) if link['rel'] == 'self']
+        add_collections([(links[0] if links else None, event)])
 
     # check if URL to catalog - ingest all collections
     if 'catalog_url' in event:
-        collections = []
-        cat = Catalog.from_file(event['catalog_url'])
-        for child in cat.get_children():
-            if isinstance(child, Collection):
-                collections.append(child)
-        stac.add_collections(collections)
+        catalog = fetch(event['catalog_url'])
+        collections = [(url, child) for url, child in fetch_children(catalog, event['catalog_url'])
+                       if 'extent' in child]
+        add_collections(collections)
 
 
 if __name__ == "__main__":
     logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
     payload = {}
-    lambda_handler(payload)
\ No newline at end of file
+    lambda_handler(payload)
@@ -0,0 +1 @@
+../../shared/durations.py
\ No newline at end of file
@@ -1,33 +1,109 @@
+import base64
+import binascii
+import gzip
+import hashlib
 import json
 import logging
 import os
+import time
+from boto3.dynamodb.conditions import Key
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
-from urllib.parse import urljoin, urlparse
+from datetime import datetime, timezone
+from functools import partial
+from urllib.parse import urlencode, urljoin, urlparse
 
-from boto3utils import s3
-from cirruslib import StateDB, stac, STATES
+from botocore.exceptions import ClientError
+
+# clients and the Cirrus state database are created on first use, to keep them (and cirruslib)
+# out of cold starts of requests that do not need them
+from aws_clients import get_client, get_resource, get_statedb
+from durations import duration_percentiles
 
 logger = logging.getLogger(__name__)
 
 # envvars
 DATA_BUCKET = os.getenv('CIRRUS_DATA_BUCKET', None)
+STATS_DB = os.getenv('CIRRUS_STATS_DB', None)
+# seconds to cache collection summaries in a warm container, 0 to disable
+SUMMARY_CACHE_TTL = int(os.getenv('CIRRUS_API_SUMMARY_CACHE_TTL', 30))
+# seconds between checks that the cached root catalog is unchanged on s3
+ROOT_REVALIDATE_INTERVAL = int(os.getenv('CIRRUS_API_ROOT_REVALIDATE_INTERVAL', 60))
+# default and max number of items per page
+PAGE_SIZE = int(os.getenv('CIRRUS_API_PAGE_SIZE', 1000))
+MAX_PAGE_SIZE = int(os.getenv('CIRRUS_API_MAX_PAGE_SIZE', 10000))
+# max number of items when not paging
+UNPAGED_LIMIT = 100000
+# key attributes of the state db table, and of its indexes
+CURSOR_KEYS = [
+    {'collections_workflow', 'itemids'},
+    {'collections_workflow', 'itemids', 'state_updated'},
+    {'collections_workflow', 'itemids', 'updated'}
+]
+# max number of catids in a single lookup request
+MAX_CATIDS = int(os.getenv('CIRRUS_API_MAX_CATIDS', 2000))
+# max number of concurrent state db requests of a lookup
+MAX_WORKERS = int(os.getenv('CIRRUS_API_MAX_WORKERS', 10))
+
+# max number of keys in a single DynamoDB BatchGetItem request
+BATCH_GET_LIMIT = 100
+# max number of BatchGetItem retries of unprocessed keys
+BATCH_GET_RETRIES = 5
+
+# length of the time bucket prefix of ISO timestamps, and default period, by stats granularity
+STATS_GRANULARITIES = {
+    'hour': (13, '2d'),
+    'day': (10, '30d')
+}
+
+# state db attributes read for each item field, in addition to the key
+FIELDS = {
+    'catid': [],
+    'collections': [],
+    'workflow': [],
+    'items': [],
+    'catalog': [],
+    'state': ['state_updated'],
+    'created': ['created'],
+    'updated': ['updated'],
+    'executions': ['executions'],
+    'outputs': ['outputs'],
+    'last_error': ['last_error']
+}
+
+# threads of concurrent state db reads, kept across invocations with the state db of each thread
+executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
 
-# Cirrus state database
-statedb = StateDB()
+# cached summaries by query, and when they expire
+summaries = {}
 
+# cached root catalog, its s3 ETag, and when it was last checked
+root_catalog = {}
 
-def response(body, status_code=200, headers={}):
+
+def response(body, status_code=200, headers={}, compress=False):
     _headers = deepcopy(headers)
     # cors
     _headers.update({
         'Access-Control-Allow-Origin': '*',
         'Access-Control-Allow-Credentials': True
     })
-    return {
+    if status_code == 304:
+        # not modified responses have no body
+        body = ""
+    elif 'Content-Type' not in _headers:
+        # bodies with a Content-Type are already serialized
+        body = json.dumps(body)
+    resp = {
         "statusCode": status_code,
         "headers": _headers,
-        "body": json.dumps(body)
+        "body": body
     }
+    if compress:
+        _headers['Content-Encoding'] = 'gzip'
+        resp['body'] = base64.b64encode(gzip.compress(body.encode('utf-8'))).decode('utf-8')
+        resp['isBase64Encoded'] = True
+    return resp
  
 
 def create_link(url, title, rel, media_type='application/json'):
@@ -39,10 +115,61 @@ def create_link(url, title, rel, media_type='application/json'):
     }
 
 
+def etag(body):
+    """Create an ETag for a response body
+
+    Args:
+        body (Dict): Response body
+
+    Returns:
+        str: Quoted ETag
+    """
+    return f'"{hashlib.md5(json.dumps(body, sort_keys=True).encode()).hexdigest()}"'
+
+
+def get_header(event, name):
+    """Get a request header, case insensitive
+
+    Args:
+        event (Dict): API Gateway event
+        name (str): Header name
+
+    Returns:
+        str: Header value, None if not present
+    """
+    headers = event.get('headers') or {}
+    return next((val for key, val in headers.items() if key.lower() == name.lower()), None)
+
+
+def get_catalog():
+    """Get the root STAC catalog, cached and revalidated against s3 with its ETag
+
+    Returns:
+        Dict: Root STAC catalog
+    """
+    now = time.time()
+    if root_catalog and now - root_catalog['checked'] < ROOT_REVALIDATE_INTERVAL:
+        return root_catalog['catalog']
+    kwargs = {'IfNoneMatch': root_catalog['etag']} if root_catalog else {}
+    try:
+        resp = get_client('s3').get_object(Bucket=DATA_BUCKET, Key='catalog.json', **kwargs)
+        root_catalog.update({
+            'catalog': json.loads(resp['Body'].read()),
+            'etag': resp['ETag']
+        })
+        logger.debug(f"Fetched root catalog (ETag {resp['ETag']})")
+    except ClientError as err:
+        if err.response['Error']['Code'] not in ['304', 'NotModified']:
+            raise
+        logger.debug("Root catalog not modified")
+    root_catalog['checked'] = now
+    return root_catalog['catalog']
+
+
 def get_root(root_url):
     cat_url = f"s3://{DATA_BUCKET}/catalog.json"
     logger.debug(f"Root catalog: {cat_url}")
-    cat = s3().read_json(cat_url)
+    cat = get_catalog()
 
     links = []
     workflows = cat.get('cirrus', {}).get('workflows', {})
@@ -64,16 +191,259 @@ def get_root(root_url):
     return root
 
 
+def parse_fields(fields):
+    """Parse the item fields requested
+
+    Args:
+        fields (str): Comma separated item fields, e.g., "state,updated"
+
+    Returns:
+        List[str]: Item fields, None for all fields
+    """
+    if not fields:
+        return None
+    fields = [f.strip() for f in fields.split(',') if f.strip() != '']
+    unknown = [f for f in fields if f not in FIELDS]
+    if len(unknown) > 0:
+        raise ValueError(f"Unknown fields {', '.join(unknown)}, must be one of {', '.join(FIELDS)}")
+    return fields
+
+
+def projection(fields):
+    """Get DynamoDB projection of the state db attributes needed for item fields
+
+    Args:
+        fields (List[str]): Item fields, None for all fields
+
+    Returns:
+        Dict: ProjectionExpression and ExpressionAttributeNames parameters, empty for all fields
+    """
+    if fields is None:
+        return {}
+    attrs = list(dict.fromkeys(['collections_workflow', 'itemids'] + [a for f in fields for a in FIELDS[f]]))
+    return {
+        'ProjectionExpression': ', '.join(f"#a{i}" for i in range(len(attrs))),
+        'ExpressionAttributeNames': {f"#a{i}": attr for i, attr in enumerate(attrs)}
+    }
+
+
+def to_item(dbitem, fields=None):
+    """Convert a state db item into an API item
+
+    Args:
+        dbitem (Dict): DynamoDB Item, with at least the attributes needed for fields
+        fields (List[str], optional): Item fields to return. Defaults to all.
+
+    Returns:
+        Dict: Item
+    """
+    from cirruslib import StateDB
+    if fields is None:
+        return StateDB.dbitem_to_item(dbitem)
+    # placeholders for attributes that were not read
+    item = StateDB.dbitem_to_item(dict({'state_updated': '_', 'created': None, 'updated': None}, **dbitem))
+    return {f: item[f] for f in fields if f in item}
+
+
+def encode_cursor(key):
+    """Encode a DynamoDB key as an opaque cursor
+
+    Args:
+        key (Dict): LastEvaluatedKey of a state db query
+
+    Returns:
+        str: Cursor
+    """
+    return base64.urlsafe_b64encode(json.dumps(key, separators=(',', ':')).encode('utf-8')).decode('utf-8')
+
+
+def decode_cursor(cursor, collections_workflow):
+    """Decode a cursor into the DynamoDB key to continue a query from
+
+    Only keys of the state db table or one of its indexes, of the queried collections and workflow, are accepted.
+
+    Args:
+        cursor (str): Cursor from a previous page
+        collections_workflow (str): Input collections and workflow being queried
+
+    Returns:
+        Dict: ExclusiveStartKey of the next query
+    """
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor.encode('utf-8')))
+    except (binascii.Error, ValueError) as err:
+        raise ValueError(f"Invalid cursor {cursor}") from err
+    if (not isinstance(key, dict) or set(key) not in CURSOR_KEYS or
+            not all(isinstance(v, str) for v in key.values()) or key['collections_workflow'] != collections_workflow):
+        raise ValueError(f"Invalid cursor {cursor}")
+    return key
+
+
+def get_items_page(collections_workflow, state=None, since=None, limit=PAGE_SIZE, cursor=None, nextkey=None,
+                   sort_ascending=False, sort_index=None, fields=None):
+    """Get a page of items from the state db
+
+    Args:
+        collections_workflow (str): Input collections and workflow
+        state (str, optional): Only get items in this state. Defaults to None.
+        since (str, optional): Only get items updated since this amount of time in the past. Defaults to None.
+        limit (int, optional): Max number of items. Defaults to PAGE_SIZE.
+        cursor (str, optional): Cursor returned with the previous page. Defaults to None.
+        nextkey (str, optional): Catalog ID of the last item of the previous page, if no cursor. Defaults to None.
+        sort_ascending (bool, optional): Sort ascending. Defaults to False.
+        sort_index (str, optional): Index to sort by. Defaults to None.
+        fields (List[str], optional): Item fields to read and return. Defaults to all.
+
+    Returns:
+        Tuple[List[Dict], Dict]: Items, and the key to continue from (None if last page)
+    """
+    statedb = get_statedb()
+    kwargs = projection(fields)
+    if cursor:
+        kwargs['ExclusiveStartKey'] = decode_cursor(cursor, collections_workflow)
+    elif nextkey:
+        dbitem = statedb.get_dbitem(nextkey)
+        kwargs['ExclusiveStartKey'] = {k: dbitem[k] for k in ['collections_workflow', 'itemids', 'state_updated', 'updated']}
+    select = 'ALL_ATTRIBUTES' if fields is None else 'SPECIFIC_ATTRIBUTES'
+    resp = statedb.query(collections_workflow, state=state, since=since, select=select, sort_ascending=sort_ascending,
+                         sort_index=sort_index, Limit=limit, **kwargs)
+    return [to_item(dbitem, fields) for dbitem in resp['Items']], resp.get('LastEvaluatedKey')
+
+
+def batch_get_dbitems(keys, fields=None):
+    """Get state db items with a single BatchGetItem, retrying unprocessed keys
+
+    Args:
+        keys (List[Dict]): Up to BATCH_GET_LIMIT state db keys
+        fields (List[str], optional): Item fields to read attributes for. Defaults to all.
+
+    Returns:
+        List[Dict]: DynamoDB Items found
+    """
+    statedb = get_statedb()
+    client = statedb.db.meta.client
+    request = {statedb.table_name: dict({'Keys': keys}, **projection(fields))}
+    dbitems = []
+    for attempt in range(BATCH_GET_RETRIES + 1):
+        resp = client.batch_get_item(RequestItems=request)
+        dbitems += resp['Responses'].get(statedb.table_name, [])
+        request = resp.get('UnprocessedKeys', {})
+        if not request:
+            return dbitems
+        # back off before retrying throttled keys
+        time.sleep(0.1 * 2**attempt)
+    raise Exception(f"Unable to fetch {len(request[statedb.table_name]['Keys'])} items from state db")
+
+
+def lookup(catids, legacy=False, fields=None):
+    """Get items of many catalogs, with concurrent batched reads
+
+    Args:
+        catids (List[str]): Catalog IDs, duplicates are ignored
+        legacy (bool, optional): Return items in legacy format. Defaults to False.
+        fields (List[str], optional): Item fields to read and return. Defaults to all.
+
+    Returns:
+        Dict: Items found, in the order requested, and the catids not found
+    """
+    statedb = get_statedb()
+    catids = list(dict.fromkeys(catids))
+    keys = [statedb.catid_to_key(catid) for catid in catids]
+    chunks = [keys[i:i+BATCH_GET_LIMIT] for i in range(0, len(keys), BATCH_GET_LIMIT)]
+    dbitems = {statedb.key_to_catid(dbitem): dbitem
+               for result in executor.map(partial(batch_get_dbitems, fields=fields), chunks) for dbitem in result}
+    items = [to_item(dbitems[catid], fields) for catid in catids if catid in dbitems]
+    if legacy:
+        items = [to_legacy(item) for item in items]
+    return {
+        "items": items,
+        "missing": [catid for catid in catids if catid not in dbitems]
+    }
+
+
+def get_count(collections_workflow, state, since, limit):
+    """Get count of items in a state, with the state db of the calling thread"""
+    return get_statedb().get_counts(collections_workflow, state=state, since=since, limit=limit)
+
+
+def get_counts(collections_workflow, since, limit):
+    """Get counts of items in every state, querying all states concurrently
+
+    Args:
+        collections_workflow (str): Input collections and workflow
+        since (str): Only count items updated since this amount of time in the past
+        limit (int): Max count, larger counts are reported as "<limit>+"
+
+    Returns:
+        Dict: Counts by state
+    """
+    from cirruslib import STATES
+    futures = {s: executor.submit(get_count, collections_workflow, s, since, limit) for s in STATES}
+    return {s: future.result() for s, future in futures.items()}
+
+
 def summary(collections_workflow, since, limit):
+    key = (collections_workflow, since, limit)
+    now = time.time()
+    if key in summaries and summaries[key][0] > now:
+        logger.debug(f"Using cached summary for {collections_workflow}")
+        return summaries[key][1]
+
     parts = collections_workflow.rsplit('_', maxsplit=1)
     logger.debug(f"Getting summary for {collections_workflow}")
-    counts = {}
-    for s in STATES:
-        counts[s] = statedb.get_counts(collections_workflow, state=s, since=since, limit=limit)
+    result = {
+        "collections": parts[0],
+        "workflow": parts[1],
+        "counts": get_counts(collections_workflow, since, limit)
+    }
+    if SUMMARY_CACHE_TTL > 0:
+        # drop expired summaries
+        for k in [k for k, (expires, _) in summaries.items() if expires <= now]:
+            del summaries[k]
+        summaries[key] = (now + SUMMARY_CACHE_TTL, result)
+    return result
+
+
+def stats(collections_workflow, granularity='hour', since=None):
+    """Get state counts and processing durations by time bucket, from the pre-aggregated stats db
+
+    Args:
+        collections_workflow (str): Input collections and workflow
+        granularity (str, optional): Time bucket size, hour or day. Defaults to 'hour'.
+        since (str, optional): Get buckets since this amount of time in the past. Defaults to 2d for
+            hourly and 30d for daily buckets.
+
+    Returns:
+        Dict: Counts by state and duration percentiles for each time bucket
+    """
+    from cirruslib import STATES, StateDB
+    if granularity not in STATS_GRANULARITIES:
+        raise ValueError(f"granularity must be one of {', '.join(STATS_GRANULARITIES)}")
+    length, default_since = STATS_GRANULARITIES[granularity]
+    start = datetime.now(timezone.utc) - StateDB.since_to_timedelta(since or default_since)
+    expr = Key('collections_workflow').eq(collections_workflow) & \
+        Key('bucket').between(f"{granularity}#{start.isoformat()[:length]}", f"{granularity}#~")
+
+    buckets = []
+    kwargs = {}
+    while True:
+        resp = get_resource('dynamodb').Table(STATS_DB).query(KeyConditionExpression=expr, **kwargs)
+        for counters in resp['Items']:
+            buckets.append({
+                'bucket': counters['bucket'].split('#')[1],
+                'counts': {s: int(counters.get(s, 0)) for s in STATES},
+                'durations': duration_percentiles(counters)
+            })
+        if 'LastEvaluatedKey' not in resp:
+            break
+        kwargs['ExclusiveStartKey'] = resp['LastEvaluatedKey']
+
+    parts = collections_workflow.rsplit('_', maxsplit=1)
     return {
         "collections": parts[0],
         "workflow": parts[1],
-        "counts": counts
+        "granularity": granularity,
+        "buckets": buckets
     }
 
 
@@ -111,37 +481,116 @@ def lambda_handler(event, context):
     state = qparams.get('state', None)
     since = qparams.get('since', None)
     nextkey = qparams.get('nextkey', None)
-    limit = int(qparams.get('limit', 100000))
+    cursor = qparams.get('cursor', None)
+    limit = qparams.get('limit', None)
     sort_ascending = bool(qparams.get('sort_ascending', None))
     sort_index = qparams.get('sort_index', None)
+    fields = qparams.get('fields', None)
     #count_limit = int(qparams.get('count_limit', 100000))
     #legacy = qparams.get('legacy', False)
 
+    # bulk lookup of catids
+    if event.get('httpMethod') == 'POST':
+        if catid != 'catids':
+            return response(f"{catid} not found", status_code=404)
+        try:
+            body = event.get('body') or '{}'
+            if event.get('isBase64Encoded', False):
+                body = base64.b64decode(body)
+            body = json.loads(body)
+            catids = body['catids']
+            if not isinstance(catids, list) or len(catids) > MAX_CATIDS:
+                raise ValueError(f"catids must be a list of up to {MAX_CATIDS} catalog IDs")
+            invalid = [c for c in catids if not isinstance(c, str) or '/workflow-' not in c]
+            if len(invalid) > 0:
+                raise ValueError(f"Invalid catids: {invalid}")
+            legacy = body.get('legacy', False)
+            fields = body.get('fields', None)
+            fields = parse_fields(','.join(fields) if isinstance(fields, list) else fields)
+            if legacy and fields:
+                raise ValueError("fields are not supported with legacy")
+        except (KeyError, TypeError, ValueError) as err:
+            return response(f"Invalid request body ({err})", status_code=400)
+        return response(lookup(catids, legacy=legacy, fields=fields))
+
     # root endpoint
     if catid == '':
-        return response(get_root(root_url))
+        root = get_root(root_url)
+        tag = etag(root)
+        if get_header(event, 'If-None-Match') == tag:
+            return response(None, status_code=304, headers={'ETag': tag})
+        return response(root, headers={'ETag': tag})
 
     if '/workflow-' not in catid:
         return response(f"{path} not found", status_code=400)
         
+    statedb = get_statedb()
     key = statedb.catid_to_key(catid)
 
+    # only read and return the requested item fields
+    try:
+        fields = parse_fields(fields)
+        if legacy and fields:
+            raise ValueError("fields are not supported with legacy")
+    except ValueError as err:
+        return response(str(err), status_code=400)
+
     if key['itemids'] == '':
         # get summary of collection
-        return response(summary(key['collections_workflow'], since=since, limit=limit))
+        count_limit = int(limit) if limit else 100000
+        return response(summary(key['collections_workflow'], since=since, limit=count_limit),
+                        headers={'Cache-Control': f"max-age={SUMMARY_CACHE_TTL}"})
+    elif key['itemids'] == 'stats':
+        # get throughput stats
+        try:
+            return response(stats(key['collections_workflow'], granularity=qparams.get('granularity', 'hour'),
+                                  since=since))
+        except ValueError as err:
+            return response(str(err), status_code=400)
     elif key['itemids'] == 'items':
-        # get items
+        # get a page of items
         logger.debug(f"Getting items for {key['collections_workflow']}, state={state}, since={since}")
-        items = statedb.get_items_page(key['collections_workflow'], state=state, since=since,
-                                        limit=limit, nextkey=nextkey, sort_ascending=sort_ascending,
-                                        sort_index=sort_index)
+        ndjson = 'application/x-ndjson' in (get_header(event, 'Accept') or '')
+        paged = cursor or limit or ndjson
+        if paged:
+            limit = min(int(limit) if limit else PAGE_SIZE, MAX_PAGE_SIZE)
+        else:
+            limit = UNPAGED_LIMIT
+        try:
+            items, lastkey = get_items_page(key['collections_workflow'], state=state, since=since, limit=limit,
+                                            cursor=cursor, nextkey=nextkey, sort_ascending=sort_ascending,
+                                            sort_index=sort_index, fields=fields)
+        except ValueError as err:
+            return response(str(err), status_code=400)
         if legacy:
             items = [to_legacy(item) for item in items]
 
-        return response(items)
+        # without paging parameters, a list of items as before paging
+        if not paged:
+            return response(items)
+
+        # newline delimited JSON, with a link to the next page
+        if ndjson:
+            headers = {'Content-Type': 'application/x-ndjson'}
+            if lastkey:
+                params = {k: v for k, v in qparams.items() if k != 'nextkey'}
+                params['cursor'] = encode_cursor(lastkey)
+                headers['Link'] = f'<?{urlencode(params)}>; rel="next"'
+            body = ''.join(json.dumps(item) + '\n' for item in items)
+            return response(body, headers=headers, compress='gzip' in (get_header(event, 'Accept-Encoding') or ''))
+
+        page = {'items': items}
+        if lastkey:
+            page['nextkey'] = statedb.key_to_catid(lastkey)
+            page['cursor'] = encode_cursor(lastkey)
+        return response(page)
     else:
         # get individual item
-        item = statedb.dbitem_to_item(statedb.get_dbitem(catid))
+        if fields is None:
+            dbitem = statedb.get_dbitem(catid)
+        else:
+            dbitem = statedb.table.get_item(Key=key, **projection(fields)).get('Item', None)
+        item = to_item(dbitem, fields)
         if legacy:
             item = to_legacy(item)
         return response(item)
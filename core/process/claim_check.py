@@ -0,0 +1 @@
+../../shared/claim_check.py
\ No newline at end of file
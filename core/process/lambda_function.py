@@ -1,16 +1,652 @@
+import boto3
 import json
 import logging
+import math
 import os
+import random
+import time
+from botocore.config import Config
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
 
-from cirruslib import Catalog, Catalogs
+from boto3utils import s3
+from cirruslib import Catalog, StateDB
 from cirruslib.utils import dict_merge
 
+from aws_clients import get_statedb
+from claim_check import to_message
+
 logger = logging.getLogger(__name__)
 
+# envvars
+CATALOG_BUCKET = os.getenv('CIRRUS_CATALOG_BUCKET', None)
+BASE_WORKFLOW_ARN = os.getenv('BASE_WORKFLOW_ARN', None)
+MAX_WORKERS = int(os.getenv('CIRRUS_PROCESS_MAX_WORKERS', 10))
+# seconds to remember dispatched catalogs in a warm container, 0 to disable
+DEDUP_TTL = int(os.getenv('CIRRUS_PROCESS_DEDUP_TTL', 0))
+DEDUP_MAX_SIZE = int(os.getenv('CIRRUS_PROCESS_DEDUP_MAX_SIZE', 10000))
+RATE_LIMIT_DB = os.getenv('CIRRUS_RATE_LIMIT_DB', None)
+# length in seconds of rate limit windows
+RATE_LIMIT_WINDOW = int(os.getenv('CIRRUS_RATE_LIMIT_WINDOW', 1))
+BACKFILL_QUEUE = os.getenv('CIRRUS_PROCESS_BACKFILL_QUEUE', None)
+# fraction of each rate limit backfill catalogs may use, the rest is reserved for real-time catalogs
+BACKFILL_RATE_SHARE = float(os.getenv('CIRRUS_BACKFILL_RATE_SHARE', 0.5))
+
 # Default PROCESSES
 with open(os.path.join(os.path.dirname(__file__), 'processes.json')) as f:
     PROCESSES = json.loads(f.read())
 
+# Max workflow starts per second, by workflow and by input collections
+with open(os.path.join(os.path.dirname(__file__), 'rate_limits.json')) as f:
+    RATE_LIMITS = json.loads(f.read())
+
+# max number of keys in a single DynamoDB BatchGetItem request
+BATCH_GET_LIMIT = 100
+# max number of BatchGetItem retries of unprocessed keys
+BATCH_GET_RETRIES = 5
+# max size in bytes of the state db sort key (itemids) of grouped catalogs
+ITEMIDS_MAX_SIZE = 1024
+# max SQS message delay in seconds
+MAX_DELAY = 900
+
+# clients, s3 connection pool sized for concurrent fetching of input catalogs
+s3client = boto3.client('s3', config=Config(max_pool_connections=MAX_WORKERS))
+sqsclient = boto3.client('sqs')
+sfnclient = boto3.client('stepfunctions')
+ratelimitdb = boto3.resource('dynamodb').Table(RATE_LIMIT_DB) if RATE_LIMIT_DB else None
+
+# threads of concurrent fetches and workflow starts, kept across invocations with the state db of each thread
+executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+
+# catalog IDs recently dispatched by this container, and when (LRU order)
+recent_catids = OrderedDict()
+
+# queue URLs by queue ARN
+queue_urls = {}
+
+
+def parse_record(record):
+    """Parse an SQS record containing an SNS message
+
+    Args:
+        record (Dict): SQS record
+
+    Returns:
+        Tuple[Dict, str, bool]: The message, an Input Catalog, STAC Item, or list of catids to rerun, when it
+            was published to SNS (None for requeued messages), and if it was requeued with a reserved start
+    """
+    envelope = json.loads(record['body'])
+    msg = json.loads(envelope['Message'])
+    logger.debug('cat: %s' % json.dumps(msg))
+    return msg, envelope.get('Timestamp'), envelope.get('Reserved', False)
+
+
+def stamp(catalog, timestamps, replace=False):
+    """Set when a catalog was fed to Cirrus, used to measure end-to-end latency
+
+    Feeders may set `created` themselves, e.g. to when the source data was announced. Requeued
+    messages have no timestamp, and keep the one set when they were first received.
+
+    Args:
+        catalog (Catalog): A Cirrus Input Catalog
+        timestamps (List[str]): When each message of the catalog was published to SNS
+        replace (bool, optional): Catalog is rerun, replace the time it was first fed. Defaults to False.
+    """
+    timestamps = [t for t in timestamps if t]
+    if len(timestamps) > 0 and (replace or 'created' not in catalog['process']):
+        catalog['process']['created'] = min(timestamps)
+
+
+def is_url_message(msg):
+    """Check if a message is an s3 URL to a catalog rather than a catalog
+
+    Args:
+        msg (Dict): A message
+
+    Returns:
+        bool: True if message only has a `url`
+    """
+    return list(msg.keys()) == ['url']
+
+
+def parse_catalog(cat):
+    """Create Catalog from a message
+
+    Args:
+        cat (Dict): An Input Catalog, or a STAC Item to use with the default process for its collection
+
+    Returns:
+        Catalog: A Cirrus Input Catalog
+    """
+    if cat.get('type', '') == 'Feature':
+        # If Item, create Catalog and use default process for that collection
+        if cat['collection'] not in PROCESSES.keys():
+            raise ValueError(f"Default process not provided for collection {cat['collection']}")
+        cat_json = {
+            'type': 'FeatureCollection',
+            'features': [cat],
+            'process': PROCESSES[cat['collection']]
+        }
+        return Catalog(cat_json, update=True)
+    return Catalog(cat, update=True)
+
+
+def get_dbitems(catids):
+    """Get state DB items using batched key lookups
+
+    Args:
+        catids (List[str]): List of catalog IDs, duplicates are ignored
+
+    Returns:
+        List[Dict]: DynamoDB Items of the catalogs found in the state db
+    """
+    catids = sorted(set(catids))
+    statedb = get_statedb()
+    client = statedb.db.meta.client
+    dbitems = []
+    for i in range(0, len(catids), BATCH_GET_LIMIT):
+        request = {
+            statedb.table_name: {
+                'Keys': [statedb.catid_to_key(catid) for catid in catids[i:i+BATCH_GET_LIMIT]]
+            }
+        }
+        for attempt in range(BATCH_GET_RETRIES + 1):
+            resp = client.batch_get_item(RequestItems=request)
+            dbitems += resp['Responses'].get(statedb.table_name, [])
+            request = resp.get('UnprocessedKeys', {})
+            if not request:
+                break
+            # back off before retrying throttled keys
+            time.sleep(0.1 * 2**attempt)
+        if request:
+            raise Exception(f"Unable to fetch {len(request[statedb.table_name]['Keys'])} items from state db")
+    logger.debug(f"Fetched {len(dbitems)} items")
+    return dbitems
+
+
+def get_states(catids):
+    """Get current states of catalogs
+
+    Args:
+        catids (List[str]): List of catalog IDs
+
+    Returns:
+        Dict[str, str]: Dictionary of catalog IDs to state
+    """
+    items = [StateDB.dbitem_to_item(dbitem) for dbitem in get_dbitems(catids)]
+    return {item['catid']: item['state'] for item in items}
+
+
+def read_json(url):
+    """Read JSON from s3 with the pooled client
+
+    Args:
+        url (str): s3 URL
+
+    Returns:
+        Dict: Parsed JSON
+    """
+    parts = s3.urlparse(url)
+    resp = s3client.get_object(Bucket=parts['bucket'], Key=parts['key'])
+    return json.loads(resp['Body'].read())
+
+
+def expand_catids(executor, reruns, failures):
+    """Expand rerun messages to the original Input Catalogs of their catids
+
+    The state db is read with batched key lookups and input catalogs are fetched
+    concurrently, once per catid across all messages.
+
+    Args:
+        executor (ThreadPoolExecutor): Executor to fetch input catalogs with
+        reruns (List[Tuple[str, Dict]]): List of (message ID, message with catids)
+        failures (Set[str]): Message IDs of failed messages are added to this set
+
+    Returns:
+        List[Tuple[List[str], Catalog]]: List of (message IDs, Catalog)
+    """
+    try:
+        catids = [c for _, msg in reruns for c in msg['catids']]
+        items = [StateDB.dbitem_to_item(dbitem) for dbitem in get_dbitems(catids)]
+    except Exception as err:
+        logger.error(f"Failed fetching catids from state db: {err}", exc_info=True)
+        failures.update([msgid for msgid, _ in reruns])
+        return []
+
+    # fetch input catalogs
+    fetch_failures = set()
+    tasks = [([item['catid']], (item['catalog'],)) for item in items]
+    fetched = {catids[0]: cat for catids, cat in run_tasks(executor, read_json, tasks, fetch_failures)}
+    logger.debug(f"Retrieved {len(fetched)} input catalogs for {len(reruns)} messages")
+
+    catalogs = []
+    for msgid, msg in reruns:
+        if any(c in fetch_failures for c in msg['catids']):
+            logger.error(f"Failed fetching input catalogs for message {msgid}")
+            failures.add(msgid)
+            continue
+        # catalogs that have never been processed cannot be rerun
+        for catid in [c for c in msg['catids'] if c not in fetched]:
+            logger.warning(f"Skipping {catid}, not in state db")
+        try:
+            _cats = [Catalog(deepcopy(fetched[c])) for c in msg['catids'] if c in fetched]
+            if 'process_update' in msg:
+                logger.debug(f"Process update: {json.dumps(msg['process_update'])}")
+                for c in _cats:
+                    c['process'] = dict_merge(c['process'], msg['process_update'])
+        except Exception as err:
+            logger.error(f"Failed processing message {msgid}: {err}", exc_info=True)
+            failures.add(msgid)
+            continue
+        catalogs += [([msgid], c) for c in _cats]
+
+    return catalogs
+
+
+def dedup(catalogs):
+    """Drop duplicate catalogs within a batch and catalogs recently dispatched by this container
+
+    Args:
+        catalogs (List[Tuple[List[str], Catalog, bool]]): List of (message IDs, Catalog, replace)
+
+    Returns:
+        Tuple[List[Tuple[List[str], Catalog, bool]], int]: Unique catalogs and number of duplicates dropped
+    """
+    now = time.time()
+    # expire old entries
+    while recent_catids and next(iter(recent_catids.values())) < now - DEDUP_TTL:
+        recent_catids.popitem(last=False)
+
+    unique = OrderedDict()
+    for msgids, cat, replace in catalogs:
+        # reruns and catalogs requesting replacement are never skipped as recently dispatched
+        replace = replace or cat['process'].get('replace', False)
+        if cat['id'] in unique:
+            # keep first occurrence, but replace if any duplicate requests it
+            _msgids, _cat, _replace = unique[cat['id']]
+            unique[cat['id']] = (_msgids, _cat, _replace or replace)
+        elif cat['id'] in recent_catids and not replace:
+            logger.debug(f"Skipping {cat['id']}, recently dispatched")
+        else:
+            unique[cat['id']] = (msgids, cat, replace)
+
+    return list(unique.values()), len(catalogs) - len(unique)
+
+
+def remember(catids):
+    """Add catalog IDs to the recently dispatched catalogs of this container
+
+    Args:
+        catids (List[str]): List of catalog IDs
+    """
+    if DEDUP_TTL <= 0:
+        return
+    now = time.time()
+    for catid in catids:
+        recent_catids.pop(catid, None)
+        recent_catids[catid] = now
+    while len(recent_catids) > DEDUP_MAX_SIZE:
+        recent_catids.popitem(last=False)
+
+
+def group_catalogs(catalogs):
+    """Group single Item catalogs into multi Item catalogs, for processes that enable it
+
+    Catalogs with a single Item, an auto-assigned ID, and a process definition with
+    `max_features` greater than 1 are grouped with other catalogs having the same
+    input collections and process, so that one workflow execution handles all of them.
+    Groups are also limited by the max size of the state db sort key. The IDs of the
+    grouped catalogs are added to the process block as `members`, in the order of the features.
+
+    Args:
+        catalogs (List[Tuple[List[str], Catalog, bool]]): List of (message IDs, Catalog, replace)
+
+    Returns:
+        List[Tuple[List[str], Catalog, bool, List[Catalog]]]: List of (message IDs, Catalog, replace, grouped catalogs)
+    """
+    results = []
+    groups = OrderedDict()
+    for msgids, cat, replace in catalogs:
+        prefix = cat['id'].rsplit('/', maxsplit=1)[0]
+        groupable = (not replace and len(cat['features']) == 1 and
+                     cat['id'] == f"{prefix}/{cat['features'][0]['id']}" and
+                     cat['process'].get('max_features', 1) > 1)
+        if groupable:
+            key = (prefix, json.dumps({k: v for k, v in cat['process'].items() if k != 'created'}, sort_keys=True))
+            groups.setdefault(key, []).append((msgids, cat))
+        else:
+            results.append((msgids, cat, replace, [cat]))
+
+    for (prefix, _), members in groups.items():
+        max_features = members[0][1]['process']['max_features']
+        members = sorted(members, key=lambda m: m[1]['features'][0]['id'])
+        chunks = [[]]
+        for member in members:
+            itemids = [m[1]['features'][0]['id'] for m in chunks[-1] + [member]]
+            if len(itemids) > max_features or len('/'.join(itemids).encode('utf-8')) > ITEMIDS_MAX_SIZE:
+                chunks.append([])
+            chunks[-1].append(member)
+        for chunk in chunks:
+            if len(chunk) == 1:
+                msgids, cat = chunk[0]
+                results.append((msgids, cat, False, [cat]))
+                continue
+            features = [cat['features'][0] for _, cat in chunk]
+            process = dict(chunk[0][1]['process'], members=[c['id'] for _, c in chunk])
+            created = [c['process']['created'] for _, c in chunk if 'created' in c['process']]
+            if len(created) > 0:
+                process['created'] = min(created)
+            cat = Catalog({
+                'id': f"{prefix}/{'/'.join([f['id'] for f in features])}",
+                'type': 'FeatureCollection',
+                'features': features,
+                'process': process
+            })
+            msgids = [msgid for _msgids, _ in chunk for msgid in _msgids]
+            results.append((msgids, cat, False, [c for _, c in chunk]))
+            logger.debug(f"Grouped {len(chunk)} catalogs into {cat['id']}")
+
+    return results
+
+
+def get_rate_limits(catalog, share=1.0):
+    """Get the rate limits that apply to starting a workflow for a catalog
+
+    Args:
+        catalog (Catalog): A Cirrus Input Catalog
+        share (float, optional): Fraction of the limits available to the catalog. Defaults to 1.0.
+
+    Returns:
+        Dict[str, int]: Max number of workflow starts per window, by rate limit bucket
+    """
+    collections, workflow = StateDB.catid_to_key(catalog['id'])['collections_workflow'].rsplit('_', maxsplit=1)
+    limits = {}
+    if workflow in RATE_LIMITS.get('workflows', {}):
+        limits[f"workflow-{workflow}"] = RATE_LIMITS['workflows'][workflow]
+    if collections in RATE_LIMITS.get('collections', {}):
+        limits[collections] = RATE_LIMITS['collections'][collections]
+    return {bucket: max(1, int(rate * share * RATE_LIMIT_WINDOW)) for bucket, rate in limits.items()}
+
+
+def claim_window(bucket, window, n, limit):
+    """Claim up to n workflow starts from a rate limit bucket in a window
+
+    Starts are counted across all containers in the rate limit db, claims over the limit are given back.
+
+    Args:
+        bucket (str): Rate limit bucket
+        window (int): Rate limit window
+        n (int): Number of workflow starts to claim
+        limit (int): Max number of workflow starts per window
+
+    Returns:
+        Tuple[int, int]: Number of starts claimed, and number already claimed in the window
+    """
+    key = {'bucket': f"{bucket}_{window}"}
+    resp = ratelimitdb.update_item(
+        Key=key,
+        UpdateExpression='ADD starts :n SET expires = if_not_exists(expires, :expires)',
+        ExpressionAttributeValues={
+            ':n': n,
+            ':expires': (window + 1) * RATE_LIMIT_WINDOW + 3600
+        },
+        ReturnValues='UPDATED_NEW'
+    )
+    used = int(resp['Attributes']['starts']) - n
+    claimed = max(0, min(n, limit - used))
+    if claimed < n:
+        ratelimitdb.update_item(Key=key, UpdateExpression='ADD starts :n',
+                                ExpressionAttributeValues={':n': claimed - n})
+    return claimed, used
+
+
+def acquire(bucket, n, limit):
+    """Claim workflow starts from a rate limit bucket in the current window, and reserve the rest in later ones
+
+    Starts over the limit of the current window are reserved in the following windows with
+    free capacity, in order of arrival, so that they are not claimed again when the deferred
+    catalogs are received. The last window reserved is kept in the rate limit db, windows
+    before it are full. Starts that do not fit within the max SQS delay are not reserved, and
+    are spread over it.
+
+    Args:
+        bucket (str): Rate limit bucket
+        n (int): Number of workflow starts to claim
+        limit (int): Max number of workflow starts per window
+
+    Returns:
+        Tuple[int, List[Tuple[float, bool]]]: Number of starts granted, and (delay in seconds, reserved) for the rest
+    """
+    now = time.time()
+    window = int(now // RATE_LIMIT_WINDOW)
+    granted, _ = claim_window(bucket, window, n, limit)
+    remaining = n - granted
+    if remaining == 0:
+        return granted, []
+
+    key = {'bucket': f"{bucket}_reserved"}
+    resp = ratelimitdb.get_item(Key=key)
+    first = max(window + 1, int(resp.get('Item', {}).get('window', 0)))
+    delays = []
+    last = first
+    while remaining > 0 and last * RATE_LIMIT_WINDOW - now <= MAX_DELAY:
+        reserved, used = claim_window(bucket, last, remaining, limit)
+        # spread evenly within the window
+        delays += [(last + (used + i) / limit) * RATE_LIMIT_WINDOW - now for i in range(reserved)]
+        remaining -= reserved
+        last += 1
+    try:
+        ratelimitdb.update_item(
+            Key=key,
+            UpdateExpression='SET #window = :window, expires = :expires',
+            ConditionExpression='attribute_not_exists(#window) OR #window < :window',
+            ExpressionAttributeNames={'#window': 'window'},
+            ExpressionAttributeValues={':window': last - 1, ':expires': int(now) + MAX_DELAY + 3600}
+        )
+    except ratelimitdb.meta.client.exceptions.ConditionalCheckFailedException:
+        pass
+    delays = [(delay, True) for delay in delays]
+    delays += [(random.uniform(RATE_LIMIT_WINDOW, MAX_DELAY), False) for _ in range(remaining)]
+    return granted, delays
+
+
+def rate_limit(catalogs, share=1.0, reserved=set()):
+    """Admit catalogs within the workflow start rate limits, and defer the rest
+
+    Args:
+        catalogs (List[Tuple[List[str], Catalog, bool, List[Catalog]]]): Catalogs that will start workflows
+        share (float, optional): Fraction of the limits available to the catalogs. Defaults to 1.0.
+        reserved (Set[str], optional): IDs of messages requeued with a reserved start. Defaults to set().
+
+    Returns:
+        Tuple[List, List[Tuple[Tuple, float, bool]]]: Admitted catalogs, and deferred catalogs with delays in
+            seconds and if their start is reserved
+    """
+    if ratelimitdb is None:
+        return catalogs, []
+
+    # starts of requeued catalogs were counted when they were deferred
+    admitted = [c for c in catalogs if reserved.issuperset(c[0])]
+    catalogs = [c for c in catalogs if not reserved.issuperset(c[0])]
+
+    limits = [get_rate_limits(cat, share) for _, cat, _, _ in catalogs]
+    needed = {}
+    for _limits in limits:
+        for bucket, limit in _limits.items():
+            needed[bucket] = (needed.get(bucket, (0, limit))[0] + 1, limit)
+    grants = {bucket: acquire(bucket, n, limit) for bucket, (n, limit) in needed.items()}
+
+    deferred = []
+    for entry, _limits in zip(catalogs, limits):
+        if all(grants[bucket][0] > 0 for bucket in _limits):
+            for bucket in _limits:
+                grants[bucket] = (grants[bucket][0] - 1, grants[bucket][1])
+            admitted.append(entry)
+        else:
+            # reserved only if deferred by every limit
+            delays = [grants[b][1].pop(0) for b in _limits if grants[b][0] <= 0]
+            delay = max([d for d, _ in delays])
+            deferred.append((entry, delay, len(delays) == len(_limits) and all(r for _, r in delays)))
+    return admitted, deferred
+
+
+def get_queue_url(arn):
+    """Get URL of an SQS queue
+
+    Args:
+        arn (str): ARN of the queue
+
+    Returns:
+        str: Queue URL
+    """
+    if arn not in queue_urls:
+        parts = arn.split(':')
+        queue_urls[arn] = sqsclient.get_queue_url(QueueName=parts[5], QueueOwnerAWSAccountId=parts[4])['QueueUrl']
+    return queue_urls[arn]
+
+
+def is_backfill(arn):
+    """Check if a queue is the backfill queue
+
+    Args:
+        arn (str): ARN of the queue
+
+    Returns:
+        bool: True if backfill queue
+    """
+    return BACKFILL_QUEUE is not None and arn is not None and arn.split(':')[-1] == BACKFILL_QUEUE
+
+
+def defer(catalog, replace, queue_arn, delay, reserved=False):
+    """Put a catalog back on the queue to be processed after a delay
+
+    Args:
+        catalog (Catalog): A Cirrus Input Catalog
+        replace (bool): Process regardless of current state
+        queue_arn (str): ARN of queue
+        delay (float): Delay in seconds
+        reserved (bool, optional): Start of the catalog is reserved in the rate limits. Defaults to False.
+    """
+    cat = dict(catalog)
+    if replace:
+        cat['process'] = dict_merge(cat['process'], {'replace': True})
+    # same format as messages from the Cirrus queue topic
+    envelope = {'Message': to_message(cat, CATALOG_BUCKET, s3client)}
+    if reserved:
+        envelope['Reserved'] = True
+    body = json.dumps(envelope)
+    sqsclient.send_message(QueueUrl=get_queue_url(queue_arn), MessageBody=body, DelaySeconds=math.ceil(delay))
+    logger.debug(f"Deferred {catalog['id']} for {math.ceil(delay)} seconds")
+
+
+def will_process(catalog, state, replace=False):
+    """Check if a workflow should be started for a catalog
+
+    Args:
+        catalog (Catalog): A Cirrus Input Catalog
+        state (str): Current state of the catalog, '' if not in the state db
+        replace (bool, optional): Process regardless of current state. Defaults to False.
+
+    Returns:
+        bool: True if catalog has not been processed, has failed, or should be replaced
+    """
+    return state in ['FAILED', ''] or replace or catalog['process'].get('replace', False)
+
+
+def start_workflow(catalog, members=[]):
+    """Add a catalog, and each of the catalogs grouped into it, to Cirrus and start one workflow
+
+    Like `Catalog.process`, with the state db of the calling thread. Every member of a group is
+    claimed and gets the execution in the state db, and its input catalog
+    saved, so that it can be looked up and rerun on its own. The group has the IDs of its members
+    in the state db (`members`). If any member is already being
+    processed the group is not started, and the claimed members are set as failed so that
+    the retried messages are grouped without it.
+
+    Args:
+        catalog (Catalog): A Cirrus Input Catalog
+        members (List[Catalog], optional): The catalogs grouped into it. Defaults to [].
+
+    Returns:
+        str: Catalog ID if a workflow was started, otherwise None
+    """
+    statedb = get_statedb()
+    for cat in [catalog] + members:
+        parts = s3.urlparse(f"s3://{CATALOG_BUCKET}/{cat['id']}/input.json")
+        s3client.put_object(Bucket=parts['bucket'], Key=parts['key'], Body=json.dumps(cat),
+                            ContentType='application/json')
+
+    if len(members) > 0:
+        # mark the group with its members, so that stats count the members rather than the group as well
+        statedb.table.update_item(Key=statedb.catid_to_key(catalog['id']), UpdateExpression='SET members = :members',
+                                  ExpressionAttributeValues={':members': [cat['id'] for cat in members]})
+    try:
+        statedb.claim_processing(catalog['id'])
+    except statedb.db.meta.client.exceptions.ConditionalCheckFailedException:
+        logger.warning(f"Skipping {catalog['id']}, already in PROCESSING state")
+        return None
+
+    claimed = [catalog['id']]
+    try:
+        for cat in members:
+            statedb.claim_processing(cat['id'])
+            claimed.append(cat['id'])
+        resp = sfnclient.start_execution(stateMachineArn=BASE_WORKFLOW_ARN + catalog['process']['workflow'],
+                                         input=json.dumps(catalog.get_payload()))
+        for catid in claimed:
+            statedb.set_processing(catid, resp['executionArn'])
+        return catalog['id']
+    except Exception as err:
+        msg = f"failed starting workflow ({err})"
+        logger.error(f"{catalog['id']}: {msg}", exc_info=True)
+        for catid in claimed:
+            statedb.set_failed(catid, msg)
+        raise err
+
+
+def dispatch(catalog, state, replace=False, members=[]):
+    """Start workflow for a catalog unless it has already been processed
+
+    Args:
+        catalog (Catalog): A Cirrus Input Catalog
+        state (str): Current state of the catalog, '' if not in the state db
+        replace (bool, optional): Process regardless of current state. Defaults to False.
+        members (List[Catalog], optional): Catalogs grouped into this catalog. Defaults to [].
+
+    Returns:
+        str: Catalog ID if a workflow was started, otherwise None
+    """
+    if len(members) > 1:
+        return start_workflow(catalog, members)
+    if will_process(catalog, state, replace):
+        return start_workflow(catalog)
+    logger.info(f"Skipping {catalog['id']}, input already in {state} state")
+    return None
+
+
+def run_tasks(executor, func, tasks, failures):
+    """Run a function concurrently over tasks belonging to SQS messages
+
+    Args:
+        executor (ThreadPoolExecutor): Executor to run tasks with
+        func (Callable): Function to run
+        tasks (List[Tuple[List[str], Tuple]]): List of (message IDs, function args)
+        failures (Set[str]): Message IDs of failed tasks are added to this set
+
+    Returns:
+        List[Tuple[List[str], Any]]: List of (message IDs, result) for successful tasks
+    """
+    futures = [(msgids, executor.submit(func, *args)) for msgids, args in tasks]
+    results = []
+    for msgids, future in futures:
+        try:
+            results.append((msgids, future.result()))
+        except Exception as err:
+            logger.error(f"Failed processing messages {', '.join(msgids)}: {err}", exc_info=True)
+            failures.update(msgids)
+    return results
+
 
 def lambda_handler(payload, context):
     logger.debug(json.dumps(payload))
@@ -18,35 +654,77 @@ def lambda_handler(payload, context):
     # Read SQS payload
     if 'Records' not in payload:
         raise ValueError("Input not from SQS")
-    
-    catalogs = []
-    for record in [json.loads(r['body']) for r in payload['Records']]:
-        cat = json.loads(record['Message'])
-        logger.debug('cat: %s' % json.dumps(cat))
-        # expand catids to full catalogs
-        if 'catids' in cat:
-            _cats = Catalogs.from_catids(cat['catids'])
-            if 'process_update' in cat:
-                logger.debug(f"Process update: {json.dumps(cat['process_update'])}")
-                for c in _cats:
-                    c['process'] = dict_merge(c['process'], cat['process_update'])
-            cats = Catalogs(_cats)
-            cats.process(replace=True)
-        elif cat.get('type', '') == 'Feature':
-        # If Item, create Catalog and use default process for that collection
-            if cat['collection'] not in PROCESSES.keys():
-                raise ValueError(f"Default process not provided for collection {cat['collection']}")
-            cat_json = {
-                'type': 'FeatureCollection',
-                'features': [cat],
-                'process': PROCESSES[cat['collection']]
-            }
-            catalogs.append(Catalog(cat_json, update=True))
-        else:
-            catalogs.append(Catalog(cat, update=True))
 
-    if len(catalogs) > 0:
-        cats = Catalogs(catalogs)
-        cats.process()
+    # IDs of SQS messages that failed and should be retried
+    failures = set()
+
+    # source queue of each message
+    queues = {r['messageId']: r.get('eventSourceARN') for r in payload['Records']}
+
+    # messages, and when they were published
+    messages, timestamps, reserved = [], {}, set()
+    for record in payload['Records']:
+        try:
+            msg, timestamps[record['messageId']], _reserved = parse_record(record)
+            messages.append((record['messageId'], msg))
+            if _reserved:
+                reserved.add(record['messageId'])
+        except Exception as err:
+            logger.error(f"Failed parsing message {record['messageId']}: {err}", exc_info=True)
+            failures.add(record['messageId'])
+
+    # fetch catalogs passed by s3 URL
+    tasks = [([msgid], (msg['url'],)) for msgid, msg in messages if is_url_message(msg)]
+    if len(tasks) > 0:
+        fetched = {msgids[0]: cat for msgids, cat in run_tasks(executor, read_json, tasks, failures)}
+        messages = [(msgid, fetched.get(msgid, msg)) for msgid, msg in messages if msgid not in failures]
+
+    # expand catids of all rerun messages in bulk, reruns always replace existing
+    reruns = [(msgid, msg) for msgid, msg in messages if 'catids' in msg]
+    catalogs = [(msgids, cat, True) for msgids, cat in expand_catids(executor, reruns, failures)] if reruns else []
+
+    # parse new catalogs
+    tasks = [([msgid], (msg,)) for msgid, msg in messages if 'catids' not in msg]
+    catalogs += [(msgids, cat, False) for msgids, cat in run_tasks(executor, parse_catalog, tasks, failures)]
+
+    # drop duplicates before any state db lookups or workflow starts
+    catalogs, ndups = dedup(catalogs)
+
+    # get existing states of catalogs that are not being replaced, and skip those already processed
+    catids = [cat['id'] for msgids, cat, replace in catalogs if not replace]
+    states = get_states(catids) if len(catids) > 0 else {}
+    skipped = [c for c in catalogs if not will_process(c[1], states.get(c[1]['id'], ''), c[2])]
+    for _, cat, _ in skipped:
+        logger.info(f"Skipping {cat['id']}, input already in {states[cat['id']]} state")
+    remember([cat['id'] for _, cat, _ in skipped])
+    catalogs = [c for c in catalogs if will_process(c[1], states.get(c[1]['id'], ''), c[2])]
+
+    # group single Item catalogs into multi Item catalogs
+    for msgids, cat, replace in catalogs:
+        stamp(cat, [timestamps.get(msgid) for msgid in msgids], replace)
+    catalogs = group_catalogs(catalogs)
+
+    # defer workflow starts over the rate limits, batches from the backfill queue only get a share of them,
+    # grouped catalogs are deferred as their members and grouped again when received
+    share = BACKFILL_RATE_SHARE if any(is_backfill(arn) for arn in queues.values()) else 1.0
+    admitted, deferred = rate_limit(catalogs, share, reserved)
+    if len(deferred) > 0:
+        tasks = [(msgids, (member, replace, queues[msgids[0]], delay, _reserved))
+                 for (msgids, _, replace, members), delay, _reserved in deferred for member in members]
+        run_tasks(executor, defer, tasks, failures)
+        deferred_ids = set([cat['id'] for (_, cat, _, _), _, _ in deferred])
+        catalogs = [c for c in catalogs if c[1]['id'] not in deferred_ids]
+
+    # start workflows
+    tasks = [(msgids, (cat, states.get(cat['id'], ''), replace, members)) for msgids, cat, replace, members in catalogs]
+    dispatched = run_tasks(executor, dispatch, tasks, failures)
+    remember([c['id'] for msgids, _, _, members in catalogs if not failures.intersection(msgids) for c in members])
+    started = [catid for msgids, catid in dispatched if catid is not None]
+
+    logger.info(f"Started {len(started)} of {len(catalogs)} catalogs, dropped {ndups} duplicates, "
+                f"deferred {len(deferred)}, {len(failures)} failed messages")
 
-    return len(catalogs)
+    # partial batch response, only failed messages are returned to the queue
+    return {
+        'batchItemFailures': [{'itemIdentifier': msgid} for msgid in sorted(failures)]
+    }
@@ -1,26 +1,132 @@
 import json
 import logging
+import os
+import time
+from datetime import datetime
 
 import cirruslib.logging
 
 # logging
 logger = logging.getLogger(f"{__name__}.publish-test")
 
+# envvars
+STACK = os.getenv('CIRRUS_STACK', None)
+# CloudWatch namespace of latency metrics
+METRICS_NAMESPACE = os.getenv('CIRRUS_METRICS_NAMESPACE', 'Cirrus')
+
+# max number of values of a metric in an Embedded Metric Format document
+MAX_METRIC_VALUES = 100
+
+
+def parse_datetime(dt):
+    """Parse an ISO 8601 timestamp, such as SNS timestamps and STAC datetimes"""
+    return datetime.fromisoformat(dt.replace('Z', '+00:00'))
+
+
+def parse_message(msg, attributes={}, timestamp=None):
+    """Get the latency of a published Item
+
+    Latency is measured from when the Input Catalog was fed to Cirrus (the `created` message attribute
+    set by the publish task from `process.created`) to when the Item was published (the SNS timestamp,
+    or the Item `updated` property).
+
+    Args:
+        msg (Dict): A published STAC Item
+        attributes (Dict, optional): SNS message attributes, by name. Defaults to {}.
+        timestamp (str, optional): When the message was published to SNS. Defaults to None.
+
+    Returns:
+        Tuple[str, str, float]: Collection, workflow, and latency in seconds (None if unknown)
+    """
+    attrs = {k: v.get('Value', v.get('StringValue')) for k, v in attributes.items()}
+    props = msg.get('properties', {})
+    collection = attrs.get('collection', msg.get('collection', 'unknown'))
+    workflow = attrs.get('workflow', 'unknown')
+    created = attrs.get('created')
+    published = timestamp or props.get('updated')
+    if created is None or published is None:
+        return collection, workflow, None
+    return collection, workflow, (parse_datetime(published) - parse_datetime(created)).total_seconds()
+
+
+def aggregate(latencies):
+    """Group latencies by collection and workflow
+
+    Args:
+        latencies (List[Tuple[str, str, float]]): Collection, workflow and latency of each Item
+
+    Returns:
+        List[Dict]: Collection, workflow, count, and latencies in seconds of each group
+    """
+    groups = {}
+    for collection, workflow, latency in latencies:
+        if latency is not None:
+            groups.setdefault((collection, workflow), []).append(latency)
+    return [{'collection': collection, 'workflow': workflow, 'count': len(values), 'latencies': values}
+            for (collection, workflow), values in sorted(groups.items())]
+
+
+def emit_metrics(results):
+    """Emit the latency of each Item as CloudWatch metrics, using the Embedded Metric Format in the logs
+
+    Each latency is a value of the `Latency` metric, so CloudWatch computes percentiles over all Items,
+    rather than over the Items of one invocation. A document has at most MAX_METRIC_VALUES values.
+    """
+    metrics = [{'Name': 'Published', 'Unit': 'Count'}, {'Name': 'Latency', 'Unit': 'Seconds'}]
+    dimensions = ['collection', 'workflow'] + (['stack'] if STACK else [])
+    for result in results:
+        values = result['latencies']
+        for i in range(0, len(values), MAX_METRIC_VALUES):
+            record = {
+                '_aws': {
+                    'Timestamp': int(time.time() * 1000),
+                    'CloudWatchMetrics': [{
+                        'Namespace': METRICS_NAMESPACE,
+                        'Dimensions': [dimensions],
+                        'Metrics': metrics
+                    }]
+                },
+                'collection': result['collection'],
+                'workflow': result['workflow'],
+                'Published': len(values[i:i + MAX_METRIC_VALUES]),
+                'Latency': values[i:i + MAX_METRIC_VALUES]
+            }
+            if STACK:
+                record['stack'] = STACK
+            print(json.dumps(record))
+
 
 def handler(payload, context):
     logger.debug('Payload: %s' % json.dumps(payload))
 
+    # (message, attributes, timestamp)
     payloads = []
-    
+
     # from SQS or SNS
     if 'Records' in payload:
         for r in payload['Records']:
             if 'body' in r:
-                payloads.append(json.loads(r['body']))
+                body = json.loads(r['body'])
+                if 'Message' in body:
+                    # SNS message delivered to SQS
+                    payloads.append((json.loads(body['Message']), body.get('MessageAttributes', {}),
+                                     body.get('Timestamp')))
+                else:
+                    payloads.append((body, {}, None))
             elif 'Sns' in r:
-                payloads.append(json.loads(r['Sns']['Message']))
+                payloads.append((json.loads(r['Sns']['Message']), r['Sns'].get('MessageAttributes', {}),
+                                 r['Sns'].get('Timestamp')))
     else:
-        payloads = [payload]
+        payloads = [(payload, {}, None)]
 
-    for p in payloads:
+    latencies = []
+    for p, attributes, timestamp in payloads:
         logger.debug(f"Message: {json.dumps(p)}")
+        latencies.append(parse_message(p, attributes, timestamp))
+
+    results = aggregate(latencies)
+    for result in results:
+        logger.info(f"Latency of {result['count']} {result['collection']} Items ({result['workflow']}): "
+                    + ', '.join(f"{latency:.1f}s" for latency in result['latencies']))
+    emit_metrics(results)
+    return results
@@ -0,0 +1,166 @@
+import boto3
+import json
+import logging
+import os
+from boto3.dynamodb.types import TypeDeserializer
+from datetime import datetime, timedelta, timezone
+
+from durations import duration_bin
+
+logger = logging.getLogger(__name__)
+
+# envvars
+STATS_DB = os.getenv('CIRRUS_STATS_DB', None)
+# days to keep hourly and daily counters
+HOURLY_RETENTION = int(os.getenv('CIRRUS_STATS_HOURLY_RETENTION', 90))
+DAILY_RETENTION = int(os.getenv('CIRRUS_STATS_DAILY_RETENTION', 730))
+
+# length of the time bucket prefix of ISO timestamps, and bucket retention in days, by granularity
+GRANULARITIES = {
+    'hour': (13, HOURLY_RETENTION),
+    'day': (10, DAILY_RETENTION)
+}
+
+# states that end processing, the duration since processing started is recorded for these
+FINAL_STATES = ['COMPLETED', 'FAILED']
+
+# clients
+statsdb = boto3.resource('dynamodb').Table(STATS_DB)
+
+deserializer = TypeDeserializer()
+
+
+def deserialize(image):
+    """Convert a DynamoDB stream image into a dict
+
+    Args:
+        image (Dict): Item in DynamoDB JSON
+
+    Returns:
+        Dict: Item
+    """
+    return {k: deserializer.deserialize(v) for k, v in image.items()}
+
+
+def get_transition(record):
+    """Get the state transition of a state db stream record
+
+    Args:
+        record (Dict): DynamoDB stream record
+
+    Returns:
+        Tuple[str, str, str, float]: collections_workflow, new state, time of change, and
+            duration in seconds if processing ended (otherwise None). None if the state did not change,
+            or if the record is of a grouped catalog, whose members are counted instead.
+    """
+    if record['eventName'] not in ['INSERT', 'MODIFY']:
+        return None
+    new = deserialize(record['dynamodb']['NewImage'])
+    old = deserialize(record['dynamodb'].get('OldImage', {}))
+    if 'state_updated' not in new or 'members' in new:
+        return None
+    state, updated = new['state_updated'].split('_', maxsplit=1)
+    # a claim and the start of the workflow both set PROCESSING
+    if state == old.get('state_updated', '').split('_')[0]:
+        return None
+
+    duration = None
+    if state in FINAL_STATES:
+        # processing started at the last change to PROCESSING, or when created
+        if old.get('state_updated', '').startswith('PROCESSING_'):
+            started = old['state_updated'].split('_', maxsplit=1)[1]
+        else:
+            started = new.get('created', updated)
+        duration = (datetime.fromisoformat(updated) - datetime.fromisoformat(started)).total_seconds()
+    return new['collections_workflow'], state, updated, duration
+
+
+def get_counters(records):
+    """Aggregate state transitions into counters by time bucket
+
+    Args:
+        records (List[Dict]): DynamoDB stream records
+
+    Returns:
+        Dict[Tuple[str, str], Dict[str, int]]: Counter increments by (collections_workflow, bucket)
+    """
+    counters = {}
+    for record in records:
+        transition = get_transition(record)
+        if transition is None:
+            continue
+        collections_workflow, state, updated, duration = transition
+        for granularity, (length, _) in GRANULARITIES.items():
+            counts = counters.setdefault((collections_workflow, f"{granularity}#{updated[:length]}"), {})
+            counts[state] = counts.get(state, 0) + 1
+            if duration is not None and state == 'COMPLETED':
+                name = duration_bin(duration)
+                counts[name] = counts.get(name, 0) + 1
+    return counters
+
+
+def expires(bucket):
+    """Get expiration time of a time bucket
+
+    Args:
+        bucket (str): Time bucket, e.g., hour#2021-01-12T10
+
+    Returns:
+        int: Epoch seconds after which the counters are removed
+    """
+    granularity, start = bucket.split('#')
+    length, retention = GRANULARITIES[granularity]
+    start = datetime.fromisoformat(start + '2021-01-01T00:00:00'[length:]).replace(tzinfo=timezone.utc)
+    return int((start + timedelta(days=retention)).timestamp())
+
+
+def update_counters(collections_workflow, bucket, counts):
+    """Add to the counters of a time bucket, in one update
+
+    Args:
+        collections_workflow (str): Input collections and workflow
+        bucket (str): Time bucket, e.g., hour#2021-01-12T10
+        counts (Dict[str, int]): Increment of each counter
+    """
+    names = {f"#c{i}": name for i, name in enumerate(counts)}
+    values = {f":c{i}": n for i, n in enumerate(counts.values())}
+    values[':expires'] = expires(bucket)
+    statsdb.update_item(
+        Key={'collections_workflow': collections_workflow, 'bucket': bucket},
+        UpdateExpression=f"ADD {', '.join(f'#c{i} :c{i}' for i in range(len(counts)))} "
+                         "SET expires = if_not_exists(expires, :expires)",
+        ExpressionAttributeNames=names,
+        ExpressionAttributeValues=values
+    )
+
+
+def lambda_handler(payload, context):
+    logger.debug(json.dumps(payload))
+
+    records = payload.get('Records', [])
+    counters = get_counters(records)
+
+    # one update per time bucket, all counters of the batch added at once
+    failed = []
+    for (collections_workflow, bucket), counts in counters.items():
+        try:
+            update_counters(collections_workflow, bucket, counts)
+        except Exception as err:
+            logger.error(f"Failed updating {bucket} counters of {collections_workflow}: {err}")
+            failed.append((collections_workflow, bucket))
+
+    if len(failed) == 0:
+        logger.info(f"Updated {len(counters)} counters from {len(records)} records")
+        return {'batchItemFailures': []}
+
+    # the stream is retried from the first record of a failed update, so what the retried records
+    # added to the counters that were updated is removed, and no record is counted twice
+    first = min((r for r in records if any(key in failed for key in get_counters([r]))),
+                key=lambda r: int(r['dynamodb']['SequenceNumber']))
+    retried = [r for r in records
+               if int(r['dynamodb']['SequenceNumber']) >= int(first['dynamodb']['SequenceNumber'])]
+    for (collections_workflow, bucket), counts in get_counters(retried).items():
+        if (collections_workflow, bucket) not in failed:
+            update_counters(collections_workflow, bucket, {name: -n for name, n in counts.items()})
+    logger.warning(f"Retrying {len(retried)} of {len(records)} records, {len(failed)} counters failed to update")
+    return {'batchItemFailures': [{'itemIdentifier': first['dynamodb']['SequenceNumber']}]}
@@ -81,7 +81,10 @@ def handler(payload, context={}):
         }
 
         # feed to cirrus through SNS topic
-        snsclient.publish(TopicArn=SNS_TOPIC, Message=json.dumps(catalog))
+        # new scenes are ingested in the real-time lane
+        snsclient.publish(TopicArn=SNS_TOPIC, Message=json.dumps(catalog), MessageAttributes={
+            'priority': {'DataType': 'String', 'StringValue': 'realtime'}
+        })
         logger.debug(f"Published {item['id']} to {SNS_TOPIC}")
         catids.append(item['id'])
 
@@ -1,5 +1,7 @@
 import boto3
+import contextlib
 import gzip
+import hashlib
 import itertools
 import json
 import logging
@@ -8,10 +10,12 @@ import sys
 import uuid
 
 from boto3utils import s3
-from cirruslib.utils import submit_batch_job
 from datetime import datetime
 from os import getenv, path as op
 
+from batch_jobs import Checkpoint, batch_job_id, clear_checkpoints, submit_batch_job
+from s3_writer import CatalogIds
+
 # envvars
 SNS_TOPIC = getenv('CIRRUS_QUEUE_TOPIC_ARN')
 LAMBDA_NAME = getenv('AWS_LAMBDA_FUNCTION_NAME')
@@ -19,9 +23,6 @@ CIRRUS_STACK = getenv('CIRRUS_STACK')
 CATALOG_BUCKET = getenv('CIRRUS_CATALOG_BUCKET')
 BASE_URL = "https://roda.sentinel-hub.com"
 
-# clients
-BATCH_CLIENT = boto3.client('batch')
-
 # logging
 logger = logging.getLogger(f"{__name__}.aws-sentinel")
 
@@ -90,18 +91,91 @@ def submit_inventory_batch_jobs(inventory_url, lambda_arn, batch_size: int=10, m
     for url in s3().latest_inventory_files(inventory_url):
         urls.append(url)
         if (len(urls) % batch_size) == 0:
-            submit_batch_job({'inventory_files': urls}, lambda_arn)
+            submit_batch_job({'inventory_files': urls}, lambda_arn, definition='geolambda-as-batch')
             urls = []
             n += 1
             if max_batches > 0 and n > max_batches:
                 break
     if len(urls) > 0:
-        submit_batch_job({'inventory_files': urls}, lambda_arn)
+        submit_batch_job({'inventory_files': urls}, lambda_arn, definition='geolambda-as-batch')
         n += 1
     logger.info(f"Submitted {n} jobs")
     return n
 
 
+def read_inventory_file(url):
+    """Get the URLs of the tileInfo.json files in an inventory file
+
+    Args:
+        url (str): s3 URL of a gzipped CSV inventory file
+
+    Yields:
+        str: URL of a tileInfo.json file
+    """
+    filename = s3().download(url, path='/tmp')
+    with gzip.open(filename, 'rt') as f:
+        for line in f:
+            if 'tileInfo.json' in line:
+                parts = line.split(',')
+                bucket = parts[0].strip('"')
+                key = parts[1].strip('"')
+                yield f"{BASE_URL}/{bucket}/{key}"
+
+
+def publish(urls, priority='backfill', checkpoint=None, catids=None):
+    """Publish a catalog to Cirrus for each tileInfo.json URL
+
+    Args:
+        urls (Iterator[str]): URLs of tileInfo.json files
+        priority (str, optional): Priority the catalogs are published with. Defaults to 'backfill'.
+        checkpoint (Checkpoint, optional): Skip the catalogs already fed, and update with progress. Defaults to None.
+        catids (CatalogIds, optional): Append the IDs of published catalogs to this manifest. Defaults to None.
+
+    Returns:
+        int: Number of published catalogs, including those published before resuming from the checkpoint
+    """
+    client = boto3.client('sns')
+    count = checkpoint.offset if checkpoint is not None else 0
+    for i, url in enumerate(urls):
+        if checkpoint is not None and i < checkpoint.offset:
+            continue
+        # populating catalog with bare minimum
+        key = s3().urlparse(s3().https_to_s3(url))['key']
+        id = '-'.join(op.dirname(key).split('/')[1:])
+        # TODO - determime input collection from url
+        item = {
+            'type': 'Feature',
+            'id': id,
+            'collection': 'sentinel-s2-l2a-aws',
+            'properties': {},
+            'assets': {
+                'json': {
+                    'href': url
+                }
+            }
+        }
+        catalog = {
+            'type': 'FeatureCollection',
+            'features': [item],
+            'process': PROCESS
+        }
+
+        # feed to cirrus through SNS topic
+        logger.debug(f"Published {json.dumps(catalog)}")
+        client.publish(TopicArn=SNS_TOPIC, Message=json.dumps(catalog), MessageAttributes={
+            'priority': {'DataType': 'String', 'StringValue': priority}
+        })
+        if ((i+1) % 250) == 0:
+            logger.debug(f"Published {i+1} catalogs to {SNS_TOPIC}")
+
+        count += 1
+        if catids is not None:
+            catids.append(item['id'])
+        if checkpoint is not None:
+            checkpoint.update(i + 1)
+    return count
+
+
 def handler(payload, context={}):
     logger.info('Payload: %s' % json.dumps(payload))
 
@@ -110,65 +184,52 @@ def handler(payload, context={}):
         # TODO - determine input collection from payload
         paths = [t['path'] for t in json.loads(payload['Records'][0]['Sns']['Message'])['tiles']]
         payload = {
-            'urls': [f"{BASE_URL}/sentinel-s2-l2a/{p}/tileInfo.json" for p in paths]
+            'urls': [f"{BASE_URL}/sentinel-s2-l2a/{p}/tileInfo.json" for p in paths],
+            'priority': 'realtime'
         }
+    priority = payload.pop('priority', 'backfill')
 
     # get latest inventory and spawn batch(es)
     latest_inventory = payload.get('latest_inventory', None)
     if latest_inventory is not None:
         return submit_inventory_batch_jobs(**latest_inventory)
 
-    # process inventory files (assumes this is batch!)
+    replace = payload.pop('replace', False)
+    PROCESS.update({'replace': replace})
+
+    # process inventory files (assumes this is batch!), resuming from checkpoints if the job was retried
     inventory_files = payload.get('inventory_files', None)
     if inventory_files:
-        urls = []
+        # only counts are kept, IDs of published catalogs are written to s3 if requested, under a prefix
+        # named by the batch job, so a retried job writes to the same prefix
+        prefix = None
+        if payload.get('output_catids', False):
+            job_id = batch_job_id() or f"local/{uuid.uuid1()}"
+            prefix = f"s3://{CATALOG_BUCKET}/feeds/feed-aws-sentinel/{job_id}/catids/"
+        count = 0
         for f in inventory_files:
-            filename = s3().download(f, path='/tmp')
-            with gzip.open(filename, 'rt') as f:
-                for line in f:
-                    if 'tileInfo.json' in line:
-                        parts = line.split(',')
-                        bucket = parts[0].strip('"')
-                        key = parts[1].strip('"')
-                        urls.append(f"{BASE_URL}/{bucket}/{key}")
-        logger.info(f"Extracted {len(urls)} URLs from {len(inventory_files)}")
-        payload['urls'] = urls
-
-    catids = []
+            checkpoint = Checkpoint(f)
+            if checkpoint.done:
+                logger.info(f"Skipping {f}, all {checkpoint.offset} catalogs were fed")
+                count += checkpoint.offset
+                continue
+            catids = None
+            if prefix is not None:
+                catids = CatalogIds(f"{prefix}{hashlib.md5(f.encode()).hexdigest()}", checkpoint=checkpoint)
+            with catids or contextlib.nullcontext():
+                count += publish(read_inventory_file(f), priority=priority, checkpoint=checkpoint, catids=catids)
+            checkpoint.complete()
+        clear_checkpoints()
+        logger.info(f"Published {count} catalogs from {len(inventory_files)} inventory files")
+        results = {'published': count}
+        if prefix is not None:
+            logger.info(f"Wrote manifests of catalog IDs to {prefix}")
+            results['catids'] = prefix
+        return results
+
+    count = 0
     if 'urls' in payload:
-        replace = payload.pop('replace', False)
-        PROCESS.update({'replace': replace})
-        for i, url in enumerate(payload['urls']):
-            # populating catalog with bare minimum
-            key = s3().urlparse(s3().https_to_s3(url))['key']
-            id = '-'.join(op.dirname(key).split('/')[1:])
-            # TODO - determime input collection from url
-            item = {
-                'type': 'Feature',
-                'id': id,
-                'collection': 'sentinel-s2-l2a-aws',
-                'properties': {},
-                'assets': {
-                    'json': {
-                        'href': url
-                    }
-                }
-            }
-            catalog = {
-                'type': 'FeatureCollection',
-                'features': [item],
-                'process': PROCESS
-            }
-
-            # feed to cirrus through SNS topic
-            client = boto3.client('sns')
-            logger.debug(f"Published {json.dumps(catalog)}")
-            client.publish(TopicArn=SNS_TOPIC, Message=json.dumps(catalog))
-            if ((i+1) % 250) == 0:
-                logger.debug(f"Published {i+1} catalogs to {SNS_TOPIC}")
-
-            catids.append(item['id'])
-
-        logger.info(f"Published {len(catids)} catalogs")
+        count = publish(payload['urls'], priority=priority)
+        logger.info(f"Published {count} catalogs")
 
-    return catids
+    return {'published': count}
@@ -0,0 +1 @@
+../../shared/s3_writer.py
\ No newline at end of file
@@ -26,13 +26,15 @@ statedb = StateDB()
 logger = logging.getLogger(f"{__name__}.rerun")
 
 
-def submit(ids, process_update=None):
+def submit(ids, process_update=None, priority='backfill'):
     payload = {
         "catids": ids
     }
     if process_update is not None:
         payload['process_update'] = process_update
-    SNS_CLIENT.publish(TopicArn=SNS_TOPIC, Message=json.dumps(payload))
+    SNS_CLIENT.publish(TopicArn=SNS_TOPIC, Message=json.dumps(payload), MessageAttributes={
+        'priority': {'DataType': 'String', 'StringValue': priority}
+    })
 
 
 def handler(payload, context={}):
@@ -45,6 +47,7 @@ def handler(payload, context={}):
     limit = payload.get('limit', None)
     batch = payload.get('batch', False)
     process_update = payload.get('process_update', None)
+    priority = payload.get('priority', 'backfill')
     catid_batch = 5
 
     # if this is a lambda and batch is set
@@ -61,12 +64,12 @@ def handler(payload, context={}):
     for i, item in enumerate(items):
         catids.append(item['catid'])
         if (i % catid_batch) == 0:
-            submit(catids, process_update=process_update)
+            submit(catids, process_update=process_update, priority=priority)
             catids = []
         if (i % 1000) == 0:
             logger.debug(f"Queued {i} catalogs")
     if len(catids) > 0:
-        submit(catids, process_update=process_update)
+        submit(catids, process_update=process_update, priority=priority)
 
     return {
         "found": nitems
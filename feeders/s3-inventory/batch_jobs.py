@@ -0,0 +1 @@
+../../shared/batch_jobs.py
\ No newline at end of file
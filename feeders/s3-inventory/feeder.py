@@ -1,60 +1,196 @@
 import argparse
 import boto3
+import contextlib
 import gzip
+import hashlib
+import heapq
 import itertools
 import json
 import io
 import logging
+import math
+import os
+import queue
 import re
 import requests
 import sys
+import threading
 import uuid
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
+from functools import partial
 from dateutil.parser import parse
 from os import getenv, path as op
 
 import pyorc
 from boto3utils import s3
-from cirruslib.utils import submit_batch_job
+
+from batch_jobs import Checkpoint, batch_job_id, clear_checkpoints, submit_batch_job
+from s3_writer import CatalogIds, S3Writer
 
 
 # envvars
 SNS_TOPIC = getenv('CIRRUS_QUEUE_TOPIC_ARN')
+CIRRUS_STACK = getenv('CIRRUS_STACK')
+CATALOG_BUCKET = getenv('CIRRUS_CATALOG_BUCKET')
+
+# size of the chunks CSV inventory files are streamed in, and number of chunks read ahead of parsing
+READ_CHUNK_SIZE = 1024 * 1024
+READ_AHEAD = 4
+# min size of ranged reads of ORC inventory files
+READ_BLOCK_SIZE = 8 * 1024 * 1024
+# target duration in seconds of batch jobs, and estimated bytes of inventory files fed per second per vCPU
+SHARD_DURATION = 3600
+SHARD_THROUGHPUT = 1024 * 1024
+# max number of sorted inventory files (or runs of merged files) read at once when merging an inventory
+MAX_MERGE_FILES = 32
+# max number of child jobs of a batch array job
+MAX_ARRAY_SIZE = 10000
 
 # clients
+S3_CLIENT = boto3.client('s3')
 SNS_CLIENT = boto3.client('sns')
 
 # logging
 logger = logging.getLogger(f"{__name__}.s3-inventory")
 
 
-def read_orc_inventory_file(filename, keys):
-    with open(filename, "rb") as data:
+class ReadAhead(io.RawIOBase):
+    """Stream read in a background thread, up to `depth` chunks ahead of the reader
+
+    Network reads overlap with decompressing and parsing, and memory is bounded to `depth` chunks.
+    """
+
+    def __init__(self, stream, chunk_size=READ_CHUNK_SIZE, depth=READ_AHEAD):
+        self.chunks = queue.Queue(maxsize=depth)
+        self.chunk = memoryview(b'')
+        self.eof = False
+        self.stopped = False
+        self.thread = threading.Thread(target=self._read, args=(stream, chunk_size), daemon=True)
+        self.thread.start()
+
+    def _read(self, stream, chunk_size):
+        try:
+            while not self.stopped:
+                chunk = stream.read(chunk_size)
+                self.chunks.put(chunk)
+                if not chunk:
+                    break
+        except Exception as err:
+            self.chunks.put(err)
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if len(self.chunk) == 0 and not self.eof:
+            chunk = self.chunks.get()
+            if isinstance(chunk, Exception):
+                raise chunk
+            self.eof = len(chunk) == 0
+            self.chunk = memoryview(chunk)
+        n = min(len(b), len(self.chunk))
+        b[:n] = self.chunk[:n]
+        self.chunk = self.chunk[n:]
+        return n
+
+    def close(self):
+        # unblock the reader thread if the stream is not read to the end
+        self.stopped = True
+        while not self.chunks.empty():
+            self.chunks.get_nowait()
+        super().close()
+
+
+class S3File(io.RawIOBase):
+    """Seekable file of an s3 object, read with ranged GETs of at least `block_size` bytes
+
+    The last block is kept, so that small reads (such as ORC footers) do not each make a request.
+    """
+
+    def __init__(self, url, block_size=READ_BLOCK_SIZE):
+        parts = s3.urlparse(url)
+        self.bucket, self.key = parts['bucket'], parts['key']
+        self.size = S3_CLIENT.head_object(Bucket=self.bucket, Key=self.key)['ContentLength']
+        self.block_size = block_size
+        self.block_start, self.block = 0, b''
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self.position = max(0, offset)
+        return self.position
+
+    def readinto(self, b):
+        if self.position >= self.size:
+            return 0
+        if not self.block_start <= self.position < self.block_start + len(self.block):
+            end = min(self.size, self.position + max(len(b), self.block_size)) - 1
+            resp = S3_CLIENT.get_object(Bucket=self.bucket, Key=self.key, Range=f"bytes={self.position}-{end}")
+            self.block_start, self.block = self.position, resp['Body'].read()
+        offset = self.position - self.block_start
+        n = min(len(b), len(self.block) - offset)
+        b[:n] = self.block[offset:offset + n]
+        self.position += n
+        return n
+
+
+def catids_prefix():
+    """Get the s3 prefix of the manifests of published catalog IDs
+
+    In a batch job it is named by the job ID and array index, so a retried job writes to the same prefix,
+    otherwise a new prefix is used.
+    """
+    job_id = batch_job_id() or f"local/{uuid.uuid1()}"
+    return f"s3://{CATALOG_BUCKET}/feeds/feed-s3-inventory/{job_id}/catids/"
+
+
+def catalog_ids(prefix, name, checkpoint=None):
+    """Open a manifest of published catalog IDs under a prefix, or a context without one if prefix is None"""
+    if prefix is None:
+        return contextlib.nullcontext()
+    return CatalogIds(f"{prefix}{hashlib.md5(name.encode()).hexdigest()}", checkpoint=checkpoint)
+
+
+def read_orc_inventory_file(url, keys):
+    with S3File(url) as data:
         reader = pyorc.Reader(data)
         for row in reader:
             record = {keys[i].lower(): v for i, v in enumerate(row)}
             yield record
 
 
-def read_csv_inventory_file(filename, keys):
-    gz = gzip.open(filename, 'rb')
-    for line in io.BufferedReader(gz):
-        l = line.decode('utf-8').replace('"', '').replace('\n', '')
-        record = {keys[i].lower(): v for i, v in enumerate(l.split(','))}
-        yield record
-    gz.close()
+def read_csv_inventory_file(url, keys):
+    parts = s3.urlparse(url)
+    body = S3_CLIENT.get_object(Bucket=parts['bucket'], Key=parts['key'])['Body']
+    with gzip.GzipFile(fileobj=io.BufferedReader(ReadAhead(body), buffer_size=READ_CHUNK_SIZE)) as gz:
+        for line in gz:
+            l = line.decode('utf-8').replace('"', '').replace('\n', '')
+            record = {keys[i].lower(): v for i, v in enumerate(l.split(','))}
+            yield record
 
 
-def read_inventory_file(fname, keys, prefix=None, suffix=None,
+def read_inventory_file(url, keys, prefix=None, suffix=None,
                         start_date=None, end_date=None,
                         datetime_regex=None, datetime_key='LastModifiedDate'):
-    logger.debug('Reading inventory file %s' % (fname))
-    filename = s3().download(fname, path='/tmp')
-    ext = op.splitext(fname)[-1]
+    logger.debug('Reading inventory file %s' % (url))
+    ext = op.splitext(url)[-1]
     if ext == ".gz":
-        records = read_csv_inventory_file(filename, keys)
+        records = read_csv_inventory_file(url, keys)
     elif ext == ".orc":
-        records = read_orc_inventory_file(filename, keys)
+        records = read_orc_inventory_file(url, keys)
 
     if datetime_regex is not None:
         regex = re.compile(datetime_regex)
@@ -64,11 +200,14 @@ def read_inventory_file(fname, keys, prefix=None, suffix=None,
     sdate = parse(start_date).date() if start_date else None
     edate = parse(end_date).date() if end_date else None
 
+    # inventory fields are lower case
+    datetime_key = datetime_key.lower()
+
     def get_datetime(record):
         if regex is not None:
             m = regex.match(record['key']).groupdict()
             dt = datetime(int(m['Y']), int(m['m']), int(m['d']))
-        elif isinstance(record[datetime_key], datetime.datetime):
+        elif isinstance(record[datetime_key], datetime):
             dt = record[datetime_key]
         else:
             dt = datetime.strptime(record[datetime_key], "%Y-%m-%dT%H:%M:%S.%fZ")
@@ -95,13 +234,636 @@ def read_inventory_file(fname, keys, prefix=None, suffix=None,
         yield 's3://%s/%s' % (record['bucket'], record['key'])
 
 
+def read_inventory_batches(url, keys, columns):
+    """Read some columns of an inventory file, in batches of rows
+
+    Args:
+        url (str): s3 URL of a gzipped CSV or ORC inventory file
+        keys (List[str]): Fields of the inventory
+        columns (List[str]): Fields to read, lower case
+
+    Yields:
+        pyarrow.RecordBatch: Batch of rows with the columns, CSV values are strings
+    """
+    import pyarrow as pa
+    from pyarrow import csv, orc
+
+    keys = [k.lower() for k in keys]
+    ext = op.splitext(url)[-1]
+    if ext == ".gz":
+        parts = s3.urlparse(url)
+        body = S3_CLIENT.get_object(Bucket=parts['bucket'], Key=parts['key'])['Body']
+        stream = pa.input_stream(io.BufferedReader(ReadAhead(body), buffer_size=READ_CHUNK_SIZE), compression='gzip')
+        reader = csv.open_csv(stream, read_options=csv.ReadOptions(column_names=keys, block_size=READ_CHUNK_SIZE),
+                              convert_options=csv.ConvertOptions(include_columns=columns,
+                                                                 column_types={c: pa.string() for c in columns}))
+        for batch in reader:
+            yield batch
+    elif ext == ".orc":
+        with S3File(url) as f:
+            reader = orc.ORCFile(f)
+            # field names in the file may differ from the inventory schema
+            fields = [reader.schema.names[keys.index(c)] for c in columns]
+            for i in range(reader.nstripes):
+                # stripe columns are in the order of the file
+                stripe = reader.read_stripe(i, columns=fields)
+                yield pa.RecordBatch.from_arrays([stripe.column(stripe.schema.get_field_index(f)) for f in fields],
+                                                 names=columns)
+
+
+def read_inventory_filtered(url, keys, columns, prefix=None, suffix=None,
+                            start_date=None, end_date=None,
+                            datetime_regex=None, datetime_key='LastModifiedDate'):
+    """Read some columns of the matching keys of an inventory file, filtering batches of rows with vectorized masks
+
+    Filters are the same as read_inventory_file, except that keys not matching `datetime_regex` are skipped.
+
+    Args:
+        url (str): s3 URL of a gzipped CSV or ORC inventory file
+        keys (List[str]): Fields of the inventory
+        columns (List[str]): Fields to read, lower case
+        prefix (str, optional): Only keys starting with this prefix. Defaults to None.
+        suffix (str, optional): Only keys ending with this suffix. Defaults to None.
+        start_date (str, optional): Only keys of this date or later. Defaults to None.
+        end_date (str, optional): Only keys of this date or earlier. Defaults to None.
+        datetime_regex (str, optional): Regex with Y, m and d groups to get the date from the key.
+            Defaults to None, to use the `datetime_key` field.
+        datetime_key (str, optional): Date field. Defaults to 'LastModifiedDate'.
+
+    Yields:
+        pyarrow.RecordBatch: Matching rows of a batch, with the columns
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    logger.debug('Reading inventory file %s' % (url))
+    sdate = parse(start_date).date() if start_date else None
+    edate = parse(end_date).date() if end_date else None
+    filter_dates = sdate is not None or edate is not None
+    datetime_key = datetime_key.lower()
+
+    read_columns = list(columns) + [c for c in ['key'] if c not in columns]
+    if filter_dates and datetime_regex is None and datetime_key not in read_columns:
+        read_columns.append(datetime_key)
+
+    def get_dates(batch):
+        if datetime_regex is not None:
+            parts = pc.extract_regex(batch.column('key'), datetime_regex)
+            dates = pc.binary_join_element_wise(parts.field('Y'), parts.field('m'), parts.field('d'), '-')
+            return pc.cast(pc.strptime(dates, format='%Y-%m-%d', unit='s', error_is_null=True), pa.date32())
+        dates = batch.column(datetime_key)
+        if pa.types.is_string(dates.type):
+            dates = pc.strptime(pc.utf8_slice_codeunits(dates, 0, 10), format='%Y-%m-%d', unit='s',
+                                error_is_null=True)
+        return pc.cast(dates, pa.date32())
+
+    for batch in read_inventory_batches(url, keys, read_columns):
+        masks = []
+        if prefix is not None:
+            masks.append(pc.starts_with(batch.column('key'), prefix))
+        if suffix is not None:
+            masks.append(pc.ends_with(batch.column('key'), suffix))
+        if filter_dates:
+            dates = get_dates(batch)
+            if sdate is not None:
+                masks.append(pc.greater_equal(dates, pa.scalar(sdate, pa.date32())))
+            if edate is not None:
+                masks.append(pc.less_equal(dates, pa.scalar(edate, pa.date32())))
+        if len(masks) > 0:
+            mask = masks[0]
+            for m in masks[1:]:
+                mask = pc.and_(mask, m)
+            batch = batch.filter(mask)
+        if batch.num_rows > 0:
+            yield batch
+
+
+def read_inventory_file_columnar(url, keys, **kwargs):
+    """Read matching s3 URLs of an inventory file, filtering batches of rows with vectorized masks
+
+    Only the bucket, key, and (if filtering on dates without a regex) date columns are read.
+
+    Args:
+        url (str): s3 URL of a gzipped CSV or ORC inventory file
+        keys (List[str]): Fields of the inventory
+        **kwargs: Filters passed to read_inventory_filtered
+
+    Yields:
+        List[str]: s3 URLs of the matching keys of a batch of rows
+    """
+    for batch in read_inventory_filtered(url, keys, ['bucket', 'key'], **kwargs):
+        yield [f"s3://{b}/{k}" for b, k in zip(batch.column('bucket').to_pylist(), batch.column('key').to_pylist())]
+
+
+def inventory_field(keys, name):
+    """Get the lower case name of an inventory field, which is `ETag` in CSV schemas and `e_tag` in ORC schemas
+
+    Args:
+        keys (List[str]): Fields of the inventory
+        name (str): Field name, such as 'ETag'
+
+    Returns:
+        str: Lower case field name in the inventory, None if it is not in the inventory
+    """
+    for key in keys:
+        if key.lower().replace('_', '') == name.lower():
+            return key.lower()
+    return None
+
+
+def read_inventory_entries(url, keys, **kwargs):
+    """Read the key, size, ETag and bucket of the matching keys of an inventory file, in key order
+
+    Inventory files are sorted by key, the order is checked as the file is read. The size and ETag
+    are strings (None if not in the inventory), so that CSV and ORC inventories compare the same.
+
+    Args:
+        url (str): s3 URL of a gzipped CSV or ORC inventory file
+        keys (List[str]): Fields of the inventory
+        **kwargs: Filters passed to read_inventory_filtered
+
+    Yields:
+        Tuple[str, str, str, str]: Key, size, ETag and bucket
+
+    Raises:
+        ValueError: If the inventory file is not sorted by key
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    fields = [inventory_field(keys, 'Size'), inventory_field(keys, 'ETag')]
+    columns = ['key'] + [f for f in fields if f is not None] + ['bucket']
+    last = None
+    for batch in read_inventory_filtered(url, keys, columns, **kwargs):
+        values = [pc.cast(batch.column(f), pa.string()).to_pylist() if f is not None else [None] * batch.num_rows
+                  for f in fields]
+        for entry in zip(batch.column('key').to_pylist(), *values, batch.column('bucket').to_pylist()):
+            if last is not None and entry[0] < last:
+                raise ValueError(f"Inventory file {url} is not sorted by key ({entry[0]} after {last})")
+            last = entry[0]
+            yield entry
+
+
+def diff_inventory(current, previous):
+    """Get the keys of directories with added or modified keys, by a merge join with the previous inventory
+
+    Each directory is fed as one Item with all its keys as assets, so every key of a directory with an
+    added or modified key is returned, not only the changed keys.
+
+    Args:
+        current (Iterator[Tuple]): Key, size, ETag and bucket of each key of the inventory, in key order
+        previous (Iterator[Tuple]): Key, size, ETag and bucket of each key of the previous inventory, in key order
+
+    Yields:
+        Tuple: Entries of the current inventory in directories with a key not in the previous inventory,
+            or with a different size or ETag
+    """
+    previous = iter(previous)
+    prev = next(previous, None)
+    for _, group in itertools.groupby(current, key=lambda e: op.dirname(e[0])):
+        group = list(group)
+        changed = False
+        for entry in group:
+            while prev is not None and prev[0] < entry[0]:
+                prev = next(previous, None)
+            if prev is None or prev[:3] != entry[:3]:
+                changed = True
+        if changed:
+            yield from group
+
+
+def merge_run_url(name, level, index):
+    """Get the s3 URL of a run of merged inventory files, under the batch job ID if in a batch job"""
+    job_id = getenv('AWS_BATCH_JOB_ID', 'local')
+    return f"s3://{CATALOG_BUCKET}/feeds/feed-s3-inventory/{job_id}/merge/{name}/{level}-{index}.ndjson.gz"
+
+
+def write_run(entries, url):
+    """Write sorted inventory entries to a run on s3, as gzipped newline delimited JSON"""
+    with S3Writer(url, ContentType='application/gzip') as f, gzip.GzipFile(fileobj=f, mode='wb') as gz:
+        for entry in entries:
+            gz.write((json.dumps(entry) + '\n').encode())
+
+
+def read_run(url):
+    """Read the inventory entries of a run, and delete it once read"""
+    parts = s3.urlparse(url)
+    body = S3_CLIENT.get_object(Bucket=parts['bucket'], Key=parts['key'])['Body']
+    with gzip.GzipFile(fileobj=io.BufferedReader(ReadAhead(body), buffer_size=READ_CHUNK_SIZE)) as gz:
+        for line in gz:
+            yield tuple(json.loads(line))
+    S3_CLIENT.delete_object(Bucket=parts['bucket'], Key=parts['key'])
+
+
+def merge_inventory(urls, read, name, max_files=None):
+    """Merge sorted inventory files into one stream sorted by key, reading at most `max_files` files at once
+
+    With more files, groups of `max_files` files are merged into sorted runs written to s3, in passes
+    until there are at most `max_files` runs, which are then merged.
+
+    Args:
+        urls (List[str]): s3 URLs of the inventory files
+        read (Callable): Function reading the entries of an inventory file URL, in key order
+        name (str): Name of the runs of the merge, unique in the batch job
+        max_files (int, optional): Max number of files or runs read at once, at least 2. Defaults to MAX_MERGE_FILES.
+
+    Returns:
+        Iterator[Tuple]: Entries of all files, in key order
+    """
+    # a merge of less than two runs would not reduce their number
+    max_files = max(2, max_files or MAX_MERGE_FILES)
+    readers = [partial(read, url) for url in urls]
+    level = 0
+    while len(readers) > max_files:
+        logger.info(f"Merging {len(readers)} sorted runs of {name} into runs of {max_files}")
+        runs = []
+        for i in range(0, len(readers), max_files):
+            url = merge_run_url(name, level, len(runs))
+            write_run(heapq.merge(*[r() for r in readers[i:i + max_files]], key=lambda e: e[0]), url)
+            runs.append(partial(read_run, url))
+        readers = runs
+        level += 1
+    return heapq.merge(*[r() for r in readers], key=lambda e: e[0])
+
+
+def read_inventory_diff(inventory_files, keys, previous_inventory_files, previous_keys, **kwargs):
+    """Read s3 URLs of the keys of directories with keys added or modified since a previous inventory
+
+    Each inventory file is sorted by key, so the files of each inventory are merged into one sorted
+    stream, and the two streams joined, reading one batch of rows of each file at a time. At most
+    MAX_MERGE_FILES files of each inventory are read at once, see `merge_inventory`.
+
+    Args:
+        inventory_files (List[str]): s3 URLs of the inventory files
+        keys (List[str]): Fields of the inventory
+        previous_inventory_files (List[str]): s3 URLs of the previous inventory files
+        previous_keys (List[str]): Fields of the previous inventory
+        **kwargs: Filters of the keys of the inventory, passed to read_inventory_filtered
+
+    Yields:
+        str: s3 URL of a key in a directory with an added or modified key
+    """
+    previous = merge_inventory(previous_inventory_files, partial(read_inventory_entries, keys=previous_keys),
+                               'previous')
+    current = merge_inventory(inventory_files, partial(read_inventory_entries, keys=keys, **kwargs), 'current')
+    for key, _, _, bucket in diff_inventory(current, previous):
+        yield f"s3://{bucket}/{key}"
+
+
+def plan_shards(files, shard_size, max_files=None):
+    """Group files into shards of about the same total size
+
+    The number of shards is the total size over `shard_size`, and files are assigned largest first to
+    the smallest shard, so shards differ by at most the size of a file.
+
+    Args:
+        files (List[Tuple[str, int]]): URL and size in bytes of each file
+        shard_size (int): Target size of a shard in bytes
+        max_files (int, optional): Max number of files in a shard. Defaults to None.
+
+    Returns:
+        List[List[str]]: URLs of the files of each shard, largest shard first
+    """
+    if len(files) == 0:
+        return []
+    nshards = math.ceil(sum(size for _, size in files) / shard_size)
+    if max_files:
+        nshards = max(nshards, math.ceil(len(files) / max_files))
+    nshards = max(1, min(nshards, len(files)))
+
+    # (total size, shard index) of shards that are not full
+    heap = [(0, i) for i in range(nshards)]
+    shards = [[] for i in range(nshards)]
+    sizes = [0] * nshards
+    for url, size in sorted(files, key=lambda f: -f[1]):
+        _, i = heapq.heappop(heap)
+        shards[i].append(url)
+        sizes[i] += size
+        if not max_files or len(shards[i]) < max_files:
+            heapq.heappush(heap, (sizes[i], i))
+    return [shards[i] for i in sorted(range(nshards), key=lambda i: -sizes[i])]
+
+
+def init_worker():
+    """Create clients of an inventory file worker process, clients can not be shared with the parent"""
+    global S3_CLIENT, SNS_CLIENT
+    S3_CLIENT = boto3.client('s3')
+    SNS_CLIENT = boto3.client('sns')
+
+
+def asset_keys(keys):
+    """Get the asset keys of the files of a directory
+
+    The key of an asset is the extension of the file (without the .), or if other files have the same
+    extension, the file name without the extension, and without the directory name if it starts with it.
+
+    Args:
+        keys (List[str]): s3 keys of the files of a directory
+
+    Returns:
+        List[str]: Asset key of each file
+    """
+    exts = [op.splitext(key)[-1].lstrip('.') for key in keys]
+    dirname = op.basename(op.dirname(keys[0]))
+    asset_keys = []
+    for key, ext in zip(keys, exts):
+        if exts.count(ext) == 1:
+            asset_keys.append(ext)
+            continue
+        name = op.splitext(op.basename(key))[0]
+        if dirname and name.startswith(dirname) and name != dirname:
+            name = name[len(dirname):].lstrip('_-.')
+        asset_keys.append(name)
+    return asset_keys
+
+
+def feed_urls(urls, process, base_url=None, priority='backfill', checkpoint=None, catids=None):
+    """Publish a catalog to Cirrus for every directory of s3 URLs
+
+    Consecutive URLs in the same directory are assets of one Item, with the directory as ID. Inventories
+    are sorted by key, so all files of a directory are consecutive.
+
+    Args:
+        urls (Iterator[str]): s3 URLs of the assets
+        process (Dict): Process definition of the catalogs
+        base_url (str, optional): Use asset hrefs under this URL rather than s3 URLs. Defaults to None.
+        priority (str, optional): Priority the catalogs are published with. Defaults to 'backfill'.
+        checkpoint (Checkpoint, optional): Skip the catalogs already fed, and update with progress. Defaults to None.
+        catids (CatalogIds, optional): Append the IDs of published catalogs to this manifest. Defaults to None.
+
+    Returns:
+        int: Number of published catalogs, including those published before resuming from the checkpoint
+    """
+    count = checkpoint.offset if checkpoint is not None else 0
+    for i, (dirname, group) in enumerate(itertools.groupby(urls, key=op.dirname)):
+        if checkpoint is not None and i < checkpoint.offset:
+            continue
+        group = list(group)
+        parts = [s3.urlparse(url) for url in group]
+        id = '-'.join(op.dirname(parts[0]['key']).split('/'))
+
+        assets = {}
+        for key, url, p in zip(asset_keys([p['key'] for p in parts]), group, parts):
+            if base_url is not None and url.startswith('s3://'):
+                url = f"{base_url}/{p['bucket']}/{p['key']}"
+            assets[key] = {'href': url}
+
+        # TODO - determime input collection from url
+        item = {
+            'type': 'Feature',
+            'id': id,
+            'collection': process['input_collections'][0],
+            'properties': {},
+            'assets': assets
+        }
+        catalog = {
+            'type': 'FeatureCollection',
+            'features': [item],
+            'process': process
+        }
+
+        # feed to cirrus through SNS topic
+        SNS_CLIENT.publish(TopicArn=SNS_TOPIC, Message=json.dumps(catalog), MessageAttributes={
+            'priority': {'DataType': 'String', 'StringValue': priority}
+        })
+        if (count % 1000) == 0:
+            logger.debug(f"Published {count} catalogs to {SNS_TOPIC}: {json.dumps(catalog)}")
+
+        count += 1
+        if catids is not None:
+            catids.append(item['id'])
+        if checkpoint is not None:
+            checkpoint.update(i + 1)
+    return count
+
+
+def inner_urls(urls, edges):
+    """Yield the URLs of all but the first and last directories of an inventory file
+
+    The first and last directories may continue in other inventory files, so their URLs are appended
+    to `edges` instead, to be merged with those of the other files.
+
+    Args:
+        urls (Iterator[str]): s3 URLs of the inventory file, sorted by key
+        edges (List[List[str]]): URLs of the first and last directories are appended to this list
+
+    Yields:
+        str: s3 URLs of the other directories
+    """
+    groups = itertools.groupby(urls, key=op.dirname)
+    first = next(groups, None)
+    if first is None:
+        return
+    edges.append(list(first[1]))
+    last = None
+    for _, group in groups:
+        if last is not None:
+            yield from last
+        last = list(group)
+    if last is not None:
+        edges.append(last)
+
+
+def feed_inventory_file(inventory_file, keys, process, base_url=None, priority='backfill', columnar=True,
+                        catids_prefix=None, **kwargs):
+    """Publish a catalog to Cirrus for every directory of matching keys of an inventory file
+
+    The first and last directories are not published, but returned to be merged with the directories
+    of other files, see `feed_edges`. In a batch job, progress is checkpointed, and a retried job
+    resumes from the checkpoint.
+
+    Args:
+        inventory_file (str): s3 URL of the inventory file
+        keys (List[str]): Fields of the inventory
+        process (Dict): Process definition of the catalogs
+        base_url (str, optional): Use asset hrefs under this URL rather than s3 URLs. Defaults to None.
+        priority (str, optional): Priority the catalogs are published with. Defaults to 'backfill'.
+        columnar (bool, optional): Filter with the columnar reader, rather than row by row. Defaults to True.
+        catids_prefix (str, optional): Write the IDs of the published catalogs to a manifest of the file
+            under this s3 prefix. Defaults to None.
+        **kwargs: Filters passed to read_inventory_file_columnar or read_inventory_file
+
+    Returns:
+        Tuple[int, List[List[str]]]: Number of published catalogs, and URLs of the first and last directories
+    """
+    checkpoint = Checkpoint(inventory_file)
+    if checkpoint.done:
+        logger.info(f"Skipping {inventory_file}, all {checkpoint.offset} catalogs were fed")
+        return checkpoint.offset, checkpoint.result or []
+
+    if columnar:
+        urls = (url for chunk in read_inventory_file_columnar(inventory_file, keys, **kwargs) for url in chunk)
+    else:
+        urls = read_inventory_file(inventory_file, keys, **kwargs)
+
+    edges = []
+    with catalog_ids(catids_prefix, inventory_file, checkpoint=checkpoint) as catids:
+        count = feed_urls(inner_urls(urls, edges), process, base_url=base_url, priority=priority,
+                          checkpoint=checkpoint, catids=catids)
+    checkpoint.complete(edges)
+    logger.info(f"Published {count} catalogs from {inventory_file}")
+    return count, edges
+
+
+def feed_inventory_files(inventory_files, workers, **kwargs):
+    """Publish catalogs for all inventory files, streaming and parsing files in a pool of worker processes
+
+    Each worker writes the manifest of the catalog IDs of its files itself, and only returns counts and
+    the URLs of the first and last directories of each file.
+
+    Args:
+        inventory_files (List[str]): s3 URLs of inventory files
+        workers (int): Number of worker processes
+        **kwargs: Passed to feed_inventory_file
+
+    Returns:
+        Tuple[int, List[str]]: Number of published catalogs, and URLs of the directories not published
+    """
+    feed = partial(feed_inventory_file, **kwargs)
+    count, edges = 0, []
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as parsers:
+        for n, groups in parsers.map(feed, inventory_files):
+            count += n
+            edges.extend(url for group in groups for url in group)
+    return count, edges
+
+
+def feed_edges(urls, process, base_url=None, priority='backfill', catids_prefix=None):
+    """Publish a catalog for every directory of the first and last directories of inventory files
+
+    A directory split across inventory files is published once, with the assets of all files.
+
+    Args:
+        urls (List[str]): s3 URLs of the first and last directories of inventory files
+        process (Dict): Process definition of the catalogs
+        base_url (str, optional): Use asset hrefs under this URL rather than s3 URLs. Defaults to None.
+        priority (str, optional): Priority the catalogs are published with. Defaults to 'backfill'.
+        catids_prefix (str, optional): Write the IDs of the published catalogs to a manifest under this
+            s3 prefix. Defaults to None.
+
+    Returns:
+        int: Number of published catalogs
+    """
+    # keys of a directory are not all consecutive when sorted by key, such as a/b/1, a/b/1/x and a/b/2
+    urls = sorted(set(urls), key=lambda url: (op.dirname(url), url))
+    checkpoint = Checkpoint('edges')
+    with catalog_ids(catids_prefix, 'edges', checkpoint=checkpoint) as catids:
+        count = feed_urls(iter(urls), process, base_url=base_url, priority=priority, checkpoint=checkpoint,
+                          catids=catids)
+    logger.info(f"Published {count} catalogs of directories at the start or end of inventory files")
+    return count
+
+
+def edges_url(job_id, index=None):
+    """Get the s3 URL the directories at the edges of a shard of an array job are saved to, or their prefix"""
+    url = f"s3://{CATALOG_BUCKET}/feeds/feed-s3-inventory/{job_id}/edges/"
+    if index is not None:
+        url += f"{index}.json"
+    return url
+
+
+def feed_results(count, catids_prefix=None):
+    """Get the result of feeding inventory files: the number of published catalogs, and the prefix of their IDs"""
+    results = {'published': count}
+    if catids_prefix is not None:
+        logger.info(f"Wrote manifests of catalog IDs to {catids_prefix}")
+        results['catids'] = catids_prefix
+    return results
+
+
+def manifest_keys(manifest):
+    """Get the fields of an inventory from its manifest
+
+    Args:
+        manifest (Dict): Inventory manifest
+
+    Returns:
+        List[str]: Fields of the inventory
+    """
+    schema = manifest['fileSchema']
+    if schema.startswith('struct'):
+        return [str(key).strip().split(':')[0] for key in schema[7:-1].split(',')]
+    return [str(key).strip() for key in schema.split(',')]
+
+
+def manifest_state_url(inventory_url):
+    """Get the URL the manifest of the last inventory processed incrementally is saved to"""
+    parts = s3.urlparse(inventory_url)
+    return f"s3://{CATALOG_BUCKET}/inventory/{parts['bucket']}/{parts['key'].strip('/')}/manifest.json"
+
+
+def submit_incremental(inventory_url, manifest, process, payload, context, previous_manifest_url=None,
+                       **job):
+    """Submit a batch job feeding the keys added or modified since the previously processed inventory
+
+    Args:
+        inventory_url (str): s3 URL of the inventory
+        manifest (Dict): Manifest of the latest inventory
+        process (Dict): Process definition of the catalogs
+        payload (Dict): Remaining payload variables (filters and feed options)
+        context (LambdaContext): Context of the Lambda, the job runs its function
+        previous_manifest_url (str, optional): URL of the manifest to diff against. Defaults to None,
+            to use the manifest of the last inventory processed incrementally.
+        **job: Options of the job passed to `submit_batch_job` (queue, definition, vcpus, memory)
+
+    Returns:
+        int: Number of batch jobs submitted
+    """
+    s3session = s3()
+    inventory_bucket = s3session.urlparse(inventory_url)['bucket']
+    state_url = manifest_state_url(inventory_url)
+    if previous_manifest_url is None and s3session.exists(state_url):
+        previous_manifest_url = state_url
+    if previous_manifest_url is not None:
+        previous = s3session.read_json(previous_manifest_url)
+    else:
+        logger.warning(f"No previously processed inventory of {inventory_url}, feeding all keys")
+        previous = {'fileSchema': manifest['fileSchema'], 'files': []}
+
+    if previous.get('creationTimestamp') == manifest.get('creationTimestamp'):
+        logger.info(f"Latest inventory of {inventory_url} was already processed")
+        return 0
+
+    batch_payload = {
+        'inventory_files': [f"s3://{inventory_bucket}/{f['key']}" for f in manifest['files']],
+        'keys': manifest_keys(manifest),
+        'previous_inventory_files': [f"s3://{inventory_bucket}/{f['key']}" for f in previous['files']],
+        'previous_keys': manifest_keys(previous),
+        'manifest': manifest,
+        'manifest_url': state_url,
+        'process': process
+    }
+    batch_payload.update(payload)
+    logger.info(f"Diffing {len(batch_payload['inventory_files'])} inventory files with "
+                f"{len(batch_payload['previous_inventory_files'])} previous inventory files")
+    submit_batch_job(batch_payload, context.invoked_function_arn, name='feed-s3-inventory', **job)
+    return 1
+
+
 def handler(payload, context={}):
     logger.info('Payload: %s' % json.dumps(payload))
 
     # get payload variables
     inventory_url = payload.pop('inventory_url', None)
-    batch_size = payload.pop('batch_size', 10)
+    # max number of inventory files per batch job
+    batch_size = payload.pop('batch_size', None)
     max_batches = payload.pop('max_batches', -1)
+    # vCPUs and memory (MB) of batch jobs, inventory files are parsed by one process per vCPU
+    vcpus = payload.pop('vcpus', 4)
+    memory = payload.pop('memory', 2048)
+    # job queue and definition of batch jobs, without the stack prefix
+    job = {
+        'queue': payload.pop('job_queue', 'basic-ondemand'),
+        'definition': payload.pop('job_definition', 'lambda-as-batch'),
+        'vcpus': vcpus,
+        'memory': memory
+    }
+    # target duration (seconds) of batch jobs, and estimated throughput (bytes/sec per vCPU) to size them
+    shard_duration = payload.pop('shard_duration', SHARD_DURATION)
+    throughput = payload.pop('throughput', SHARD_THROUGHPUT)
+    # only feed keys added or modified since the last inventory processed, or the given manifest
+    incremental = payload.pop('incremental', False)
+    previous_manifest_url = payload.pop('previous_manifest', None)
     # required payload variable
     process = payload.pop('process')
 
@@ -112,94 +874,100 @@ def handler(payload, context={}):
         inventory_bucket = s3session.urlparse(inventory_url)['bucket']
         # get manifest and schema
         manifest = s3session.latest_inventory_manifest(inventory_url)
-        schema = manifest['fileSchema']
-        if schema.startswith('struct'):
-            keys = [str(key).strip().split(':')[0] for key in schema[7:-1].split(',')]
-        else:
-            keys = [str(key).strip() for key in schema.split(',')]
+        keys = manifest_keys(manifest)
+
+        if incremental:
+            return submit_incremental(inventory_url, manifest, process, payload, context,
+                                      previous_manifest_url=previous_manifest_url, **job)
 
-        # get list of inventory files
+        # get list of inventory files, and group them into shards of about the same size
         files = manifest.get('files')
         logger.info('Getting latest inventory (%s files) from %s' % (len(files), inventory_url))
-
-        submitted_urls = []
-        njobs = 0
-        for f in files:
-            url = f"s3://{inventory_bucket}/{f['key']}"
-            submitted_urls.append(url)
-            if (len(submitted_urls) % batch_size) == 0:
-                batch_payload = {
-                    'inventory_files': submitted_urls,
-                    'keys': keys,
-                    'process': process
-                }
-                batch_payload.update(payload)
-                submit_batch_job(batch_payload, context.invoked_function_arn, definition='lambda-as-batch', name='feed-s3-inventory')
-                submitted_urls = []
-                njobs += 1
-                # stop if max batches reached (used for testing)
-                if max_batches > 0 and njobs >= max_batches:
-                    break
-        if len(submitted_urls) > 0:
-            batch_payload = {
-                'inventory_files': submitted_urls,
-                'keys': keys,
-                'process': process
-            }
-            batch_payload.update(payload)
-            submit_batch_job(batch_payload, context.invoked_function_arn, definition='lambda-as-batch', name='feed-s3-inventory')
-            njobs += 1
-        logger.info(f"Submitted {njobs} batch jobs")
-        return njobs
+        files = [(f"s3://{inventory_bucket}/{f['key']}", f.get('size', 1)) for f in files]
+        # larger shards than the target if there would be more than an array job can run
+        shard_size = max(shard_duration * throughput * vcpus, math.ceil(sum(f[1] for f in files) / MAX_ARRAY_SIZE))
+        if batch_size:
+            batch_size = max(batch_size, math.ceil(len(files) / MAX_ARRAY_SIZE))
+        shards = plan_shards(files, shard_size, max_files=batch_size)
+        # stop if max batches reached (used for testing)
+        if max_batches > 0:
+            shards = shards[:max_batches]
+        if len(shards) == 0:
+            return 0
+
+        # one array job, each child job feeds the shard of its array index
+        batch_payload = {
+            'shards': shards,
+            'keys': keys,
+            'process': process,
+            'workers': vcpus
+        }
+        batch_payload.update(payload)
+        array_size = len(shards) if len(shards) > 1 else None
+        job_id = submit_batch_job(batch_payload, context.invoked_function_arn, name='feed-s3-inventory',
+                                  array_size=array_size, **job)
+        if array_size is not None:
+            # then one job feeding the directories split across inventory files of different shards
+            edges_payload = {'edges': edges_url(job_id), 'process': process}
+            edges_payload.update(payload)
+            submit_batch_job(edges_payload, context.invoked_function_arn, name='feed-s3-inventory-edges',
+                             depends_on=[job_id], **job)
+        logger.info(f"Submitted {len(shards)} batch jobs, of {len(shards[-1])} to {len(shards[0])} inventory files")
+        return len(shards)
 
     # process inventory files (assumes this is batch!)
     inventory_files = payload.pop('inventory_files', None)
+    shards = payload.pop('shards', None)
+    if shards is not None:
+        inventory_files = shards[int(os.getenv('AWS_BATCH_JOB_ARRAY_INDEX', 0))]
     keys = payload.pop('keys', None)
-    base_url = payload.pop('base_url', None)
+    workers = payload.pop('workers', None) or os.cpu_count()
+    # write the IDs of published catalogs to a manifest on s3, only counts are returned otherwise
+    prefix = catids_prefix() if payload.pop('output_catids', False) else None
+
+    # feed the directories at the edges of the inventory files of all shards of an array job
+    edges = payload.pop('edges', None)
+    if edges is not None:
+        feed_options = {k: payload.pop(k) for k in ['base_url', 'priority'] if k in payload}
+        urls = [url for edges_file in s3session.find(edges) for url in s3session.read_json(edges_file)]
+        count = feed_edges(urls, process, catids_prefix=prefix, **feed_options)
+        clear_checkpoints()
+        return feed_results(count, prefix)
+
+    # diff with the previous inventory, and save the manifest once all changes are fed
+    if 'previous_inventory_files' in payload:
+        previous_inventory_files = payload.pop('previous_inventory_files')
+        previous_keys = payload.pop('previous_keys')
+        manifest = payload.pop('manifest', None)
+        manifest_url = payload.pop('manifest_url', None)
+        feed_options = {k: payload.pop(k) for k in ['base_url', 'priority'] if k in payload}
+        payload.pop('columnar', None)
+        urls = read_inventory_diff(inventory_files, keys, previous_inventory_files, previous_keys, **payload)
+        checkpoint = Checkpoint('diff')
+        with catalog_ids(prefix, 'diff', checkpoint=checkpoint) as catids:
+            count = feed_urls(urls, process, checkpoint=checkpoint, catids=catids, **feed_options)
+        logger.info(f"Published {count} catalogs of keys added or modified since the previous inventory")
+        if manifest is not None and manifest_url is not None:
+            s3session.upload_json(manifest, manifest_url)
+        clear_checkpoints()
+        return feed_results(count, prefix)
 
     # these are all required
-    catids = []
     if inventory_files and keys and process:
         # filter filenames
-        logger.info(f"Parsing {len(inventory_files)} inventory files")
-        for f in inventory_files:
-            for url in read_inventory_file(f, keys, **payload):
-                parts = s3session.urlparse(url)
-                id = '-'.join(op.dirname(parts['key']).split('/'))
-
-                # use extension without . for asset key
-                ext = op.splitext(parts['key'])[-1].lstrip('.')
-
-                if base_url is not None and url.startswith('s3://'):
-                    url = f"{base_url}/{parts['bucket']}/{parts['key']}"
-
-                # TODO - determime input collection from url
-                item = {
-                    'type': 'Feature',
-                    'id': id,
-                    'collection': process['input_collections'][0],
-                    'properties': {},
-                    'assets': {
-                        ext: {
-                            'href': url
-                        }
-                    }
-                }
-                catalog = {
-                    'type': 'FeatureCollection',
-                    'features': [item],
-                    'process': process
-                }
-
-                # feed to cirrus through SNS topic
-                SNS_CLIENT.publish(TopicArn=SNS_TOPIC, Message=json.dumps(catalog))
-                if (len(catids) % 1000) == 0:
-                    logger.debug(f"Published {len(catids)} catalogs to {SNS_TOPIC}: {json.dumps(catalog)}")
-
-                catids.append(item['id'])
-
-        logger.info(f"Published {len(catids)} catalogs from {len(inventory_files)} inventory files")
-        return catids
+        logger.info(f"Parsing {len(inventory_files)} inventory files with {workers} workers")
+        count, edges = feed_inventory_files(inventory_files, min(workers, len(inventory_files)),
+                                            catids_prefix=prefix, keys=keys, process=process, **payload)
+        logger.info(f"Published {count} catalogs from {len(inventory_files)} inventory files")
+        if shards is not None and len(shards) > 1:
+            # directories may continue in the files of other shards, they are fed once all shards are done
+            job_id = os.getenv('AWS_BATCH_JOB_ID', 'local').split(':')[0]
+            s3session.upload_json(edges, edges_url(job_id, os.getenv('AWS_BATCH_JOB_ARRAY_INDEX', 0)))
+        else:
+            feed_options = {k: payload[k] for k in ['base_url', 'priority'] if k in payload}
+            count += feed_edges(edges, process, catids_prefix=prefix, **feed_options)
+        clear_checkpoints()
+        return feed_results(count, prefix)
 
 
 if __name__ == "__main__":
@@ -1,5 +1,4 @@
 import argparse
-import boto3
 import datetime
 import json
 import logging
@@ -16,13 +15,13 @@ from boto3utils import s3
 from cirruslib.utils import submit_batch_job
 from satsearch import Search
 
+from claim_check import publish
+
 
 # envvars
 SNS_TOPIC = os.getenv('CIRRUS_QUEUE_TOPIC_ARN')
 MAX_ITEMS_REQUEST = 5000
 
-# boto clients
-SNS_CLIENT = boto3.client('sns')
 
 # logging
 logger = logging.getLogger(f"{__name__}.stac-api")
@@ -60,7 +59,7 @@ def split_request(params, nbatches):
         yield request
     
 
-def run(params, url, sleep=None, process=None):
+def run(params, url, sleep=None, process=None, priority='backfill'):
     search = Search(url=url, **params)
     logger.debug(f"Searching {url}")    
     found = search.found()
@@ -76,7 +75,7 @@ def run(params, url, sleep=None, process=None):
             }
             if process:
                 payload['process'] = process
-            resp = SNS_CLIENT.publish(TopicArn=SNS_TOPIC, Message=json.dumps(payload))
+            publish(payload, priority=priority)
             if (i % 500) == 0:
                 logger.debug(f"Added {i+1} items to Cirrus")
             #if resp['StatusCode'] != 200:
@@ -89,7 +88,7 @@ def run(params, url, sleep=None, process=None):
         nbatches = 2
         logger.info(f"Too many Items for single request, splitting into {nbatches} batches by date range")
         for params in split_request(params, nbatches):
-            run(params, url, process=process)
+            run(params, url, process=process, priority=priority)
 
 
 def handler(event, context={}):
@@ -100,6 +99,7 @@ def handler(event, context={}):
     max_items_batch = event.get('max_items_batch', 15000)
     sleep = event.get('sleep', None)
     process = event.get('process', None)
+    priority = event.get('priority', 'backfill')
 
     # search API
     search = Search(url=url, **params)
@@ -109,7 +109,7 @@ def handler(event, context={}):
     logger.debug(f"Total items found: {found}")
 
     if found <= MAX_ITEMS_REQUEST:
-        return run(params, url, sleep=sleep, process=process)
+        return run(params, url, sleep=sleep, process=process, priority=priority)
     elif hasattr(context, "invoked_function_arn"):
         nbatches = int(found / max_items_batch) + 1
         if nbatches == 1:
@@ -121,7 +121,7 @@ def handler(event, context={}):
         logger.info(f"Submitted {nbatches} batches")
         return
     else:
-        run(params, url, sleep=sleep, process=process)
+        run(params, url, sleep=sleep, process=process, priority=priority)
 
 
 if __name__ == "__main__":
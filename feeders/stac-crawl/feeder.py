@@ -1,10 +1,8 @@
 import argparse
-import boto3
 import datetime
 import json
 import logging
 import math
-import os
 import requests
 import sys
 import time
@@ -16,11 +14,8 @@ from cirruslib.utils import submit_batch_job
 from dateutil.parser import parse
 from pystac import Catalog
 
-# envvars
-SNS_TOPIC = os.getenv('CIRRUS_QUEUE_TOPIC_ARN')
+from claim_check import publish
 
-# clients
-SNS_CLIENT = boto3.client('sns')
 
 # logging
 logger = logging.getLogger(f"{__name__}.stac-crawl")
@@ -33,6 +28,7 @@ def handler(event, context={}):
     url = event.get('url')
     batch = event.get('batch', False)
     process = event['process']
+    priority = event.get('priority', 'backfill')
 
     if batch and hasattr(context, "invoked_function_arn"):
         submit_batch_job(event, context.invoked_function_arn, definition='lambda-as-batch', name='feed-stac-crawl')
@@ -46,7 +42,7 @@ def handler(event, context={}):
             'features': [item.to_dict()],
             'process': process
         }
-        SNS_CLIENT.publish(TopicArn=SNS_TOPIC, Message=json.dumps(payload))
+        publish(payload, priority=priority)
 
 
 if __name__ == "__main__":
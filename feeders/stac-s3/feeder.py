@@ -1,5 +1,4 @@
 import argparse
-import boto3
 import json
 import logging
 import os
@@ -8,11 +7,8 @@ import sys
 
 from cirruslib.transfer import get_s3_session
 
-# envvars
-SNS_TOPIC = os.getenv('CIRRUS_QUEUE_TOPIC_ARN')
+from claim_check import publish
 
-# boto clients
-SNS_CLIENT = boto3.client('sns')
 
 # logging
 logger = logging.getLogger(f"{__name__}.stac-s3")
@@ -27,6 +23,7 @@ def handler(event, context={}):
 
     # process block required
     process = event['process']
+    priority = event.get('priority', 'backfill')
 
     num = 0
     for s3url in s3urls:
@@ -53,8 +50,7 @@ def handler(event, context={}):
             }
 
             # feed to cirrus through SNS topic
-
-            SNS_CLIENT.publish(TopicArn=SNS_TOPIC, Message=json.dumps(catalog))
+            publish(catalog, priority=priority)
             if (num % 500) == 0:
                 logger.debug(f"Added {num+1} items to Cirrus")
             num+=1
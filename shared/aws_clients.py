@@ -0,0 +1,70 @@
+"""boto3 clients and resources, and the Cirrus state db, of the shared modules"""
+import os
+import threading
+from functools import lru_cache
+
+import boto3
+
+# boto3 resources, and the state db, are not thread safe, each thread gets its own
+_local = threading.local()
+# creating clients and resources with the default boto3 session is not thread safe either
+_lock = threading.Lock()
+
+
+@lru_cache(maxsize=None)
+def _get_client(service, pid):
+    with _lock:
+        return boto3.client(service)
+
+
+def _thread_cached(name, create):
+    # a forked process starts with the objects of the thread that forked it
+    if getattr(_local, 'pid', None) != os.getpid():
+        _local.pid = os.getpid()
+        _local.cache = {}
+    if name not in _local.cache:
+        with _lock:
+            _local.cache[name] = create()
+    return _local.cache[name]
+
+
+def _create_statedb():
+    # importing cirruslib creates boto3 clients, so it is only imported when the state db is used
+    from cirruslib import StateDB
+    return StateDB()
+
+
+def get_client(service):
+    """Get a boto3 client, created on first use in each process so that it is not shared with forked workers
+
+    Args:
+        service (str): AWS service name
+
+    Returns:
+        botocore.client.BaseClient: The client
+    """
+    return _get_client(service, os.getpid())
+
+
+def get_resource(service):
+    """Get a boto3 resource, created on first use in each thread, since resources are not thread safe
+
+    Args:
+        service (str): AWS service name
+
+    Returns:
+        boto3.resources.base.ServiceResource: The resource
+    """
+    return _thread_cached(service, lambda: boto3.resource(service))
+
+
+def get_statedb():
+    """Get the Cirrus state db, created on first use in each thread, since it uses a boto3 resource
+
+    Threads that use the state db should be reused, such as those of an executor kept across
+    invocations, so that it is not created again for every task.
+
+    Returns:
+        cirruslib.StateDB: The state db
+    """
+    return _thread_cached('statedb', _create_statedb)
@@ -0,0 +1,167 @@
+"""Batch jobs running a Lambda handler, retried and resumed from checkpoints if their instance is terminated"""
+import hashlib
+import json
+import logging
+import time
+import uuid
+from os import getenv
+
+from aws_clients import get_client
+
+# envvars
+CIRRUS_STACK = getenv('CIRRUS_STACK')
+CATALOG_BUCKET = getenv('CIRRUS_CATALOG_BUCKET')
+
+# seconds between saving checkpoints of the progress of batch jobs
+CHECKPOINT_INTERVAL = 60
+# batch jobs are retried if the instance they run on is terminated (e.g. spot interruption)
+RETRY_STRATEGY = {
+    'attempts': 3,
+    'evaluateOnExit': [
+        {'onStatusReason': 'Host EC2*', 'action': 'RETRY'},
+        {'onReason': '*', 'action': 'EXIT'}
+    ]
+}
+
+# logging
+logger = logging.getLogger(__name__)
+
+
+def submit_batch_job(payload, arn, name=None, queue='basic-ondemand', definition='lambda-as-batch', vcpus=1,
+                     memory=512, array_size=None, depends_on=None):
+    """Submit a batch job running a Lambda, like cirruslib.utils.submit_batch_job but retried if its instance
+    is terminated, and with more vCPUs and memory
+
+    Args:
+        payload (Dict): Payload of the job
+        arn (str): ARN of the Lambda run by the job
+        name (str, optional): Name of the job. Defaults to the name of the Lambda.
+        queue (str, optional): Job queue, without the stack prefix. Defaults to 'basic-ondemand'.
+        definition (str, optional): Job definition, without the stack prefix. Defaults to 'lambda-as-batch'.
+        vcpus (int, optional): vCPUs of the job. Defaults to 1.
+        memory (int, optional): Memory of the job in MB. Defaults to 512.
+        array_size (int, optional): Submit an array job of this many child jobs, all with the same
+            payload. Defaults to None, for a single job.
+        depends_on (List[str], optional): IDs of jobs that must succeed before this job runs. Defaults to None.
+
+    Returns:
+        str: ID of the job
+    """
+    key = f"batch/{uuid.uuid1()}.json"
+    get_client('s3').put_object(Bucket=CATALOG_BUCKET, Key=key, Body=json.dumps(payload))
+    kwargs = {'arrayProperties': {'size': array_size}} if array_size is not None else {}
+    if depends_on:
+        kwargs['dependsOn'] = [{'jobId': job_id} for job_id in depends_on]
+    response = get_client('batch').submit_job(
+        jobName=name or arn.split(':')[-1],
+        jobQueue=f"{CIRRUS_STACK}-{queue}",
+        jobDefinition=f"{CIRRUS_STACK}-{definition}",
+        parameters={
+            'lambda_function': arn,
+            'url': f"s3://{CATALOG_BUCKET}/{key}"
+        },
+        containerOverrides={
+            'vcpus': vcpus,
+            'memory': memory
+        },
+        retryStrategy=RETRY_STRATEGY,
+        **kwargs
+    )
+    logger.debug(f"Submitted batch job {response['jobId']} with payload s3://{CATALOG_BUCKET}/{key}")
+    return response['jobId']
+
+
+def batch_job_id():
+    """Get the ID of the batch job, with the array index of a child job of an array job
+
+    The ID is the same when the job is retried, so it names what a retried job resumes from.
+
+    Returns:
+        str: Job ID, None if not run in a batch job
+    """
+    job_id = getenv('AWS_BATCH_JOB_ID')
+    if job_id is None:
+        return None
+    index = getenv('AWS_BATCH_JOB_ARRAY_INDEX')
+    job_id = job_id.split(':')[0]
+    return job_id if index is None else f"{job_id}:{index}"
+
+
+def checkpoint_key(name=None):
+    """Get the s3 key of a checkpoint of the batch job, or the prefix of all its checkpoints
+
+    Args:
+        name (str, optional): Name of the checkpoint, such as an inventory file URL. Defaults to None.
+
+    Returns:
+        str: Key in the Catalogs bucket, None if not run in a batch job
+    """
+    job_id = batch_job_id()
+    if job_id is None:
+        return None
+    key = f"checkpoints/{job_id}/"
+    if name is not None:
+        key += f"{hashlib.md5(name.encode()).hexdigest()}.json"
+    return key
+
+
+class Checkpoint(object):
+    """Progress of a batch job feeding a file, saved to s3 at intervals
+
+    A checkpoint is the number of catalogs fed from the file, if all were fed, and the result of a file
+    that is done, returned again rather than read from the file. It is saved under
+    the ID of the batch job, which is the same when the job is retried, so a retried job skips what
+    was already fed. Outside of batch jobs, nothing is saved.
+
+    Functions in `on_save` are called with the offset before each save, to flush what must be saved
+    with the progress, such as a manifest of the catalogs fed.
+    """
+
+    def __init__(self, name, interval=None):
+        self.key = checkpoint_key(name)
+        self.interval = CHECKPOINT_INTERVAL if interval is None else interval
+        self.offset = 0
+        self.done = False
+        self.result = None
+        self.on_save = []
+        if self.key is not None:
+            client = get_client('s3')
+            try:
+                state = json.loads(client.get_object(Bucket=CATALOG_BUCKET, Key=self.key)['Body'].read())
+                self.offset, self.done, self.result = state['offset'], state['done'], state.get('result')
+                logger.info(f"Resuming {name} from checkpoint at {self.offset} catalogs (done: {self.done})")
+            except client.exceptions.NoSuchKey:
+                pass
+        self.saved = time.time()
+
+    def save(self):
+        for flush in self.on_save:
+            flush(self.offset)
+        if self.key is not None:
+            state = {'offset': self.offset, 'done': self.done, 'result': self.result}
+            get_client('s3').put_object(Bucket=CATALOG_BUCKET, Key=self.key, Body=json.dumps(state))
+        self.saved = time.time()
+
+    def update(self, offset):
+        """Set the number of catalogs fed, saving the checkpoint if the interval has passed"""
+        self.offset = offset
+        if time.time() - self.saved >= self.interval:
+            self.save()
+
+    def complete(self, result=None):
+        """Mark the file as done, saving the checkpoint with a result that a retried job returns"""
+        self.done = True
+        self.result = result
+        self.save()
+
+
+def clear_checkpoints():
+    """Delete the checkpoints of the batch job, once all is fed"""
+    prefix = checkpoint_key()
+    if prefix is None:
+        return
+    client = get_client('s3')
+    for page in client.get_paginator('list_objects_v2').paginate(Bucket=CATALOG_BUCKET, Prefix=prefix):
+        objects = [{'Key': obj['Key']} for obj in page.get('Contents', [])]
+        if len(objects) > 0:
+            client.delete_objects(Bucket=CATALOG_BUCKET, Delete={'Objects': objects})
@@ -0,0 +1,51 @@
+"""Claim check for catalogs sent through SNS and SQS
+
+Catalogs too large for a message are uploaded to the Cirrus catalog bucket, and the
+message only contains an s3 URL to them, `{"url": "s3://..."}`, which the `process`
+Lambda fetches.
+"""
+import json
+import os
+import uuid
+
+from aws_clients import get_client
+
+# envvars
+SNS_TOPIC = os.getenv('CIRRUS_QUEUE_TOPIC_ARN')
+CATALOG_BUCKET = os.getenv('CIRRUS_CATALOG_BUCKET')
+
+# max size in bytes of catalogs sent in messages, larger catalogs are sent as an s3 URL
+MAX_MESSAGE_SIZE = 250000
+
+
+def to_message(catalog, bucket, s3client=None):
+    """Create message for a catalog, uploading it to s3 if too large for SNS/SQS
+
+    Args:
+        catalog (Dict): A Cirrus Input Catalog
+        bucket (str): Bucket large catalogs are uploaded to, under `payloads/`
+        s3client (botocore.client.S3, optional): s3 client to upload with. Defaults to a client of this process.
+
+    Returns:
+        str: Message, the catalog or an s3 URL to the catalog
+    """
+    msg = json.dumps(catalog)
+    # size once escaped in the SNS envelope
+    if len(json.dumps(msg).encode('utf-8')) > MAX_MESSAGE_SIZE:
+        key = f"payloads/{uuid.uuid1()}.json"
+        (s3client or get_client('s3')).put_object(Bucket=bucket, Key=key, Body=msg, ContentType='application/json')
+        msg = json.dumps({'url': f"s3://{bucket}/{key}"})
+    return msg
+
+
+def publish(catalog, priority='backfill'):
+    """Publish catalog to the Cirrus queue, or an s3 URL to it if too large for SNS
+
+    Args:
+        catalog (Dict): A Cirrus Input Catalog
+        priority (str, optional): Ingest lane, 'realtime' or 'backfill'. Defaults to 'backfill'.
+    """
+    msg = to_message(catalog, CATALOG_BUCKET)
+    get_client('sns').publish(TopicArn=SNS_TOPIC, Message=msg, MessageAttributes={
+        'priority': {'DataType': 'String', 'StringValue': priority}
+    })
@@ -0,0 +1,81 @@
+"""Histograms of processing durations, counted in the stats db"""
+import math
+import re
+
+# linear sub-bins of each power of 2 of seconds
+SUB_BINS = 8
+
+
+def duration_bin(seconds):
+    """Get the histogram bin of a duration
+
+    Bin `d<i>_<j>` counts durations from 2^i * (1 + j/SUB_BINS) up to 2^i * (1 + (j+1)/SUB_BINS) seconds,
+    bin `d0_0` also counts durations under 1 second.
+
+    Args:
+        seconds (float): Duration in seconds
+
+    Returns:
+        str: Name of counter
+    """
+    if seconds < 1:
+        return 'd0_0'
+    i = int(math.log2(seconds))
+    # log2 may round across a power of 2
+    if 2**i > seconds:
+        i -= 1
+    elif 2**(i + 1) <= seconds:
+        i += 1
+    j = min(SUB_BINS - 1, int((seconds / 2**i - 1) * SUB_BINS))
+    return f"d{i}_{j}"
+
+
+def bin_bounds(name):
+    """Get the range of durations counted by a histogram bin
+
+    Counters `d<i>` of a whole power of 2, counted before bins were split, are also read.
+
+    Args:
+        name (str): Name of counter
+
+    Returns:
+        Tuple[float, float]: Lower and upper bound in seconds, None if the counter is not a bin
+    """
+    match = re.fullmatch(r'd(\d+)(?:_(\d+))?', name)
+    if match is None:
+        return None
+    i = int(match.group(1))
+    if match.group(2) is None:
+        lower, upper = 2**i, 2**(i + 1)
+    else:
+        j = int(match.group(2))
+        lower, upper = 2**i * (1 + j / SUB_BINS), 2**i * (1 + (j + 1) / SUB_BINS)
+    # the first bin also counts durations under 1 second
+    return (0 if lower == 1 else lower), upper
+
+
+def duration_percentiles(counters, percentiles=[50, 95, 99]):
+    """Get processing duration percentiles from a histogram of durations
+
+    Percentiles are interpolated linearly within the bin they fall in.
+
+    Args:
+        counters (Dict): Stats db item
+        percentiles (List[int], optional): Percentiles to get. Defaults to [50, 95, 99].
+
+    Returns:
+        Dict: Number of durations, and each percentile in seconds (None if there are no durations)
+    """
+    bins = sorted((bin_bounds(k), int(v)) for k, v in counters.items() if bin_bounds(k) is not None)
+    total = sum(n for _, n in bins)
+    result = {'count': total}
+    for p in percentiles:
+        result[f"p{p}"] = None
+        target = p / 100 * total
+        cumulative = 0
+        for (lower, upper), n in bins:
+            if n > 0 and cumulative + n >= target:
+                result[f"p{p}"] = round(lower + (upper - lower) * (target - cumulative) / n, 1)
+                break
+            cumulative += n
+    return result
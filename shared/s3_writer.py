@@ -0,0 +1,136 @@
+"""Streaming writes to s3 objects with multipart uploads"""
+import gzip
+import io
+import json
+
+from aws_clients import get_client
+
+# size of the parts of multipart uploads
+WRITE_PART_SIZE = 8 * 1024 * 1024
+
+
+def urlparse(url):
+    """Split an s3 URL into bucket and key"""
+    bucket, _, key = url[len('s3://'):].partition('/')
+    return bucket, key
+
+
+class S3Writer(io.RawIOBase):
+    """Writable stream to an s3 object, uploaded with a multipart upload as parts of `part_size` are written
+
+    Memory is bounded to a part. The object is only created when the stream is closed without an error.
+    """
+
+    def __init__(self, url, part_size=WRITE_PART_SIZE, **kwargs):
+        self.bucket, self.key = urlparse(url)
+        self.part_size = part_size
+        self.kwargs = kwargs
+        self.client = get_client('s3')
+        self.buffer = bytearray()
+        self.parts = []
+        self.upload_id = None
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.buffer += b
+        if len(self.buffer) >= self.part_size:
+            self._upload_part()
+        return len(b)
+
+    def _upload_part(self):
+        if self.upload_id is None:
+            self.upload_id = self.client.create_multipart_upload(Bucket=self.bucket, Key=self.key,
+                                                                 **self.kwargs)['UploadId']
+        number = len(self.parts) + 1
+        resp = self.client.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                       PartNumber=number, Body=bytes(self.buffer))
+        self.parts.append({'ETag': resp['ETag'], 'PartNumber': number})
+        self.buffer = bytearray()
+
+    def close(self):
+        if self.closed:
+            return
+        if self.upload_id is None:
+            self.client.put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self.buffer), **self.kwargs)
+        else:
+            if len(self.buffer) > 0:
+                self._upload_part()
+            self.client.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                                  MultipartUpload={'Parts': self.parts})
+        super().close()
+
+    def abort(self):
+        if self.upload_id is not None:
+            self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+        super().close()
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
+
+
+def abort_uploads(url):
+    """Abort the incomplete multipart uploads of an s3 object, such as those of a terminated job"""
+    bucket, key = urlparse(url)
+    client = get_client('s3')
+    for page in client.get_paginator('list_multipart_uploads').paginate(Bucket=bucket, Prefix=key):
+        for upload in page.get('Uploads', []):
+            if upload['Key'] == key:
+                client.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload['UploadId'])
+
+
+class CatalogIds(object):
+    """Manifest of the IDs of published catalogs, written to s3 as gzipped newline delimited JSON
+
+    IDs are compressed and uploaded as they are appended, so that a job feeding millions of catalogs
+    does not keep them in memory. The upload is aborted on an error.
+
+    The manifest is written in segments `<url>-<offset>.ndjson.gz` of the catalogs fed from an offset.
+    With a checkpoint, a segment is completed each time the checkpoint is saved, and the next one started,
+    so a retried job resuming from the checkpoint only rewrites the segment it resumes from, and aborts
+    the incomplete upload of that segment left by the terminated job.
+    """
+
+    def __init__(self, url, checkpoint=None, part_size=WRITE_PART_SIZE):
+        self.url = url
+        self.part_size = part_size
+        self.checkpoint = checkpoint
+        self.count = 0
+        self.start(checkpoint.offset if checkpoint is not None else 0)
+        if checkpoint is not None:
+            checkpoint.on_save.append(self.flush)
+
+    def start(self, offset):
+        """Start the segment of the catalogs fed from `offset`"""
+        url = f"{self.url}-{offset:012d}.ndjson.gz"
+        if self.checkpoint is not None:
+            abort_uploads(url)
+        self.upload = S3Writer(url, part_size=self.part_size, ContentType='application/gzip')
+        self.gz = gzip.GzipFile(fileobj=self.upload, mode='wb', compresslevel=6)
+        self.appended = 0
+
+    def append(self, id):
+        self.gz.write((json.dumps({'id': id}) + '\n').encode())
+        self.count += 1
+        self.appended += 1
+
+    def flush(self, offset):
+        """Complete the segment, with the catalogs fed until `offset`, and start the next one"""
+        if self.appended == 0:
+            return
+        self.gz.close()
+        self.upload.close()
+        self.start(offset)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if self.checkpoint is not None:
+            self.checkpoint.on_save.remove(self.flush)
+        self.gz.close()
+        self.upload.__exit__(exc_type, *args)
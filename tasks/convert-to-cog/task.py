@@ -16,9 +16,6 @@ def handler(payload, context={}):
     catalog = Catalog.from_payload(payload)
     logger = get_task_logger(f"{__name__}.convert-to-cog", catalog=catalog)
 
-    # TODO - make this more general for more items/collections
-    item = catalog['features'][0] #, collection=catalog['collections'][0])
-
     # configuration options
     config = catalog['process']['tasks'].get('convert-to-cog', {})
     outopts = catalog['process'].get('output_options', {})
@@ -28,46 +25,47 @@ def handler(payload, context={}):
     tmpdir = mkdtemp()
 
     try:
-        asset_keys = [a for a in assets if a in item['assets'].keys()]
+        for i, item in enumerate(catalog['features']):
+            asset_keys = [a for a in assets if a in item['assets'].keys()]
         
-        for asset in asset_keys:
-            logger.info(f"Converting {asset} to COG")
-            # download asset
-            item = download_item_assets(item, path=tmpdir, assets=[asset])
-
-            # cogify
-            fn = item['assets'][asset]['href']
-            fnout = cogify(fn, os.path.splitext(fn)[0] + '.tif', **assets[asset])
-            item['assets'][asset]['href'] = fnout
-            item['assets'][asset]['type'] = "image/tiff; application=geotiff; profile=cloud-optimized"
-            with rasterio.open(fnout) as src:
-                item['assets'][asset]['proj:shape'] = src.shape
-                item['assets'][asset]['proj:transform'] = src.transform
-
-            # upload assets
-            item = upload_item_assets(item, assets=[asset], **outopts)
-            # cleanup files
-            if os.path.exists(fn):
-                os.remove(fn)
-            if os.path.exists(fnout):
-                os.remove(fnout)
-
-        # add derived_from link
-        links = [l['href'] for l in item['links'] if l['rel'] == 'self']
-        if len(links) == 1:
-            # add derived from link
-            item ['links'].append({
-                'title': 'Source STAC Item',
-                'rel': 'derived_from',
-                'href': links[0],
-                'type': 'application/json'
-            })
-
-        # drop any specified assets
-        for asset in [a for a in config.get('drop_assets', []) if a in item['assets'].keys()]:
-            item['assets'].pop(asset)
-
-        catalog['features'][0] = item
+            for asset in asset_keys:
+                logger.info(f"Converting {asset} to COG")
+                # download asset
+                item = download_item_assets(item, path=tmpdir, assets=[asset])
+
+                # cogify
+                fn = item['assets'][asset]['href']
+                fnout = cogify(fn, os.path.splitext(fn)[0] + '.tif', **assets[asset])
+                item['assets'][asset]['href'] = fnout
+                item['assets'][asset]['type'] = "image/tiff; application=geotiff; profile=cloud-optimized"
+                with rasterio.open(fnout) as src:
+                    item['assets'][asset]['proj:shape'] = src.shape
+                    item['assets'][asset]['proj:transform'] = src.transform
+
+                # upload assets
+                item = upload_item_assets(item, assets=[asset], **outopts)
+                # cleanup files
+                if os.path.exists(fn):
+                    os.remove(fn)
+                if os.path.exists(fnout):
+                    os.remove(fnout)
+
+            # add derived_from link
+            links = [l['href'] for l in item['links'] if l['rel'] == 'self']
+            if len(links) == 1:
+                # add derived from link
+                item ['links'].append({
+                    'title': 'Source STAC Item',
+                    'rel': 'derived_from',
+                    'href': links[0],
+                    'type': 'application/json'
+                })
+
+            # drop any specified assets
+            for asset in [a for a in config.get('drop_assets', []) if a in item['assets'].keys()]:
+                item['assets'].pop(asset)
+
+            catalog['features'][i] = item
     except CRSError as err:
         msg = f"convert-to-cog: invalid CRS ({err})"
         logger.error(msg, exc_info=True)
@@ -39,9 +39,45 @@ def handler(payload, context={}):
 
     catalog = Catalog.from_payload(payload)
 
-    # TODO - make this more general for more items/collections
-    assert(len(catalog['features']) == 1)
+    # IDs of the grouped catalogs, by feature
+    members = catalog['process'].get('members', [])
+    invalid = {}
+    # grouped catalog the Items were created from, by Item ID
+    sources = {}
+    items = []
+    for i, feature in enumerate(catalog['features']):
+        url = s3().s3_to_https(feature['assets']['txt']['href'].rstrip())
+        try:
+            items.append(landsat_to_stac(url, feature['id']))
+            if len(members) > 0:
+                sources[items[-1]['id']] = members[i]
+        except InvalidInput as err:
+            # in a grouped catalog only fail if none are valid, the others are published and the
+            # invalid catalogs set as INVALID in the state db by the publish task
+            if len(members) == 0:
+                raise err
+            logger.warning(f"landsat-to-stac: skipping {feature['id']} ({err})")
+            invalid[members[i]] = str(err)
+
+    if len(items) == 0:
+        msg = "landsat-to-stac: no valid input Items"
+        logger.error(msg)
+        raise InvalidInput(msg)
+
+    # update STAC catalog
+    catalog['features'] = items
+    if len(invalid) > 0:
+        catalog['process']['invalid'] = invalid
+    if len(sources) > 0:
+        catalog['process']['sources'] = sources
+    logger.debug(f"STAC Output: {json.dumps(catalog)}")
+    logger.debug(f"Items: {json.dumps(items)}")
+
+    return catalog
 
+
+def landsat_to_stac(url, itemid):
+    """Create a STAC Item from a Landsat MTL URL"""
     # configuration options
     #config = catalog['process']['functions'].get('landsat-to-stac', {})
     #output_options = catalog['process'].get('output_options', {})
@@ -51,9 +87,6 @@ def handler(payload, context={}):
     #output_collection = list(catalog['process']['output_options']['collections'].keys())[0]
     #output_collection = 'landsat-c1-l2a'
 
-    items = []
-    # get metadata
-    url = s3().s3_to_https(catalog['features'][0]['assets']['txt']['href'].rstrip())
     base_url = url.rstrip('_MTL.txt')
 
     # get metadata and convert to JSON
@@ -103,10 +136,8 @@ def handler(payload, context={}):
         landsat.add_assets(item, base_url)
 
         #item.validate()
-        items.append(item.to_dict())
-
     except Exception as err:
-        msg = f"landsat-to-stac: failed creating STAC for {catalog['id']} ({err})"
+        msg = f"landsat-to-stac: failed creating STAC for {itemid} ({err})"
         logger.error(msg)
         logger.error(format_exc())
         raise Exception(msg)
@@ -118,12 +149,7 @@ def handler(payload, context={}):
         logger.error(msg)
         raise InvalidInput(msg)
 
-    # update STAC catalog
-    catalog['features'] = items
-    logger.debug(f"STAC Output: {json.dumps(catalog)}")
-    logger.debug(f"Items: {json.dumps(items)}")
-
-    return catalog
+    return item.to_dict()
 
 
 if __name__ == "__main__":
@@ -1,7 +1,9 @@
 import json
+from functools import lru_cache
 from os import getenv
 
-from cirruslib import Catalog, StateDB, get_task_logger
+# the Cirrus state db is created on first use
+from aws_clients import get_statedb
 
 # envvars
 DATA_BUCKET = getenv('CIRRUS_DATA_BUCKET')
@@ -9,12 +11,70 @@ API_URL = getenv('CIRRUS_API_URL', None)
 # DEPRECATED - additional topics
 PUBLISH_TOPICS = getenv('CIRRUS_PUBLISH_SNS', None)
 
-# Cirrus state db
-statedb = StateDB()
+
+@lru_cache(maxsize=None)
+def catalog_class():
+    """Get the Catalog class publishing Items with the workflow and when the catalog was fed
+
+    Importing cirruslib creates boto3 clients, so it is imported when invoked rather than at cold start.
+    """
+    from cirruslib import Catalog as _Catalog
+
+    class Catalog(_Catalog):
+
+        def sns_attributes(self, item):
+            """Create attributes from Item for publishing to SNS, with the workflow and when the catalog was fed
+
+            Args:
+                item (Dict): A STAC Item
+
+            Returns:
+                Dict: Attributes for SNS publishing
+            """
+            attr = super().sns_attributes(item)
+            attr['workflow'] = {
+                'DataType': 'String',
+                'StringValue': self['process']['workflow']
+            }
+            if 'created' in self['process']:
+                attr['created'] = {
+                    'DataType': 'String',
+                    'StringValue': self['process']['created']
+                }
+            return attr
+
+    return Catalog
+
+
+def member_outputs(catalog, s3urls):
+    """Get the outputs of each catalog grouped into a catalog
+
+    An output Item is from the grouped catalog of the input Item with the same ID, or, for Items
+    created by a task from an input Item, the grouped catalog in `process.sources`.
+
+    Args:
+        catalog (Catalog): A Cirrus catalog, with the published Items as features
+        s3urls (List[str]): s3 URLs of the published Items, in the order of the features
+
+    Returns:
+        Dict[str, List[str]]: s3 URLs of the output Items, by grouped catalog ID
+    """
+    members = catalog['process'].get('members', [])
+    sources = catalog['process'].get('sources', {})
+    # grouped catalogs have a single input Item, and its ID is the last part of the catalog ID
+    by_itemid = {catid.rsplit('/', maxsplit=1)[-1]: catid for catid in members}
+    outputs = {catid: [] for catid in members}
+    for item, url in zip(catalog['features'], s3urls):
+        catid = sources.get(item['id'], by_itemid.get(item['id']))
+        if catid in outputs:
+            outputs[catid].append(url)
+    return outputs
 
 
 def handler(payload, context):
-    catalog = Catalog.from_payload(payload)
+    from cirruslib import get_task_logger
+
+    catalog = catalog_class().from_payload(payload)
     logger = get_task_logger(f"{__name__}.publish", catalog=catalog)
 
     config = catalog['process']['tasks'].get('publish', {})
@@ -59,7 +119,15 @@ def handler(payload, context):
 
     try:
         # update processing in table
+        statedb = get_statedb()
         statedb.set_completed(catalog['id'], outputs=s3urls)
+        # and the catalogs grouped into this one, each with the outputs of its own Item
+        invalid = catalog['process'].get('invalid', {})
+        for catid, outputs in member_outputs(catalog, s3urls).items():
+            if catid in invalid:
+                statedb.set_invalid(catid, invalid[catid])
+            else:
+                statedb.set_completed(catid, outputs=outputs)
     except Exception as err:
         msg = f"publish: failed setting as complete ({err})"
         logger.error(msg, exc_info=True)
@@ -25,9 +25,44 @@ def handler(payload, context={}):
 
     logger = get_task_logger(f"{__name__}.sentinel-to-stac", catalog=catalog)
 
+    # IDs of the grouped catalogs, by feature
+    members = catalog['process'].get('members', [])
+    invalid = {}
+    # grouped catalog the Items were created from, by Item ID
+    sources = {}
+    items = []
+    for i, feature in enumerate(catalog['features']):
+        try:
+            _items = sentinel_to_stac(feature['assets']['json']['href'].rstrip(), logger)
+            items += _items
+            if len(members) > 0:
+                sources.update({item['id']: members[i] for item in _items})
+        except InvalidInput as err:
+            # in a grouped catalog only fail if none are valid, the others are published and the
+            # invalid catalogs set as INVALID in the state db by the publish task
+            if len(members) == 0:
+                raise err
+            logger.warning(f"sentinel-to-stac: skipping {feature['id']} ({err})")
+            invalid[members[i]] = str(err)
+
+    if len(items) == 0:
+        msg = "sentinel-to-stac: no valid input Items"
+        logger.error(msg)
+        raise InvalidInput(msg)
+
+    # update STAC catalog
+    catalog['features'] = items
+    if len(invalid) > 0:
+        catalog['process']['invalid'] = invalid
+    if len(sources) > 0:
+        catalog['process']['sources'] = sources
+
+    return catalog
+
+
+def sentinel_to_stac(url, logger):
+    """Create STAC Items from a Sentinel tileInfo.json URL, the L2A Item and the L1C Item if available"""
     items = []
-    # get metadata
-    url = catalog['features'][0]['assets']['json']['href'].rstrip()
     # if this is the FREE URL, get s3 base
     if url[0:5] == 'https':
         base_url = 's3:/' + op.dirname(urlparse(url).path)
@@ -110,7 +145,4 @@ def handler(payload, context={}):
         logger.error(msg)
         raise InvalidInput(msg)
 
-    # update STAC catalog
-    catalog['features'] = items
-
-    return catalog
+    return items
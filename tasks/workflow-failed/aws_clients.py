@@ -0,0 +1 @@
+../../shared/aws_clients.py
\ No newline at end of file
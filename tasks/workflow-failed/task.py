@@ -1,23 +1,16 @@
-import boto3
 import json
 from os import getenv
 
-from cirruslib import Catalog, StateDB, get_task_logger
+# boto3 clients and the Cirrus state database are created on first use
+from aws_clients import get_client, get_statedb
 
 # envvars
 FAILED_TOPIC_ARN = getenv('CIRRUS_FAILED_TOPIC_ARN', None)
 
-# boto3 clients
-SNS_CLIENT = boto3.client('sns')
-LOG_CLIENT = boto3.client('logs')
-
-# Cirrus state database
-statedb = StateDB()
-
 
 def get_error_from_batch(logname):
     try:
-        logs = LOG_CLIENT.get_log_events(logGroupName='/aws/batch/job', logStreamName=logname)
+        logs = get_client('logs').get_log_events(logGroupName='/aws/batch/job', logStreamName=logname)
         msg = logs['events'][-1]['message'].lstrip('cirruslib.errors.')
         parts = msg.split(':', maxsplit=1)
         if len(parts) > 1:
@@ -30,6 +23,9 @@ def get_error_from_batch(logname):
 
 
 def handler(payload, context):
+    # importing cirruslib creates boto3 clients, so it is imported when invoked rather than at cold start
+    from cirruslib import Catalog, get_task_logger
+
     catalog = Catalog.from_payload(payload)
     logger = get_task_logger(f"{__name__}.workflow-failed", catalog=catalog)
 
@@ -61,11 +57,17 @@ def handler(payload, context):
     error = f"{error_type}: {error_msg}"
     logger.info(error)
 
+    statedb = get_statedb()
+    # catalogs grouped into this one fail with it, unless found invalid themselves
+    invalid = catalog['process'].get('invalid', {})
     try:
-        if error_type == "InvalidInput":
-            statedb.set_invalid(catalog['id'], error)
-        else:
-            statedb.set_failed(catalog['id'], error)
+        for catid in [catalog['id']] + catalog['process'].get('members', []):
+            if catid in invalid:
+                statedb.set_invalid(catid, invalid[catid])
+            elif error_type == "InvalidInput":
+                statedb.set_invalid(catid, error)
+            else:
+                statedb.set_failed(catid, error)
     except Exception as err:
         msg = f"Failed marking as failed: {err}"
         logger.error(msg, exc_info=True)
@@ -89,7 +91,7 @@ def handler(payload, context):
                 }
             }
             logger.debug(f"Publishing item to {FAILED_TOPIC_ARN}")
-            SNS_CLIENT.publish(TopicArn=FAILED_TOPIC_ARN, Message=json.dumps(item), MessageAttributes=attrs)
+            get_client('sns').publish(TopicArn=FAILED_TOPIC_ARN, Message=json.dumps(item), MessageAttributes=attrs)
         except Exception as err:
             msg = f"Failed publishing to {FAILED_TOPIC_ARN}: {err}"
             logger.error(msg, exc_info=True)
@@ -0,0 +1,504 @@
+#!/usr/bin/env python
+"""End-to-end pipeline benchmark
+
+Runs a feeder, the process Lambda, and the workflows with their tasks in-process, against
+moto stand-ins for S3, SNS, SQS, DynamoDB and Step Functions. Synthetic Input Catalogs are
+generated from the payloads in test/payloads and docs/examples.
+
+    $ python test/benchmark.py -n 1000 --output baseline.json
+
+Requires moto, pyyaml and the requirements of the feeder, process Lambda and tasks.
+"""
+import argparse
+import importlib.util
+import json
+import logging
+import os
+import resource
+import sys
+import time
+from copy import deepcopy
+from glob import glob
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+REGION = 'us-west-2'
+ACCOUNT = '123456789012'
+STACK = 'cirrus-bench'
+
+# environment the Lambdas are deployed with (see serverless.yml), must be set before importing them
+ENVIRONMENT = {
+    'AWS_ACCESS_KEY_ID': 'testing',
+    'AWS_SECRET_ACCESS_KEY': 'testing',
+    'AWS_SECURITY_TOKEN': 'testing',
+    'AWS_SESSION_TOKEN': 'testing',
+    'AWS_DEFAULT_REGION': REGION,
+    'AWS_REGION': REGION,
+    'CIRRUS_LOG_LEVEL': 'WARNING',
+    'CIRRUS_STACK': STACK,
+    'CIRRUS_DATA_BUCKET': f"{STACK}-data",
+    'CIRRUS_CATALOG_BUCKET': f"{STACK}-catalogs",
+    'CIRRUS_STATE_DB': f"{STACK}-state",
+    'CIRRUS_STATS_DB': f"{STACK}-stats",
+    'CIRRUS_PROCESS_QUEUE': f"{STACK}-process",
+    'CIRRUS_QUEUE_TOPIC_ARN': f"arn:aws:sns:{REGION}:{ACCOUNT}:{STACK}-queue",
+    'CIRRUS_PUBLISH_TOPIC_ARN': f"arn:aws:sns:{REGION}:{ACCOUNT}:{STACK}-publish",
+    'BASE_WORKFLOW_ARN': f"arn:aws:states:{REGION}:{ACCOUNT}:stateMachine:{STACK}-",
+}
+SOURCE_BUCKET = f"{STACK}-source"
+
+# directories of the input payloads synthetic catalogs are generated from
+PAYLOAD_DIRS = ['test/payloads', 'docs/examples']
+
+logger = logging.getLogger('benchmark')
+
+
+def load_module(path, name):
+    """Import a Lambda handler module from a file
+
+    Args:
+        path (str): Path of the module, relative to the repository root
+        name (str): Unique module name
+
+    Returns:
+        module: The imported module
+    """
+    # modules shared by handlers are symlinked into the handler directory
+    moddir = os.path.join(ROOT, os.path.dirname(path))
+    if moddir not in sys.path:
+        sys.path.append(moddir)
+    spec = importlib.util.spec_from_file_location(name, os.path.join(ROOT, path))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def percentile(values, p):
+    """Get percentile of values (nearest rank)
+
+    Args:
+        values (List[float]): Values
+        p (float): Percentile, 0-100
+
+    Returns:
+        float: The percentile, None if no values
+    """
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, int(round(p / 100 * len(values) + 0.5)) - 1))]
+
+
+def peak_memory():
+    """Peak resident memory of this process in MB"""
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes on Linux
+    return maxrss / 1024 / 1024 if sys.platform == 'darwin' else maxrss / 1024
+
+
+class Stats(object):
+    """Latencies of a pipeline stage"""
+
+    def __init__(self):
+        self.latencies = []
+        self.elapsed = 0.0
+        self.catalogs = 0
+        self.errors = 0
+        self.peak_memory = None
+
+    def time(self, func, *args, **kwargs):
+        """Call a function and record its latency"""
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            latency = time.perf_counter() - start
+            self.latencies.append(latency)
+            self.elapsed += latency
+
+    def report(self):
+        return {
+            'calls': len(self.latencies),
+            'catalogs': self.catalogs,
+            'errors': self.errors,
+            'catalogs_per_sec': self.catalogs / self.elapsed if self.elapsed else None,
+            'p50_ms': percentile(self.latencies, 50) * 1000 if self.latencies else None,
+            'p95_ms': percentile(self.latencies, 95) * 1000 if self.latencies else None,
+            'peak_memory_mb': self.peak_memory,
+        }
+
+
+def get_path(obj, path):
+    """Get a value from a dict using a Step Functions reference path, e.g., $.process.tasks
+
+    Returns:
+        Tuple[bool, Any]: True and the value if present, otherwise False and None
+    """
+    for key in path.lstrip('$').lstrip('.').split('.'):
+        if not isinstance(obj, dict) or key not in obj:
+            return False, None
+        obj = obj[key]
+    return True, obj
+
+
+def choose(state, payload):
+    """Get next state of a Choice state
+
+    Args:
+        state (Dict): Choice state definition
+        payload (Dict): State input
+
+    Returns:
+        str: Name of next state
+    """
+    for choice in state.get('Choices', []):
+        present, value = get_path(payload, choice['Variable'])
+        if 'IsPresent' in choice and present == choice['IsPresent']:
+            return choice['Next']
+        for op in ['BooleanEquals', 'StringEquals', 'NumericEquals']:
+            if op in choice and present and value == choice[op]:
+                return choice['Next']
+    if 'Default' in state:
+        return state['Default']
+    raise ValueError('No matching Choice')
+
+
+class Workflow(object):
+    """Minimal in-process runner of a workflow definition made of Lambda tasks"""
+
+    def __init__(self, name, tasks):
+        """Load a workflow definition
+
+        Args:
+            name (str): Workflow name (a directory in workflows/)
+            tasks (Dict): Loaded task modules by name, extended with the tasks of this workflow
+        """
+        import yaml
+        with open(os.path.join(ROOT, 'workflows', name, 'definition.yml')) as f:
+            self.definition = yaml.safe_load(f)['definition']
+        self.name = name
+        self.tasks = tasks
+        for state in self.definition['States'].values():
+            task = self.task_name(state)
+            if task is not None and task not in tasks:
+                tasks[task] = load_module(f"tasks/{task}/task.py", f"task_{task.replace('-', '_')}")
+
+    @classmethod
+    def task_name(cls, state):
+        """Name of the Lambda task run by a state, None if not a Lambda Task"""
+        resource = state.get('Resource')
+        if state['Type'] == 'Task' and isinstance(resource, dict) and 'Fn::GetAtt' in resource:
+            return resource['Fn::GetAtt'][0]
+        return None
+
+    def run(self, payload, stats):
+        """Run workflow on a payload
+
+        Args:
+            payload (Dict): Workflow input
+            stats (Dict[str, Stats]): Task stats, by task name
+
+        Returns:
+            bool: True if workflow succeeded
+        """
+        name = self.definition['StartAt']
+        while True:
+            state = self.definition['States'][name]
+            if state['Type'] == 'Choice':
+                name = choose(state, payload)
+                continue
+            if state['Type'] in ['Succeed', 'Fail']:
+                return state['Type'] == 'Succeed'
+            task = self.task_name(state)
+            if task is None:
+                raise ValueError(f"{self.name}: state {name} can not be run in-process")
+            _stats = stats.setdefault(f"task:{task}", Stats())
+            try:
+                output = _stats.time(self.tasks[task].handler, deepcopy(payload), {})
+                # round trip through JSON like a Lambda response
+                payload = json.loads(json.dumps(output))
+                _stats.catalogs += 1
+            except Exception as err:
+                _stats.errors += 1
+                if 'Catch' not in state:
+                    return False
+                payload['error'] = {'Error': type(err).__name__, 'Cause': str(err)}
+                name = state['Catch'][0]['Next']
+                continue
+            if state.get('End', False):
+                return True
+            name = state['Next']
+
+
+def setup_aws(workflows):
+    """Create the Cirrus resources in moto (see core/resources.yml)
+
+    Args:
+        workflows (List[str]): Names of workflows to create state machines for
+
+    Returns:
+        Tuple[str, str]: URLs of the process queue, and of a queue subscribed to the publish topic
+    """
+    import boto3
+
+    s3 = boto3.client('s3')
+    for bucket in [ENVIRONMENT['CIRRUS_DATA_BUCKET'], ENVIRONMENT['CIRRUS_CATALOG_BUCKET'], SOURCE_BUCKET]:
+        s3.create_bucket(Bucket=bucket, CreateBucketConfiguration={'LocationConstraint': REGION})
+
+    sns = boto3.client('sns')
+    queue_topic = sns.create_topic(Name=f"{STACK}-queue")['TopicArn']
+    publish_topic = sns.create_topic(Name=f"{STACK}-publish")['TopicArn']
+
+    sqs = boto3.client('sqs')
+    queue_urls = []
+    for topic, name in [(queue_topic, ENVIRONMENT['CIRRUS_PROCESS_QUEUE']), (publish_topic, f"{STACK}-publish")]:
+        queue_url = sqs.create_queue(QueueName=name)['QueueUrl']
+        queue_arn = sqs.get_queue_attributes(QueueUrl=queue_url, AttributeNames=['QueueArn'])['Attributes']['QueueArn']
+        sns.subscribe(TopicArn=topic, Protocol='sqs', Endpoint=queue_arn)
+        queue_urls.append(queue_url)
+
+    gsi = lambda name: {
+        'IndexName': name,
+        'KeySchema': [
+            {'AttributeName': 'collections_workflow', 'KeyType': 'HASH'},
+            {'AttributeName': name, 'KeyType': 'RANGE'}
+        ],
+        'Projection': {'ProjectionType': 'ALL'}
+    }
+    boto3.client('dynamodb').create_table(
+        TableName=ENVIRONMENT['CIRRUS_STATE_DB'],
+        AttributeDefinitions=[{'AttributeName': a, 'AttributeType': 'S'}
+                              for a in ['collections_workflow', 'itemids', 'state_updated', 'updated']],
+        KeySchema=[
+            {'AttributeName': 'collections_workflow', 'KeyType': 'HASH'},
+            {'AttributeName': 'itemids', 'KeyType': 'RANGE'}
+        ],
+        GlobalSecondaryIndexes=[gsi('state_updated'), gsi('updated')],
+        BillingMode='PAY_PER_REQUEST'
+    )
+
+    sfn = boto3.client('stepfunctions')
+    for wf in workflows:
+        sfn.create_state_machine(name=f"{STACK}-{wf}", definition='{}',
+                                 roleArn=f"arn:aws:iam::{ACCOUNT}:role/{STACK}-workflow")
+    return tuple(queue_urls)
+
+
+def load_templates(workflows=None):
+    """Load Input Catalogs to generate synthetic catalogs from
+
+    Args:
+        workflows (List[str], optional): Only load catalogs for these workflows. Defaults to all.
+
+    Returns:
+        List[Tuple[str, Dict]]: (filename, catalog)
+    """
+    templates = []
+    for d in PAYLOAD_DIRS:
+        for filename in sorted(glob(os.path.join(ROOT, d, '*.json'))):
+            with open(filename) as f:
+                catalog = json.loads(f.read())
+            if 'process' not in catalog or len(catalog.get('features', [])) == 0:
+                continue
+            if workflows and catalog['process']['workflow'] not in workflows:
+                continue
+            # older payloads predate the tasks block
+            catalog['process'].setdefault('tasks', {})
+            templates.append((os.path.relpath(filename, ROOT), catalog))
+    return templates
+
+
+def generate(templates, n, asset_size):
+    """Generate synthetic Items as STAC JSON with assets in the source bucket
+
+    Items are written in chunks to separate prefixes, each fed to Cirrus by one feeder call.
+
+    Args:
+        templates (List[Tuple[str, Dict]]): Catalogs to generate from, used round robin
+        n (int): Number of Items
+        asset_size (int): Size in bytes of each asset
+
+    Returns:
+        List[Tuple[str, Dict]]: s3 URL of each Item, and its process definition
+    """
+    import boto3
+    s3 = boto3.client('s3')
+    body = b'0' * asset_size
+    items = []
+    for i in range(n):
+        _, catalog = templates[i % len(templates)]
+        item = deepcopy(catalog['features'][0])
+        item['id'] = f"{item['id']}-{i:07d}"
+        prefix = f"items/{catalog['process']['workflow']}/{item['id']}"
+        # relative asset hrefs, resolved by the feeder
+        for key in item.get('assets', {}):
+            item['assets'][key]['href'] = f"{key}.dat"
+            s3.put_object(Bucket=SOURCE_BUCKET, Key=f"{prefix}/{key}.dat", Body=body)
+        s3.put_object(Bucket=SOURCE_BUCKET, Key=f"{prefix}/{item['id']}.json", Body=json.dumps(item))
+        items.append((f"s3://{SOURCE_BUCKET}/{prefix}/", catalog['process']))
+    return items
+
+
+def feed(feeder, items, stats):
+    """Feed Items to Cirrus with the stac-s3 feeder, one call per Item"""
+    for url, process in items:
+        try:
+            stats.catalogs += stats.time(feeder.handler, {'s3urls': [url], 'process': process})
+        except Exception as err:
+            logger.error(f"Feeder failed on {url}: {err}")
+            stats.errors += 1
+
+
+def process(process_lambda, queue_url, stats, batch_size=10):
+    """Drain the process queue through the process Lambda, as the SQS event source mapping would"""
+    import boto3
+    sqs = boto3.client('sqs')
+    queue_arn = sqs.get_queue_attributes(QueueUrl=queue_url, AttributeNames=['QueueArn'])['Attributes']['QueueArn']
+    while True:
+        messages = sqs.receive_message(QueueUrl=queue_url, MaxNumberOfMessages=batch_size).get('Messages', [])
+        if len(messages) == 0:
+            break
+        event = {'Records': [{
+            'messageId': m['MessageId'],
+            'receiptHandle': m['ReceiptHandle'],
+            'body': m['Body'],
+            'eventSource': 'aws:sqs',
+            'eventSourceARN': queue_arn
+        } for m in messages]}
+        try:
+            resp = stats.time(process_lambda.lambda_handler, event, {})
+            stats.errors += len(resp.get('batchItemFailures', []))
+        except Exception as err:
+            logger.error(f"Process Lambda failed: {err}")
+            stats.errors += len(messages)
+        stats.catalogs += len(messages)
+        # failures are counted, not retried
+        sqs.delete_message_batch(QueueUrl=queue_url, Entries=[
+            {'Id': str(i), 'ReceiptHandle': m['ReceiptHandle']} for i, m in enumerate(messages)
+        ])
+
+
+def run_workflows(workflows, stats):
+    """Run the workflow of every started execution"""
+    import boto3
+    sfn = boto3.client('stepfunctions')
+    for name, workflow in workflows.items():
+        arn = f"{ENVIRONMENT['BASE_WORKFLOW_ARN']}{name}"
+        for page in sfn.get_paginator('list_executions').paginate(stateMachineArn=arn):
+            for execution in page['executions']:
+                payload = json.loads(sfn.describe_execution(executionArn=execution['executionArn'])['input'])
+                if stats['workflow'].time(workflow.run, payload, stats):
+                    stats['workflow'].catalogs += 1
+                else:
+                    stats['workflow'].errors += 1
+
+
+def latency(publish_test, queue_url):
+    """Get end-to-end latency of all published Items with the publish-test Lambda"""
+    import boto3
+    sqs = boto3.client('sqs')
+    records = []
+    while True:
+        messages = sqs.receive_message(QueueUrl=queue_url, MaxNumberOfMessages=10).get('Messages', [])
+        if len(messages) == 0:
+            break
+        records += [{'body': m['Body']} for m in messages]
+        sqs.delete_message_batch(QueueUrl=queue_url, Entries=[
+            {'Id': str(i), 'ReceiptHandle': m['ReceiptHandle']} for i, m in enumerate(messages)
+        ])
+    results = publish_test.handler({'Records': records}, {})
+    return [{'collection': r['collection'], 'workflow': r['workflow'], 'count': r['count'],
+             'p50': percentile(r['latencies'], 50), 'p95': percentile(r['latencies'], 95),
+             'p99': percentile(r['latencies'], 99)} for r in results]
+
+
+def benchmark(n=100, workflows=None, asset_size=1024):
+    """Run the pipeline on synthetic catalogs
+
+    Args:
+        n (int, optional): Number of catalogs. Defaults to 100.
+        workflows (List[str], optional): Only use payloads of these workflows. Defaults to all.
+        asset_size (int, optional): Size in bytes of each asset. Defaults to 1024.
+
+    Returns:
+        Dict: Benchmark results
+    """
+    for key, val in ENVIRONMENT.items():
+        os.environ.setdefault(key, val)
+
+    from moto import mock_aws
+
+    with mock_aws():
+        templates = load_templates(workflows)
+        if len(templates) == 0:
+            raise ValueError('No payloads found')
+
+        # modules create their clients at import time, so import once moto is active
+        tasks, _workflows = {}, {}
+        for wf in set(catalog['process']['workflow'] for _, catalog in templates):
+            try:
+                _workflows[wf] = Workflow(wf, tasks)
+            except ImportError as err:
+                logger.warning(f"Skipping workflow {wf}, tasks can not be imported ({err})")
+        templates = [t for t in templates if t[1]['process']['workflow'] in _workflows]
+        if len(templates) == 0:
+            raise ValueError('No payloads with runnable workflows found')
+        queue_url, publish_queue_url = setup_aws(_workflows.keys())
+        feeder = load_module('feeders/stac-s3/feeder.py', 'feeder_stac_s3')
+        process_lambda = load_module('core/process/lambda_function.py', 'process_lambda')
+        publish_test = load_module('core/publish-test/lambda_function.py', 'publish_test')
+
+        logger.info(f"Generating {n} catalogs from {', '.join(f for f, _ in templates)}")
+        items = generate(templates, n, asset_size)
+
+        stats = {'feed': Stats(), 'process': Stats(), 'workflow': Stats()}
+        start = time.perf_counter()
+        feed(feeder, items, stats['feed'])
+        stats['feed'].peak_memory = peak_memory()
+        process(process_lambda, queue_url, stats['process'])
+        stats['process'].peak_memory = peak_memory()
+        run_workflows(_workflows, stats)
+        stats['workflow'].peak_memory = peak_memory()
+        elapsed = time.perf_counter() - start
+        latencies = latency(publish_test, publish_queue_url)
+
+    return {
+        'catalogs': n,
+        'workflows': sorted(_workflows.keys()),
+        'elapsed_sec': elapsed,
+        'catalogs_per_sec': n / elapsed,
+        'peak_memory_mb': peak_memory(),
+        'stages': {name: s.report() for name, s in stats.items()},
+        'latency': latencies
+    }
+
+
+def print_results(results):
+    fmt = lambda v, f: '-' if v is None else f.format(v)
+    print(f"{results['catalogs']} catalogs ({', '.join(results['workflows'])}) in {results['elapsed_sec']:.2f}s: "
+          f"{results['catalogs_per_sec']:.1f} catalogs/sec, peak memory {results['peak_memory_mb']:.1f} MB")
+    print(f"{'stage':<24}{'calls':>8}{'catalogs':>10}{'errors':>8}{'cat/sec':>10}{'p50 ms':>10}{'p95 ms':>10}{'peak MB':>10}")
+    for name, r in results['stages'].items():
+        print(f"{name:<24}{r['calls']:>8}{r['catalogs']:>10}{r['errors']:>8}{fmt(r['catalogs_per_sec'], '{:.1f}'):>10}"
+              f"{fmt(r['p50_ms'], '{:.2f}'):>10}{fmt(r['p95_ms'], '{:.2f}'):>10}{fmt(r['peak_memory_mb'], '{:.1f}'):>10}")
+    print(f"{'end-to-end latency':<40}{'items':>8}{'p50 s':>10}{'p95 s':>10}{'p99 s':>10}")
+    for r in results['latency']:
+        print(f"{r['collection'] + ' ' + r['workflow']:<40}{r['count']:>8}{r['p50']:>10.2f}{r['p95']:>10.2f}{r['p99']:>10.2f}")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description='Benchmark the Cirrus pipeline in-process')
+    parser.add_argument('-n', '--num', type=int, default=100, help='Number of catalogs')
+    parser.add_argument('--workflow', action='append', dest='workflows',
+                        help='Only use payloads of this workflow (can be repeated)')
+    parser.add_argument('--asset-size', type=int, default=1024, help='Size in bytes of each asset')
+    parser.add_argument('--output', help='Write results as JSON to this file')
+    args = parser.parse_args(sys.argv[1:])
+
+    results = benchmark(n=args.num, workflows=args.workflows, asset_size=args.asset_size)
+    print_results(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(json.dumps(results, indent=2))
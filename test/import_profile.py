@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+"""Import time profile of the Lambda handlers
+
+Imports each handler module (core Lambdas, feeders and tasks) in a fresh Python process, as in a
+cold start, against moto stand-ins for AWS, and reports how long the import took and the modules
+that took the longest to import.
+
+    $ python test/import_profile.py --output baseline.json
+
+Requires moto and the requirements of the handlers, handlers that can not be imported are reported
+with the error.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+from glob import glob
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'test'))
+
+from benchmark import ENVIRONMENT, load_module  # noqa: E402
+
+# handler modules, relative to the repository root
+HANDLERS = ['core/*/lambda_function.py', 'feeders/*/feeder.py', 'tasks/*/task.py']
+
+# written to stderr around the handler import, to find its lines in the -X importtime output
+MARKER = 'import-profile'
+
+
+def child(path):
+    """Import a handler module and print how long it took, run in its own process
+
+    boto3 is imported (and timed) before AWS is mocked, everything imported after is attributed
+    to the handler.
+
+    Args:
+        path (str): Path of the handler module, relative to the repository root
+    """
+    import time
+    os.environ.update(ENVIRONMENT)
+    # handlers are deployed with the modules next to them
+    sys.path.insert(0, os.path.join(ROOT, os.path.dirname(path)))
+
+    start = time.perf_counter()
+    import boto3  # noqa: F401
+    boto3_ms = (time.perf_counter() - start) * 1000
+
+    from moto import mock_aws
+    with mock_aws():
+        s3client = boto3.client('s3')
+        s3client.create_bucket(Bucket=ENVIRONMENT['CIRRUS_DATA_BUCKET'],
+                               CreateBucketConfiguration={'LocationConstraint': ENVIRONMENT['AWS_REGION']})
+        print(f"{MARKER}:start", file=sys.stderr, flush=True)
+        start = time.perf_counter()
+        error = None
+        try:
+            load_module(path, 'handler')
+        except Exception as err:
+            error = f"{type(err).__name__}: {err}"
+        import_ms = (time.perf_counter() - start) * 1000
+        print(f"{MARKER}:end", file=sys.stderr, flush=True)
+    print(json.dumps({'boto3_ms': boto3_ms, 'import_ms': import_ms, 'error': error}))
+
+
+def parse_importtime(stderr, top=5):
+    """Get the slowest top level imports of the handler from -X importtime output
+
+    Args:
+        stderr (str): stderr of the child process
+        top (int, optional): Number of modules. Defaults to 5.
+
+    Returns:
+        List[Tuple[str, float]]: Module names and cumulative import time in ms, slowest first
+    """
+    lines = stderr.splitlines()
+    try:
+        lines = lines[lines.index(f"{MARKER}:start") + 1:lines.index(f"{MARKER}:end")]
+    except ValueError:
+        return []
+    modules = []
+    for line in lines:
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        # nested imports are indented, only report the ones imported by the handler itself
+        if not cumulative.strip().isdigit() or name.startswith('   '):
+            continue
+        modules.append((name.strip(), int(cumulative) / 1000))
+    return sorted(modules, key=lambda m: -m[1])[:top]
+
+
+def profile(path, repeat=3):
+    """Profile the import of a handler module, keeping the fastest of several cold imports
+
+    Args:
+        path (str): Path of the handler module, relative to the repository root
+        repeat (int, optional): Number of imports. Defaults to 3.
+
+    Returns:
+        Dict: Import time in ms of boto3 and of the handler, its slowest imports, and import error if any
+    """
+    best = None
+    for i in range(repeat):
+        proc = subprocess.run([sys.executable, '-X', 'importtime', __file__, '--child', path],
+                              cwd=ROOT, capture_output=True, text=True)
+        if proc.returncode != 0:
+            return {'error': proc.stderr.strip().splitlines()[-1]}
+        result = json.loads(proc.stdout.strip().splitlines()[-1])
+        result['modules'] = parse_importtime(proc.stderr)
+        if best is None or result['import_ms'] < best['import_ms']:
+            best = result
+    return best
+
+
+def print_results(results):
+    print(f"{'handler':45} {'import ms':>10} {'boto3 ms':>9}  slowest imports")
+    for path, result in results.items():
+        if result.get('error'):
+            print(f"{path:45} {'-':>10} {'-':>9}  {result['error'][:80]}")
+            continue
+        modules = ', '.join(f"{name} {ms:.0f}" for name, ms in result['modules'])
+        print(f"{path:45} {result['import_ms']:10.1f} {result['boto3_ms']:9.1f}  {modules}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Profile import time of the Lambda handlers')
+    parser.add_argument('--handler', action='append', dest='handlers',
+                        help='Only profile this handler module (may be repeated)')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='Imports of each handler, the fastest is kept')
+    parser.add_argument('--output', help='Write results as JSON to this file')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child)
+        sys.exit(0)
+
+    paths = args.handlers or sorted(os.path.relpath(f, ROOT) for pattern in HANDLERS
+                                    for f in glob(os.path.join(ROOT, pattern)))
+    results = {path: profile(path, repeat=args.repeat) for path in paths}
+    print_results(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+"""S3 inventory reader benchmark
+
+Compares the row at a time and columnar readers of the `feed-s3-inventory` feeder on synthetic
+inventory files (gzipped CSV and ORC) in moto, with the filters of common payloads.
+
+    $ python test/inventory_benchmark.py -n 1000000 --output inventory.json
+
+Requires moto and the requirements of the feeder (pyorc, pyarrow).
+"""
+import argparse
+import gzip
+import io
+import json
+import logging
+import os
+import sys
+import time
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from benchmark import ENVIRONMENT, load_module, peak_memory  # noqa: E402
+
+BUCKET = 'cirrus-bench-inventory'
+KEYS = ['bucket', 'key', 'size', 'last_modified_date', 'e_tag']
+
+# filters of the payloads benchmarked
+FILTERS = {
+    'none': {},
+    'suffix': {'suffix': 'MTL.txt'},
+    'prefix+suffix': {'prefix': 'c1/L8/1', 'suffix': 'MTL.txt'},
+    'dates': {'start_date': '2020-03-01', 'end_date': '2020-06-30', 'datetime_key': 'last_modified_date'},
+    'regex dates': {'start_date': '2020-03-01', 'suffix': 'MTL.txt',
+                    'datetime_regex': r'.*?_(?P<Y>\d{4})(?P<m>\d{2})(?P<d>\d{2})_'},
+}
+
+# files of a synthetic Landsat like scene
+FILES = ['B1.TIF', 'B2.TIF', 'B3.TIF', 'B4.TIF', 'B5.TIF', 'BQA.TIF', 'ANG.txt', 'MTL.txt']
+
+logger = logging.getLogger('inventory-benchmark')
+
+
+def generate(n):
+    """Generate rows of a synthetic inventory
+
+    Args:
+        n (int): Number of rows
+
+    Returns:
+        List[Tuple]: Rows (bucket, key, size, last modified date, ETag)
+    """
+    rows = []
+    for i in range(n):
+        scene, f = divmod(i, len(FILES))
+        month, day = scene % 12 + 1, scene % 28 + 1
+        name = f"LC08_L1TP_{scene % 233:03d}{scene % 248:03d}_2020{month:02d}{day:02d}_20200101_01_T1"
+        key = f"c1/L8/{scene % 233:03d}/{scene % 248:03d}/{name}/{name}_{FILES[f]}"
+        rows.append((BUCKET, key, 1000 + i, datetime(2020, month, day, 12, tzinfo=timezone.utc), f"{i:032x}"))
+    return rows
+
+
+def write_inventory(s3client, rows):
+    """Write the rows as a gzipped CSV and an ORC inventory file
+
+    Returns:
+        Dict: s3 URL of the inventory file by format
+    """
+    import pyorc
+
+    csv = io.BytesIO()
+    with gzip.GzipFile(fileobj=csv, mode='wb') as gz:
+        for bucket, key, size, dt, etag in rows:
+            gz.write(f'"{bucket}","{key}","{size}","{dt.strftime("%Y-%m-%dT%H:%M:%S.000Z")}","{etag}"\n'.encode())
+    s3client.put_object(Bucket=BUCKET, Key='data/inventory.csv.gz', Body=csv.getvalue())
+
+    orc = io.BytesIO()
+    schema = 'struct<bucket:string,key:string,size:bigint,last_modified_date:timestamp,e_tag:string>'
+    with pyorc.Writer(orc, schema) as writer:
+        for row in rows:
+            writer.write(row)
+    s3client.put_object(Bucket=BUCKET, Key='data/inventory.orc', Body=orc.getvalue())
+
+    return {
+        'csv': f"s3://{BUCKET}/data/inventory.csv.gz",
+        'orc': f"s3://{BUCKET}/data/inventory.orc"
+    }
+
+
+def run(reader, url, filters):
+    """Read an inventory file with a reader, and return the number of matches and elapsed seconds"""
+    start = time.perf_counter()
+    matches = sum(1 for _ in reader(url, KEYS, **filters))
+    return matches, time.perf_counter() - start
+
+
+def benchmark(n=100000, formats=['csv', 'orc']):
+    """Benchmark the inventory readers
+
+    Args:
+        n (int, optional): Number of inventory rows. Defaults to 100000.
+        formats (List[str], optional): Inventory formats. Defaults to csv and orc.
+
+    Returns:
+        Dict: Matches, seconds and rows/sec of each reader, by format and filter
+    """
+    for key, val in ENVIRONMENT.items():
+        os.environ.setdefault(key, val)
+
+    import boto3
+    from moto import mock_aws
+
+    results = {}
+    with mock_aws():
+        s3client = boto3.client('s3')
+        s3client.create_bucket(Bucket=BUCKET, CreateBucketConfiguration={'LocationConstraint': ENVIRONMENT['AWS_REGION']})
+        logger.info(f"Generating inventory of {n} rows")
+        urls = write_inventory(s3client, generate(n))
+
+        feeder = load_module('feeders/s3-inventory/feeder.py', 'feeder_s3_inventory')
+        readers = {
+            'row': feeder.read_inventory_file,
+            # flatten chunks of URLs
+            'columnar': lambda *args, **kwargs: (u for c in feeder.read_inventory_file_columnar(*args, **kwargs)
+                                                 for u in c)
+        }
+        for fmt in formats:
+            for name, filters in FILTERS.items():
+                result = {}
+                for reader, func in readers.items():
+                    matches, elapsed = run(func, urls[fmt], filters)
+                    result[reader] = {'matches': matches, 'seconds': elapsed, 'rows_per_sec': n / elapsed}
+                if result['row']['matches'] != result['columnar']['matches']:
+                    logger.error(f"Readers disagree on {fmt} with {name} filter")
+                result['speedup'] = result['row']['seconds'] / result['columnar']['seconds']
+                results.setdefault(fmt, {})[name] = result
+
+    return {
+        'rows': n,
+        'peak_memory_mb': peak_memory(),
+        'results': results
+    }
+
+
+def print_results(results):
+    print(f"{results['rows']} inventory rows, peak memory {results['peak_memory_mb']:.1f} MB")
+    print(f"{'format':<8}{'filter':<16}{'matches':>10}{'row/sec':>14}{'columnar/sec':>14}{'speedup':>10}")
+    for fmt, filters in results['results'].items():
+        for name, r in filters.items():
+            print(f"{fmt:<8}{name:<16}{r['columnar']['matches']:>10}{r['row']['rows_per_sec']:>14.0f}"
+                  f"{r['columnar']['rows_per_sec']:>14.0f}{r['speedup']:>9.1f}x")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description='Benchmark the s3-inventory feeder readers')
+    parser.add_argument('-n', '--num', type=int, default=100000, help='Number of inventory rows')
+    parser.add_argument('--format', action='append', dest='formats', choices=['csv', 'orc'],
+                        help='Only benchmark this inventory format (can be repeated)')
+    parser.add_argument('--output', help='Write results as JSON to this file')
+    args = parser.parse_args(sys.argv[1:])
+
+    results = benchmark(n=args.num, formats=args.formats or ['csv', 'orc'])
+    print_results(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
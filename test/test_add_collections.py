@@ -0,0 +1,122 @@
+import boto3
+import json
+import os
+import sys
+import unittest
+from unittest.mock import patch
+
+from moto import mock_aws
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from benchmark import ENVIRONMENT, load_module  # noqa: E402
+
+for key, val in ENVIRONMENT.items():
+    os.environ.setdefault(key, val)
+
+DATA_BUCKET = ENVIRONMENT['CIRRUS_DATA_BUCKET']
+SOURCE_URL = 'https://example.com/stac/sentinel-s2-l2a/collection.json'
+
+collections = None
+
+
+def setUpModule():
+    global collections
+    # cirruslib reads the root catalog when imported
+    mock = mock_aws()
+    mock.start()
+    create_bucket()
+    collections = load_module('core/add-collections/lambda_function.py', 'lambda_add_collections')
+    mock.stop()
+
+
+def create_bucket():
+    boto3.client('s3').create_bucket(Bucket=DATA_BUCKET,
+                                     CreateBucketConfiguration={'LocationConstraint': ENVIRONMENT['AWS_REGION']})
+
+
+def make_collection(**fields):
+    """Create a source STAC Collection"""
+    collection = {
+        'type': 'Collection',
+        'stac_version': '1.0.0-beta.2',
+        'id': 'sentinel-s2-l2a',
+        'description': 'Sentinel-2 L2A',
+        'license': 'proprietary',
+        'extent': {
+            'spatial': {'bbox': [[-180, -90, 180, 90]]},
+            'temporal': {'interval': [['2015-06-27T10:25:31Z', None]]}
+        },
+        'links': [
+            {'rel': 'self', 'href': SOURCE_URL},
+            {'rel': 'root', 'href': '../catalog.json'},
+            {'rel': 'license', 'href': '../license.html'},
+            {'rel': 'child', 'href': './2020/catalog.json'}
+        ]
+    }
+    return dict(collection, **fields)
+
+
+class TestAddCollections(unittest.TestCase):
+
+    def setUp(self):
+        self.mock = mock_aws()
+        self.mock.start()
+        create_bucket()
+        self.s3 = boto3.client('s3')
+        # created by cirruslib when imported
+        self.s3.put_object(Bucket=DATA_BUCKET, Key='catalog.json', Body=json.dumps(collections.stac.ROOT_CATALOG.to_dict()))
+        self.patch = patch.object(collections.stac, 'snsclient')
+        self.sns = self.patch.start()
+
+    def tearDown(self):
+        self.patch.stop()
+        self.mock.stop()
+
+    def read(self, key):
+        return json.loads(self.s3.get_object(Bucket=DATA_BUCKET, Key=key)['Body'].read())
+
+    def add_with_cirruslib(self, collection):
+        """Add a collection to the root catalog as cirruslib.stac.add_collections does"""
+        root = collections.Catalog.from_file(f"{collections.stac.ROOT_URL}/catalog.json")
+        collection = collections.Collection.from_dict(collection, href=SOURCE_URL)
+        collection.remove_links('child')
+        collection.add_link(collections.Link('copied_from', collection))
+        root.add_child(collection)
+        for doc, key in [(collection.to_dict(), 'sentinel-s2-l2a/collection.json'), (root.to_dict(), 'catalog.json')]:
+            self.s3.put_object(Bucket=DATA_BUCKET, Key=key, Body=json.dumps(doc))
+
+    def test_new(self):
+        self.assertEqual(collections.add_collections([(SOURCE_URL, make_collection())]), ['sentinel-s2-l2a'])
+        copy = self.read('sentinel-s2-l2a/collection.json')
+        links = {link['rel']: link['href'] for link in copy['links']}
+        self.assertEqual(links['license'], 'https://example.com/stac/license.html')
+        self.assertEqual(links['copied_from'], SOURCE_URL)
+        self.assertEqual(links['self'], collections.collection_url('sentinel-s2-l2a'))
+        self.assertNotIn('child', links)
+        root = self.read('catalog.json')
+        self.assertEqual([link['href'] for link in root['links'] if link['rel'] == 'child'],
+                         [collections.collection_url('sentinel-s2-l2a')])
+        self.sns.publish.assert_called_once()
+
+    def test_unchanged(self):
+        self.add_with_cirruslib(make_collection())
+        self.assertEqual(collections.add_collections([(SOURCE_URL, make_collection())]), [])
+        # a copy written by add_collections is unchanged too
+        self.s3.delete_object(Bucket=DATA_BUCKET, Key='sentinel-s2-l2a/collection.json')
+        collections.add_collections([(SOURCE_URL, make_collection())])
+        self.assertEqual(collections.add_collections([(SOURCE_URL, make_collection())]), [])
+        self.sns.publish.assert_called_once()
+
+    def test_changed(self):
+        self.add_with_cirruslib(make_collection())
+        collection = make_collection(description='Sentinel-2 L2A COGs')
+        self.assertEqual(collections.add_collections([(SOURCE_URL, collection)]), ['sentinel-s2-l2a'])
+        self.assertEqual(self.read('sentinel-s2-l2a/collection.json')['description'], 'Sentinel-2 L2A COGs')
+        # already linked from the root catalog
+        root = self.read('catalog.json')
+        self.assertEqual(len([link for link in root['links'] if link['rel'] == 'child']), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
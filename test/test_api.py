@@ -0,0 +1,93 @@
+import json
+import os
+import sys
+import unittest
+from unittest.mock import MagicMock, patch
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from benchmark import ENVIRONMENT, load_module  # noqa: E402
+
+for key, val in ENVIRONMENT.items():
+    os.environ.setdefault(key, val)
+
+api = load_module('core/api/lambda_function.py', 'lambda_api')
+
+COLLECTIONS_WORKFLOW = 'sentinel-s2-l1c_publish-sentinel'
+LASTKEY = {'collections_workflow': COLLECTIONS_WORKFLOW, 'itemids': 'item1',
+           'state_updated': 'FAILED_2021-01-12T10:00:00+00:00'}
+
+
+def items_event(qparams=None, headers=None, legacy=False):
+    """Create an API Gateway event getting the items of a workflow"""
+    path = '/sentinel-s2-l1c/workflow-publish-sentinel/items'
+    return {
+        'httpMethod': 'GET',
+        'path': '/collections' + path if legacy else path,
+        'queryStringParameters': qparams,
+        'headers': headers or {}
+    }
+
+
+class TestCursor(unittest.TestCase):
+
+    def test_roundtrip(self):
+        cursor = api.encode_cursor(LASTKEY)
+        self.assertEqual(api.decode_cursor(cursor, COLLECTIONS_WORKFLOW), LASTKEY)
+
+    def test_invalid(self):
+        keys = [
+            ['not', 'a', 'key'],
+            dict(LASTKEY, updated='2021-01-12T10:00:00+00:00'),
+            {'collections_workflow': COLLECTIONS_WORKFLOW},
+            dict(LASTKEY, itemids={'S': 'item1'}),
+            dict(LASTKEY, collections_workflow='landsat-c1-l1_publish-landsat')
+        ]
+        for key in keys:
+            with self.assertRaises(ValueError):
+                api.decode_cursor(api.encode_cursor(key), COLLECTIONS_WORKFLOW)
+        with self.assertRaises(ValueError):
+            api.decode_cursor('not a cursor', COLLECTIONS_WORKFLOW)
+
+
+class TestItems(unittest.TestCase):
+
+    def setUp(self):
+        self.items = [{'catid': f"{COLLECTIONS_WORKFLOW}/item{i}", 'state': 'FAILED'} for i in range(2)]
+        statedb = MagicMock()
+        statedb.catid_to_key.return_value = {'collections_workflow': COLLECTIONS_WORKFLOW, 'itemids': 'items'}
+        statedb.key_to_catid.return_value = self.items[-1]['catid']
+        patches = [
+            patch.object(api, 'get_statedb', return_value=statedb),
+            patch.object(api, 'get_items_page', return_value=(self.items, LASTKEY)),
+            patch.object(api, 'to_legacy', side_effect=lambda item: {'id': item['catid']})
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+
+    def test_unpaged(self):
+        resp = api.lambda_handler(items_event({'state': 'FAILED'}), None)
+        self.assertEqual(json.loads(resp['body']), self.items)
+        self.assertEqual(api.get_items_page.call_args[1]['limit'], api.UNPAGED_LIMIT)
+
+    def test_unpaged_legacy(self):
+        resp = api.lambda_handler(items_event(legacy=True), None)
+        self.assertEqual(json.loads(resp['body']), [{'id': item['catid']} for item in self.items])
+
+    def test_limit(self):
+        resp = api.lambda_handler(items_event({'limit': '2'}), None)
+        page = json.loads(resp['body'])
+        self.assertEqual(page['items'], self.items)
+        self.assertEqual(api.decode_cursor(page['cursor'], COLLECTIONS_WORKFLOW), LASTKEY)
+        self.assertEqual(api.get_items_page.call_args[1]['limit'], 2)
+
+    def test_ndjson(self):
+        resp = api.lambda_handler(items_event(headers={'Accept': 'application/x-ndjson'}), None)
+        self.assertEqual([json.loads(line) for line in resp['body'].splitlines()], self.items)
+        self.assertIn('rel="next"', resp['headers']['Link'])
+        self.assertEqual(api.get_items_page.call_args[1]['limit'], api.PAGE_SIZE)
+
+
+if __name__ == '__main__':
+    unittest.main()
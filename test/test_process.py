@@ -0,0 +1,246 @@
+import json
+import os
+import sys
+import unittest
+from unittest.mock import MagicMock, patch
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from benchmark import ENVIRONMENT, load_module  # noqa: E402
+
+for key, val in ENVIRONMENT.items():
+    os.environ.setdefault(key, val)
+
+process = load_module('core/process/lambda_function.py', 'lambda_process')
+
+
+def make_catalog(itemid, collection='sentinel-s2-l1c', workflow='publish-sentinel', max_features=20):
+    """Create a single Item Input Catalog with an auto-assigned ID"""
+    return process.Catalog({
+        'type': 'FeatureCollection',
+        'features': [{'type': 'Feature', 'id': itemid, 'collection': collection, 'properties': {}, 'assets': {}}],
+        'process': {
+            'workflow': workflow,
+            'output_options': {},
+            'tasks': {},
+            'max_features': max_features
+        }
+    }, update=True)
+
+
+class TestGroupCatalogs(unittest.TestCase):
+
+    def test_group(self):
+        catalogs = [([f"msg{i}"], make_catalog(f"item{i}"), False) for i in range(3)]
+        groups = process.group_catalogs(catalogs)
+        self.assertEqual(len(groups), 1)
+        msgids, cat, replace, members = groups[0]
+        self.assertEqual(msgids, ['msg0', 'msg1', 'msg2'])
+        self.assertEqual(cat['id'], 'sentinel-s2-l1c/workflow-publish-sentinel/item0/item1/item2')
+        self.assertEqual([f['id'] for f in cat['features']], ['item0', 'item1', 'item2'])
+        self.assertEqual(cat['process']['members'], [c['id'] for c in members])
+        self.assertFalse(replace)
+
+    def test_not_grouped(self):
+        catalogs = [
+            (['msg0'], make_catalog('item0', max_features=1), False),
+            (['msg1'], make_catalog('item1'), True),
+            (['msg2'], make_catalog('item2', workflow='publish-only'), False),
+            (['msg3'], make_catalog('item3'), False),
+        ]
+        groups = process.group_catalogs(catalogs)
+        self.assertEqual(sorted(cat['id'] for _, cat, _, _ in groups), sorted(cat['id'] for _, cat, _ in catalogs))
+        for _, cat, _, members in groups:
+            self.assertEqual(members, [cat])
+            self.assertNotIn('members', cat['process'])
+
+    def test_max_features(self):
+        catalogs = [([f"msg{i}"], make_catalog(f"item{i}", max_features=2), False) for i in range(5)]
+        groups = process.group_catalogs(catalogs)
+        self.assertEqual([len(cat['features']) for _, cat, _, _ in groups], [2, 2, 1])
+
+    def test_itemids_max_size(self):
+        itemid = 'x' * 300
+        catalogs = [([f"msg{i}"], make_catalog(f"{itemid}{i}"), False) for i in range(7)]
+        groups = process.group_catalogs(catalogs)
+        # 3 IDs of 301 bytes and separators fit in 1024 bytes, 4 do not
+        self.assertEqual([len(cat['features']) for _, cat, _, _ in groups], [3, 3, 1])
+        for _, cat, _, _ in groups:
+            itemids = cat['id'].split('/', maxsplit=2)[-1]
+            self.assertLessEqual(len(itemids.encode('utf-8')), process.ITEMIDS_MAX_SIZE)
+
+    def test_created(self):
+        catalogs = [([f"msg{i}"], make_catalog(f"item{i}"), False) for i in range(2)]
+        catalogs[0][1]['process']['created'] = '2020-01-02T00:00:00Z'
+        catalogs[1][1]['process']['created'] = '2020-01-01T00:00:00Z'
+        groups = process.group_catalogs(catalogs)
+        self.assertEqual(groups[0][1]['process']['created'], '2020-01-01T00:00:00Z')
+
+
+class ConditionalCheckFailed(Exception):
+    pass
+
+
+class TestStartWorkflow(unittest.TestCase):
+
+    def setUp(self):
+        self.statedb = MagicMock()
+        self.statedb.db.meta.client.exceptions.ConditionalCheckFailedException = ConditionalCheckFailed
+        self.sfnclient = MagicMock()
+        self.sfnclient.start_execution.return_value = {'executionArn': 'arn'}
+        self.patches = [patch.object(process, 'get_statedb', return_value=self.statedb), patch.object(process, 's3client'),
+                        patch.object(process, 'sfnclient', self.sfnclient)]
+        for p in self.patches:
+            p.start()
+        members = [([f"msg{i}"], make_catalog(f"item{i}"), False) for i in range(3)]
+        _, self.catalog, _, self.members = process.group_catalogs(members)[0]
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+
+    def test_started(self):
+        self.assertEqual(process.start_workflow(self.catalog, self.members), self.catalog['id'])
+        catids = [self.catalog['id']] + [c['id'] for c in self.members]
+        self.assertEqual([c[0][0] for c in self.statedb.claim_processing.call_args_list], catids)
+        self.assertEqual([c[0] for c in self.statedb.set_processing.call_args_list], [(c, 'arn') for c in catids])
+        self.sfnclient.start_execution.assert_called_once()
+        # the group is marked with its members
+        self.assertEqual(self.statedb.table.update_item.call_args[1]['ExpressionAttributeValues'],
+                         {':members': catids[1:]})
+
+    def test_member_processing(self):
+        def claim(catid):
+            if catid == self.members[1]['id']:
+                raise ConditionalCheckFailed()
+        self.statedb.claim_processing.side_effect = claim
+        with self.assertRaises(ConditionalCheckFailed):
+            process.start_workflow(self.catalog, self.members)
+        self.sfnclient.start_execution.assert_not_called()
+        # the member being processed is left alone
+        failed = [c[0][0] for c in self.statedb.set_failed.call_args_list]
+        self.assertEqual(failed, [self.catalog['id'], self.members[0]['id']])
+
+    def test_single(self):
+        catalog = make_catalog('item0', max_features=1)
+        self.assertEqual(process.start_workflow(catalog), catalog['id'])
+        self.statedb.claim_processing.assert_called_once_with(catalog['id'])
+        self.statedb.set_processing.assert_called_once_with(catalog['id'], 'arn')
+        self.statedb.table.update_item.assert_not_called()
+
+    def test_group_processing(self):
+        self.statedb.claim_processing.side_effect = ConditionalCheckFailed()
+        self.assertIsNone(process.start_workflow(self.catalog, self.members))
+        self.statedb.set_failed.assert_not_called()
+
+
+class TestRateLimit(unittest.TestCase):
+
+    def setUp(self):
+        from moto import mock_aws
+        import boto3
+        self.mock = mock_aws()
+        self.mock.start()
+        table = boto3.resource('dynamodb').create_table(
+            TableName='rate-limit', BillingMode='PAY_PER_REQUEST',
+            KeySchema=[{'AttributeName': 'bucket', 'KeyType': 'HASH'}],
+            AttributeDefinitions=[{'AttributeName': 'bucket', 'AttributeType': 'S'}])
+        self.patches = [patch.object(process, 'ratelimitdb', table), patch.object(process.time, 'time', return_value=1000.5)]
+        for p in self.patches:
+            p.start()
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+        self.mock.stop()
+
+    def test_reserve_following_windows(self):
+        granted, delays = process.acquire('test', 25, 10)
+        self.assertEqual(granted, 10)
+        # reserved in the next two windows, spread within each
+        self.assertEqual([round(d, 1) for d, _ in delays], [round(0.5 + i / 10, 1) for i in range(15)])
+        self.assertTrue(all(r for _, r in delays))
+        # later claims are reserved after them
+        granted, delays = process.acquire('test', 6, 10)
+        self.assertEqual(granted, 0)
+        self.assertEqual([round(d, 1) for d, _ in delays], [2.0, 2.1, 2.2, 2.3, 2.4, 2.5])
+
+    @patch.object(process, 'MAX_DELAY', 20)
+    def test_max_delay(self):
+        granted, delays = process.acquire('test', 100, 1)
+        self.assertEqual(granted, 1)
+        reserved = [d for d, r in delays if r]
+        self.assertEqual(len(reserved), process.MAX_DELAY)
+        self.assertLessEqual(max(reserved), process.MAX_DELAY)
+        # the rest are not all requeued with the same delay
+        self.assertGreater(len(set(d for d, r in delays if not r)), 1)
+
+    def test_reserved_messages_admitted(self):
+        catalogs = [([f"msg{i}"], make_catalog(f"item{i}", max_features=1), False, []) for i in range(3)]
+        with patch.object(process, 'get_rate_limits', return_value={'test': 1}):
+            admitted, deferred = process.rate_limit(catalogs, reserved={'msg1', 'msg2'})
+        self.assertEqual(sorted(c[0][0] for c in admitted), ['msg0', 'msg1', 'msg2'])
+        self.assertEqual(deferred, [])
+
+
+class TestHandler(unittest.TestCase):
+
+    def record(self, msgid, catalog):
+        return {
+            'messageId': msgid,
+            'body': json.dumps({'Message': json.dumps(catalog), 'Timestamp': '2020-01-01T00:00:00Z'})
+        }
+
+    def test_skip_processed_members(self):
+        catalogs = [make_catalog(f"item{i}") for i in range(3)]
+        payload = {'Records': [self.record(f"msg{i}", cat) for i, cat in enumerate(catalogs)]}
+        states = {catalogs[1]['id']: 'COMPLETED'}
+        with patch.object(process, 'get_states', return_value=states) as get_states, \
+             patch.object(process, 'dispatch', return_value=None) as dispatch:
+            resp = process.lambda_handler(payload, None)
+        self.assertEqual(resp['batchItemFailures'], [])
+        # states are looked up by the catalogs that are grouped
+        self.assertEqual(sorted(get_states.call_args[0][0]), sorted(c['id'] for c in catalogs))
+        dispatch.assert_called_once()
+        cat = dispatch.call_args[0][0]
+        self.assertEqual(cat['process']['members'], [catalogs[0]['id'], catalogs[2]['id']])
+
+    def test_partial_batch_failures(self):
+        catalogs = [make_catalog(f"item{i}", max_features=1) for i in range(3)]
+        payload = {'Records': [self.record(f"msg{i}", cat) for i, cat in enumerate(catalogs)]}
+        # a message that can not be parsed
+        payload['Records'].append({'messageId': 'msg3', 'body': 'not json'})
+
+        def dispatch(catalog, state, replace=False, members=[]):
+            if catalog['id'] == catalogs[1]['id']:
+                raise Exception('failed starting workflow')
+            return catalog['id']
+
+        with patch.object(process, 'get_states', return_value={}), \
+             patch.object(process, 'dispatch', side_effect=dispatch):
+            resp = process.lambda_handler(payload, None)
+        # only the failed messages are returned to the queue
+        self.assertEqual(resp['batchItemFailures'], [{'itemIdentifier': 'msg1'}, {'itemIdentifier': 'msg3'}])
+
+    def test_group_failure(self):
+        catalogs = [make_catalog(f"item{i}") for i in range(2)] + [make_catalog('item2', max_features=1)]
+        payload = {'Records': [self.record(f"msg{i}", cat) for i, cat in enumerate(catalogs)]}
+
+        def dispatch(catalog, state, replace=False, members=[]):
+            if len(members) > 1:
+                raise Exception('failed starting workflow')
+            return catalog['id']
+
+        with patch.object(process, 'get_states', return_value={}), \
+             patch.object(process, 'dispatch', side_effect=dispatch):
+            resp = process.lambda_handler(payload, None)
+        # all messages of a failed group are returned to the queue
+        self.assertEqual(resp['batchItemFailures'], [{'itemIdentifier': 'msg0'}, {'itemIdentifier': 'msg1'}])
+
+    def test_not_sqs(self):
+        with self.assertRaises(ValueError):
+            process.lambda_handler({}, None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from benchmark import ENVIRONMENT, load_module  # noqa: E402
+
+for key, val in ENVIRONMENT.items():
+    os.environ.setdefault(key, val)
+
+publish = load_module('tasks/publish/task.py', 'task_publish')
+
+PREFIX = 'sentinel-s2-l2a-aws/workflow-publish-sentinel'
+
+
+def make_catalog(itemids, **process):
+    """Create a grouped catalog with the given output Items"""
+    return {
+        'id': f"{PREFIX}/a/b",
+        'features': [{'id': itemid} for itemid in itemids],
+        'process': dict(members=[f"{PREFIX}/a", f"{PREFIX}/b"], **process)
+    }
+
+
+class TestMemberOutputs(unittest.TestCase):
+
+    def test_same_ids(self):
+        catalog = make_catalog(['a', 'b'])
+        outputs = publish.member_outputs(catalog, ['s3://data/a.json', 's3://data/b.json'])
+        self.assertEqual(outputs, {f"{PREFIX}/a": ['s3://data/a.json'], f"{PREFIX}/b": ['s3://data/b.json']})
+
+    def test_sources(self):
+        # Items created from the input Items, one of them invalid
+        catalog = make_catalog(['a-L2A', 'a-L1C'], sources={'a-L2A': f"{PREFIX}/a", 'a-L1C': f"{PREFIX}/a"},
+                               invalid={f"{PREFIX}/b": 'no tileInfo'})
+        outputs = publish.member_outputs(catalog, ['s3://data/a-L2A.json', 's3://data/a-L1C.json'])
+        self.assertEqual(outputs, {f"{PREFIX}/a": ['s3://data/a-L2A.json', 's3://data/a-L1C.json'],
+                                   f"{PREFIX}/b": []})
+
+    def test_not_grouped(self):
+        catalog = {'id': f"{PREFIX}/a", 'features': [{'id': 'a'}], 'process': {}}
+        self.assertEqual(publish.member_outputs(catalog, ['s3://data/a.json']), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,335 @@
+import gzip
+import hashlib
+import json
+import os
+import sys
+import unittest
+from unittest.mock import MagicMock, patch
+
+import boto3
+from moto import mock_aws
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from benchmark import ENVIRONMENT, load_module  # noqa: E402
+
+for key, val in ENVIRONMENT.items():
+    os.environ.setdefault(key, val)
+
+feeder = load_module('feeders/s3-inventory/feeder.py', 'feeder_s3_inventory')
+
+CATALOG_BUCKET = ENVIRONMENT['CIRRUS_CATALOG_BUCKET']
+PROCESS = {'input_collections': ['test'], 'workflow': 'publish-only'}
+
+
+def published_ids(sns):
+    """IDs of the catalogs published with a mocked SNS client"""
+    return [json.loads(c[1]['Message'])['features'][0]['id'] for c in sns.publish.call_args_list]
+
+
+class TestCheckpoint(unittest.TestCase):
+
+    def setUp(self):
+        self.mock = mock_aws()
+        self.mock.start()
+        self.s3 = boto3.client('s3')
+        self.s3.create_bucket(Bucket=CATALOG_BUCKET,
+                              CreateBucketConfiguration={'LocationConstraint': ENVIRONMENT['AWS_REGION']})
+        self.env = patch.dict(os.environ, {'AWS_BATCH_JOB_ID': 'job1'})
+        self.env.start()
+        self.urls = [f"s3://src/data/scene{i}/B{b}.TIF" for i in range(10) for b in range(2)]
+
+    def tearDown(self):
+        self.env.stop()
+        self.mock.stop()
+
+    def checkpoints(self):
+        return self.s3.list_objects_v2(Bucket=CATALOG_BUCKET, Prefix='checkpoints/').get('KeyCount')
+
+    def test_resume(self):
+        sns = MagicMock()
+        # interrupted while publishing the 5th catalog
+        sns.publish.side_effect = [None] * 4 + [Exception('interrupted')]
+        with patch.object(feeder, 'SNS_CLIENT', sns):
+            with self.assertRaises(Exception):
+                feeder.feed_urls(iter(self.urls), PROCESS, checkpoint=feeder.Checkpoint('file', interval=0))
+        fed = published_ids(sns)[:4]
+
+        # a retried job skips the catalogs already fed
+        checkpoint = feeder.Checkpoint('file', interval=0)
+        self.assertEqual(checkpoint.offset, 4)
+        sns = MagicMock()
+        with patch.object(feeder, 'SNS_CLIENT', sns):
+            count = feeder.feed_urls(iter(self.urls), PROCESS, checkpoint=checkpoint)
+        # counted with the catalogs fed before the retry
+        self.assertEqual(count, 10)
+        self.assertEqual(fed + published_ids(sns), [f"data-scene{i}" for i in range(10)])
+
+    def test_done(self):
+        checkpoint = feeder.Checkpoint('s3://inv/data/0.csv.gz')
+        checkpoint.offset = 10
+        checkpoint.complete([['s3://src/data/scene0/B0.TIF']])
+        # a completed file is not read again, and returns its count and the directories at its edges
+        with patch.object(feeder, 'read_inventory_file_columnar') as read:
+            count, edges = feeder.feed_inventory_file('s3://inv/data/0.csv.gz', ['Bucket', 'Key'], PROCESS)
+        self.assertEqual(count, 10)
+        self.assertEqual(edges, [['s3://src/data/scene0/B0.TIF']])
+        read.assert_not_called()
+
+    def test_interval(self):
+        checkpoint = feeder.Checkpoint('file', interval=3600)
+        checkpoint.update(5)
+        self.assertEqual(self.checkpoints(), 0)
+        checkpoint.complete()
+        self.assertEqual(self.checkpoints(), 1)
+
+    def test_clear(self):
+        for name in ['file1', 'file2']:
+            feeder.Checkpoint(name).complete()
+        self.assertEqual(self.checkpoints(), 2)
+        feeder.clear_checkpoints()
+        self.assertEqual(self.checkpoints(), 0)
+
+    def test_not_batch(self):
+        del os.environ['AWS_BATCH_JOB_ID']
+        checkpoint = feeder.Checkpoint('file', interval=0)
+        checkpoint.update(5)
+        checkpoint.complete()
+        self.assertEqual(self.checkpoints(), 0)
+        self.assertEqual(feeder.Checkpoint('file').offset, 0)
+
+
+class TestDiffInventory(unittest.TestCase):
+
+    def test_diff(self):
+        previous = [('a/0', '1', 'e1', 'src'), ('b/0', '1', 'e1', 'src'), ('c/0', '1', 'e1', 'src'),
+                    ('d/0', '1', 'e1', 'src')]
+        current = [('a/0', '1', 'e1', 'src'), ('b/0', '2', 'e1', 'src'), ('c/0', '1', 'e2', 'src'),
+                   ('c2/0', '1', 'e1', 'src'), ('e/0', '1', 'e1', 'src')]
+        # modified size or ETag, and added keys, deleted keys are ignored
+        self.assertEqual([e[0] for e in feeder.diff_inventory(iter(current), iter(previous))],
+                         ['b/0', 'c/0', 'c2/0', 'e/0'])
+
+    def test_no_previous(self):
+        current = [('a', '1', 'e1', 'src'), ('b', '1', 'e1', 'src')]
+        self.assertEqual(list(feeder.diff_inventory(iter(current), iter([]))), current)
+        self.assertEqual(list(feeder.diff_inventory(iter([]), iter(current))), [])
+
+    def test_directories(self):
+        previous = [('x/a', '1', 'e1', 'src'), ('x/b', '1', 'e1', 'src'), ('y/a', '1', 'e1', 'src'),
+                    ('y/b', '1', 'e1', 'src'), ('z/a', '1', 'e1', 'src')]
+        current = [('x/a', '1', 'e1', 'src'), ('x/b', '2', 'e1', 'src'), ('y/a', '1', 'e1', 'src'),
+                   ('y/b', '1', 'e1', 'src'), ('z/a', '1', 'e1', 'src'), ('z/b', '1', 'e1', 'src')]
+        # every key of a directory with a modified or added key, so its Item has all assets
+        self.assertEqual([e[0] for e in feeder.diff_inventory(iter(current), iter(previous))],
+                         ['x/a', 'x/b', 'z/a', 'z/b'])
+
+
+class TestMergeInventory(unittest.TestCase):
+
+    def setUp(self):
+        self.mock = mock_aws()
+        self.mock.start()
+        self.s3 = boto3.client('s3')
+        self.s3.create_bucket(Bucket=CATALOG_BUCKET,
+                              CreateBucketConfiguration={'LocationConstraint': ENVIRONMENT['AWS_REGION']})
+        self.patch = patch.object(feeder, 'S3_CLIENT', self.s3)
+        self.patch.start()
+        # files with overlapping key ranges
+        self.files = {f"s3://inv/data/{i}.csv.gz": [(f"key{j:03d}", '1', None, 'src') for j in range(i, 100, 7)]
+                      for i in range(7)}
+        self.opened = []
+        self.open = 0
+
+    def tearDown(self):
+        self.patch.stop()
+        self.mock.stop()
+
+    def read(self, url):
+        self.open += 1
+        self.opened.append(self.open)
+        yield from self.files[url]
+        self.open -= 1
+
+    def test_merge(self):
+        entries = feeder.merge_inventory(list(self.files), self.read, 'current', max_files=7)
+        self.assertEqual([e[0] for e in entries], [f"key{j:03d}" for j in range(100)])
+
+    def test_bounded(self):
+        entries = list(feeder.merge_inventory(list(self.files), self.read, 'current', max_files=2))
+        self.assertEqual(entries, sorted(e for f in self.files.values() for e in f))
+        self.assertLessEqual(max(self.opened), 2)
+        # runs are deleted once read
+        self.assertEqual(self.s3.list_objects_v2(Bucket=CATALOG_BUCKET).get('KeyCount'), 0)
+
+
+class TestEdges(unittest.TestCase):
+
+    def test_inner_urls(self):
+        urls = [f"s3://src/scene{i}/B{b}.TIF" for i in range(4) for b in range(2)]
+        edges = []
+        self.assertEqual(list(feeder.inner_urls(iter(urls), edges)), urls[2:6])
+        self.assertEqual(edges, [urls[:2], urls[6:]])
+
+    def test_one_directory(self):
+        urls = ['s3://src/scene0/B0.TIF', 's3://src/scene0/B1.TIF']
+        edges = []
+        self.assertEqual(list(feeder.inner_urls(iter(urls), edges)), [])
+        self.assertEqual(edges, [urls])
+        self.assertEqual(list(feeder.inner_urls(iter([]), edges)), [])
+
+    def test_split_directory(self):
+        # scene1 continues in the second file
+        files = {
+            's3://inv/data/0.csv.gz': ['s3://src/scene0/B0.TIF', 's3://src/scene1/B0.TIF', 's3://src/scene1/B1.TIF'],
+            's3://inv/data/1.csv.gz': ['s3://src/scene1/B2.TIF', 's3://src/scene2/B0.TIF', 's3://src/scene3/B0.TIF']
+        }
+        sns = MagicMock()
+        with patch.object(feeder, 'SNS_CLIENT', sns), \
+             patch.object(feeder, 'read_inventory_file_columnar', side_effect=lambda url, keys: [files[url]]):
+            results = [feeder.feed_inventory_file(url, ['Bucket', 'Key'], PROCESS) for url in files]
+            count = feeder.feed_edges([url for _, edges in results for group in edges for url in group], PROCESS)
+        self.assertEqual([n for n, _ in results], [0, 1])
+        self.assertEqual(count, 3)
+        catalogs = [json.loads(c[1]['Message'])['features'][0] for c in sns.publish.call_args_list]
+        self.assertEqual(sorted(item['id'] for item in catalogs), ['scene0', 'scene1', 'scene2', 'scene3'])
+        # published once, with the assets of both files
+        scene1 = [item for item in catalogs if item['id'] == 'scene1'][0]
+        self.assertEqual(sorted(scene1['assets']), ['B0', 'B1', 'B2'])
+
+    def test_sort_by_directory(self):
+        urls = ['s3://src/a/b/2.TIF', 's3://src/a/b/1/x.TIF', 's3://src/a/b/1.TIF']
+        sns = MagicMock()
+        with patch.object(feeder, 'SNS_CLIENT', sns):
+            self.assertEqual(feeder.feed_edges(urls, PROCESS), 2)
+
+
+class TestPlanShards(unittest.TestCase):
+
+    def test_balanced(self):
+        files = [(f"s3://inv/data/{i}.csv.gz", size) for i, size in enumerate([90, 10, 50, 40, 30, 30, 20, 30])]
+        shards = feeder.plan_shards(files, 100)
+        self.assertEqual(len(shards), 3)
+        sizes = [sum(dict(files)[url] for url in shard) for shard in shards]
+        self.assertEqual(sum(sizes), 300)
+        # largest shard first, differing by at most the size of a file
+        self.assertEqual(sizes, sorted(sizes, reverse=True))
+        self.assertLessEqual(sizes[0] - sizes[-1], 90)
+        self.assertEqual(sorted(url for shard in shards for url in shard), sorted(url for url, _ in files))
+
+    def test_max_files(self):
+        files = [(f"s3://inv/data/{i}.csv.gz", 1) for i in range(10)]
+        self.assertEqual([len(shard) for shard in feeder.plan_shards(files, 100)], [10])
+        self.assertEqual([len(shard) for shard in feeder.plan_shards(files, 100, max_files=3)], [3, 3, 2, 2])
+
+    def test_large_file(self):
+        # no more shards than files
+        files = [('s3://inv/data/0.orc', 1000), ('s3://inv/data/1.orc', 10)]
+        self.assertEqual(feeder.plan_shards(files, 100), [['s3://inv/data/0.orc'], ['s3://inv/data/1.orc']])
+
+    def test_empty(self):
+        self.assertEqual(feeder.plan_shards([], 100), [])
+
+
+class TestSubmit(unittest.TestCase):
+
+    def submit(self, sizes):
+        manifest = {'fileSchema': 'Bucket, Key', 'files': [{'key': f"data/{i}.csv.gz", 'size': size}
+                                                           for i, size in enumerate(sizes)]}
+        session = MagicMock()
+        session.urlparse.return_value = {'bucket': 'inv', 'key': 'src'}
+        session.latest_inventory_manifest.return_value = manifest
+        context = MagicMock(invoked_function_arn='arn:aws:lambda:us-west-2:123456789012:function:feed-s3-inventory')
+        with patch.object(feeder, 's3', return_value=session), \
+             patch.object(feeder, 'submit_batch_job', return_value='job1') as submit:
+            feeder.handler({'inventory_url': 's3://inv/src', 'process': PROCESS, 'shard_duration': 1,
+                            'throughput': 100, 'vcpus': 1}, context)
+        return submit.call_args_list
+
+    def test_edges_job(self):
+        calls = self.submit([100, 100, 100])
+        self.assertEqual(calls[0][1]['array_size'], 3)
+        # the directories at the edges of the shards are fed after all shards
+        payload = calls[1][0][0]
+        self.assertEqual(payload['edges'], feeder.edges_url('job1'))
+        self.assertEqual(calls[1][1]['depends_on'], ['job1'])
+
+    def test_single_job(self):
+        calls = self.submit([100])
+        self.assertEqual(len(calls), 1)
+        self.assertIsNone(calls[0][1]['array_size'])
+
+
+class TestCatalogIds(unittest.TestCase):
+
+    def setUp(self):
+        self.mock = mock_aws()
+        self.mock.start()
+        self.s3 = boto3.client('s3')
+        self.s3.create_bucket(Bucket=CATALOG_BUCKET,
+                              CreateBucketConfiguration={'LocationConstraint': ENVIRONMENT['AWS_REGION']})
+
+    def tearDown(self):
+        self.mock.stop()
+
+    def manifests(self, prefix):
+        bucket, key = prefix[len('s3://'):].split('/', 1)
+        keys = [o['Key'] for o in self.s3.list_objects_v2(Bucket=bucket, Prefix=key).get('Contents', [])]
+        return {k: gzip.decompress(self.s3.get_object(Bucket=bucket, Key=k)['Body'].read()).decode().splitlines()
+                for k in keys}
+
+    def test_manifest_per_file(self):
+        prefix = feeder.catids_prefix()
+        files = {'s3://inv/data/0.csv.gz': ['s3://src/a/B1.TIF', 's3://src/b/B1.TIF', 's3://src/c/B1.TIF'],
+                 's3://inv/data/1.csv.gz': ['s3://src/d/B1.TIF']}
+        with patch.object(feeder, 'SNS_CLIENT'), \
+             patch.object(feeder, 'read_inventory_file_columnar', side_effect=lambda url, keys: [files[url]]):
+            counts = [feeder.feed_inventory_file(url, ['Bucket', 'Key'], PROCESS, catids_prefix=prefix)
+                      for url in files]
+        self.assertEqual([n for n, _ in counts], [1, 0])
+        # each file writes its own manifest under the prefix
+        manifests = self.manifests(prefix)
+        self.assertEqual(len(manifests), 2)
+        ids = sorted(json.loads(line)['id'] for lines in manifests.values() for line in lines)
+        # the first and last directories of a file are fed with those of other files
+        self.assertEqual(ids, ['b'])
+
+    def test_abort(self):
+        prefix = feeder.catids_prefix()
+        with self.assertRaises(ValueError):
+            with feeder.catalog_ids(prefix, 'file') as catids:
+                catids.append('id')
+                raise ValueError()
+        # no partial manifest is written
+        self.assertEqual(self.manifests(prefix), {})
+
+    def test_resume(self):
+        with patch.dict(os.environ, {'AWS_BATCH_JOB_ID': 'job1:2', 'AWS_BATCH_JOB_ARRAY_INDEX': '2'}):
+            # a retried job writes to the same prefix
+            prefix = feeder.catids_prefix()
+            self.assertEqual(prefix, f"s3://{CATALOG_BUCKET}/feeds/feed-s3-inventory/job1:2/catids/")
+            urls = [f"s3://src/data/scene{i}/B0.TIF" for i in range(10)]
+            sns = MagicMock()
+            # interrupted while publishing the 5th catalog
+            sns.publish.side_effect = [None] * 4 + [Exception('interrupted')]
+            with patch.object(feeder, 'SNS_CLIENT', sns), self.assertRaises(Exception):
+                checkpoint = feeder.Checkpoint('file', interval=0)
+                with feeder.catalog_ids(prefix, 'file', checkpoint=checkpoint) as catids:
+                    feeder.feed_urls(iter(urls), PROCESS, checkpoint=checkpoint, catids=catids)
+            # a terminated job leaves the upload of the segment it was writing incomplete
+            key = f"{prefix[len(f's3://{CATALOG_BUCKET}/'):]}{hashlib.md5(b'file').hexdigest()}-000000000004.ndjson.gz"
+            self.s3.create_multipart_upload(Bucket=CATALOG_BUCKET, Key=key)
+
+            checkpoint = feeder.Checkpoint('file', interval=0)
+            with patch.object(feeder, 'SNS_CLIENT'):
+                with feeder.catalog_ids(prefix, 'file', checkpoint=checkpoint) as catids:
+                    count = feeder.feed_urls(iter(urls), PROCESS, checkpoint=checkpoint, catids=catids)
+        self.assertEqual(count, 10)
+        # the manifest has the catalogs fed before and after the retry, and the incomplete upload is aborted
+        ids = sorted(json.loads(line)['id'] for lines in self.manifests(prefix).values() for line in lines)
+        self.assertEqual(ids, [f"data-scene{i}" for i in range(10)])
+        self.assertEqual(self.s3.list_multipart_uploads(Bucket=CATALOG_BUCKET).get('Uploads', []), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+import os
+import sys
+import unittest
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from benchmark import ENVIRONMENT, load_module  # noqa: E402
+
+for key, val in ENVIRONMENT.items():
+    os.environ.setdefault(key, val)
+
+stats = load_module('core/stats/lambda_function.py', 'lambda_stats')
+durations = sys.modules['durations']
+
+
+def record(seq, catid, state, updated, old=None, workflow='sentinel-s2-l1c_publish-sentinel'):
+    """Create a state db stream record of a state change"""
+    image = {
+        'id': {'S': catid},
+        'collections_workflow': {'S': workflow},
+        'state_updated': {'S': f"{state}_{updated}"},
+        'created': {'S': '2021-01-12T10:00:00+00:00'}
+    }
+    rec = {'eventName': 'MODIFY', 'dynamodb': {'SequenceNumber': str(seq), 'NewImage': image}}
+    if old is not None:
+        rec['dynamodb']['OldImage'] = dict(image, state_updated={'S': old})
+    return rec
+
+
+class TestDurations(unittest.TestCase):
+
+    def test_bins(self):
+        self.assertEqual(durations.duration_bin(0.5), 'd0_0')
+        self.assertEqual(durations.duration_bin(1), 'd0_0')
+        self.assertEqual(durations.duration_bin(8), 'd3_0')
+        self.assertEqual(durations.duration_bin(15.9), 'd3_7')
+        self.assertEqual(durations.duration_bin(100), 'd6_4')
+        for seconds in [0.5, 1, 3, 8, 15.9, 100, 2**20 - 1, 2**20]:
+            lower, upper = durations.bin_bounds(durations.duration_bin(seconds))
+            self.assertTrue(lower <= seconds < upper, seconds)
+
+    def test_percentiles(self):
+        # 80 durations, evenly spread from 64 to 128 seconds
+        counters = {f"d6_{j}": 10 for j in range(8)}
+        result = durations.duration_percentiles(counters)
+        self.assertEqual(result, {'count': 80, 'p50': 96.0, 'p95': 124.8, 'p99': 127.4})
+
+    def test_whole_power_bins(self):
+        # counters of whole powers of 2, and counters that are not bins
+        counters = {'d4': 10, 'd5_0': 10, 'COMPLETED': 20, 'collections_workflow': 'x'}
+        result = durations.duration_percentiles(counters, percentiles=[25, 75])
+        self.assertEqual(result, {'count': 20, 'p25': 24.0, 'p75': 34.0})
+
+    def test_no_durations(self):
+        self.assertEqual(durations.duration_percentiles({}), {'count': 0, 'p50': None, 'p95': None, 'p99': None})
+
+
+class TestHandler(unittest.TestCase):
+
+    def setUp(self):
+        self.records = [
+            record(100, 'a', 'COMPLETED', '2021-01-12T10:01:04+00:00', old='PROCESSING_2021-01-12T10:00:00+00:00'),
+            record(101, 'b', 'PROCESSING', '2021-01-12T11:00:00+00:00'),
+            record(102, 'c', 'FAILED', '2021-01-12T10:30:00+00:00')
+        ]
+        self.counters = {}
+
+    def update(self, collections_workflow, bucket, counts):
+        if bucket in self.fail:
+            raise Exception('throttled')
+        for name, n in counts.items():
+            key = (bucket, name)
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    def handle(self, records, fail=[]):
+        self.fail = fail
+        with patch.object(stats, 'update_counters', side_effect=self.update):
+            return stats.lambda_handler({'Records': records}, None)
+
+    def test_counters(self):
+        self.assertEqual(self.handle(self.records), {'batchItemFailures': []})
+        self.assertEqual(self.counters[('hour#2021-01-12T10', 'COMPLETED')], 1)
+        self.assertEqual(self.counters[('hour#2021-01-12T10', 'd6_0')], 1)
+        self.assertEqual(self.counters[('day#2021-01-12', 'FAILED')], 1)
+
+    def test_processing_counted_once(self):
+        # claimed, then the workflow started
+        claimed = record(100, 'a', 'PROCESSING', '2021-01-12T10:00:00+00:00')
+        started = record(101, 'a', 'PROCESSING', '2021-01-12T10:00:01+00:00',
+                         old='PROCESSING_2021-01-12T10:00:00+00:00')
+        self.handle([claimed, started])
+        self.assertEqual(self.counters[('hour#2021-01-12T10', 'PROCESSING')], 1)
+
+    def test_group_not_counted(self):
+        group = record(100, 'a/b', 'COMPLETED', '2021-01-12T10:01:04+00:00', old='PROCESSING_2021-01-12T10:00:00+00:00')
+        group['dynamodb']['NewImage']['members'] = {'L': [{'S': 'a'}, {'S': 'b'}]}
+        members = [record(101 + i, catid, 'COMPLETED', '2021-01-12T10:01:04+00:00',
+                          old='PROCESSING_2021-01-12T10:00:00+00:00') for i, catid in enumerate(['a', 'b'])]
+        self.handle([group] + members)
+        self.assertEqual(self.counters[('hour#2021-01-12T10', 'COMPLETED')], 2)
+
+    def test_retry_counted_once(self):
+        # the hour of the second record fails, the stream is retried from it
+        resp = self.handle(self.records, fail=['hour#2021-01-12T11'])
+        self.assertEqual(resp, {'batchItemFailures': [{'itemIdentifier': '101'}]})
+        self.handle(self.records[1:])
+        # each change is counted once
+        counted = {key: n for key, n in self.counters.items() if n != 0}
+        self.handle(self.records)
+        self.assertEqual({key: n * 2 for key, n in counted.items()},
+                         {key: n for key, n in self.counters.items() if n != 0})
+
+
+if __name__ == '__main__':
+    unittest.main()